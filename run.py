@@ -1,5 +1,11 @@
+from __future__ import annotations
+
 import argparse
+import ast
 import collections
+import gzip
+import hashlib
+import http.client
 import json
 import logging
 import os
@@ -8,14 +14,34 @@ import re
 import shutil
 import subprocess
 import tarfile
+import tempfile
+import threading
+import time
+import urllib.error
 import urllib.parse
+import urllib.request
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
-
-from sysroot_builder import build_sysroot, load_sysroot_config
+from typing import Dict, List
+
+from sysroot_builder import (
+    SysrootBuildError,
+    SysrootConfig,
+    build_sysroot,
+    empty_trash,
+    explain_sysroot,
+    load_sysroot_config,
+    load_sysroot_lock,
+    lock_sysroot,
+    move_to_trash,
+    sysroot_lock_path,
+    verify_sysroot,
+)
 
 logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 
 class ChangeDirectory(object):
@@ -73,6 +99,20 @@ def rm_rf(path: str):
         logging.debug(f"rm -rf {path} => directory removed")
 
 
+# 巨大なディレクトリを削除する。同じファイルシステム上の .trash へ rename で移すだけなので、
+# 実際の削除は切り離した子プロセスに任せ、呼び出し元は待たない。
+def rm_rf_deferred(path: str):
+    if not os.path.exists(path) and not os.path.islink(path):
+        logger.debug(f"rm -rf {path} => path not found")
+        return
+    trashed = move_to_trash(Path(path))
+    if trashed is None:
+        logger.debug(f"rm -rf {path} => removed")
+        return
+    empty_trash(trashed.parent, background=True)
+    logger.debug(f"rm -rf {path} => moved to {trashed}")
+
+
 def mkdir_p(path: str):
     if os.path.exists(path):
         logging.debug(f"mkdir -p {path} => already exists")
@@ -99,7 +139,209 @@ def add_path(path: str, is_after=False):
         os.environ["PATH"] = path + PATH_SEPARATOR + os.environ["PATH"]
 
 
-def download(url: str, output_dir: Optional[str] = None, filename: Optional[str] = None) -> str:
+# download() の読み書きの単位
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# これ以上の大きさのファイルは、サーバーが Range に対応していれば分割して並列にダウンロードする
+DOWNLOAD_PARALLEL_MIN_SIZE = 32 * 1024 * 1024
+# 通信エラーで途切れた場合に、続きから取得し直す回数
+DOWNLOAD_RETRIES = 3
+
+
+class DownloadError(Exception):
+    """ダウンロードしたファイルが壊れているか、途中で変わってしまったときに送出するエラー。"""
+
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _read_json_file(path: str) -> dict | None:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json_file(path: str, value: dict):
+    # 書き込み途中のファイルが読まれないよう、一時ファイルから rename する
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+def _download_part(url: str, path: str, start: int = 0, end: int | None = None):
+    # url の start から end (end を含む) までを path に保存する。end が None なら最後まで。
+    # path に途中まで書かれていれば、続きだけを Range で取得する。
+    # 前回の取得時の ETag や Last-Modified を If-Range に指定して、
+    # サーバー側のファイルが変わっていた場合は最初から取得し直させる。
+    meta_path = f"{path}.meta"
+    offset = os.path.getsize(path) if os.path.exists(path) else 0
+    if end is not None and start + offset > end:
+        return
+    meta = _read_json_file(meta_path) if offset > 0 else None
+    headers = {"User-Agent": "webrtc-build"}
+    if start + offset > 0 or end is not None:
+        headers["Range"] = f"bytes={start + offset}-{'' if end is None else end}"
+        if meta is not None and meta.get("validator"):
+            headers["If-Range"] = meta["validator"]
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        response = urllib.request.urlopen(request, timeout=60)
+    except urllib.error.HTTPError as e:
+        if e.code != 416 or offset == 0:
+            raise
+        # 途中のファイルがサーバー側の大きさと合わないので、最初から取得し直す
+        logger.warning(f"Discarding partial download of {url}")
+        os.remove(path)
+        return _download_part(url, path, start, end)
+    with response:
+        if response.status == 206:
+            mode = "ab"
+        elif start > 0 or end is not None:
+            raise DownloadError(f"Server does not support range requests: {url}")
+        else:
+            # Range に応じなかったか、ファイルが変わっていたので最初から書き直す
+            mode = "wb"
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+        if mode == "wb" or meta is None:
+            _write_json_file(meta_path, {"url": url, "validator": validator})
+        with open(path, mode) as f:
+            shutil.copyfileobj(response, f, DOWNLOAD_CHUNK_SIZE)
+
+
+def _probe_download_size(url: str) -> int | None:
+    # Range に対応したサーバーならファイル全体の大きさを返す
+    request = urllib.request.Request(
+        url, headers={"User-Agent": "webrtc-build", "Range": "bytes=0-0"}
+    )
+    with urllib.request.urlopen(request, timeout=60) as response:
+        content_range = response.headers.get("Content-Range", "")
+        if response.status != 206 or "/" not in content_range:
+            return None
+        size = content_range.rsplit("/", 1)[1]
+        return int(size) if size.isdigit() else None
+
+
+def _download_parallel(url: str, path: str, size: int, jobs: int):
+    # ファイルを jobs 個の範囲に分けて並列に取得し、path へ連結する。
+    # 分け方は .plan に保存し、中断した場合は jobs に関係なく同じ分け方で続きから取得する。
+    plan_path = f"{path}.plan"
+    plan = _read_json_file(plan_path)
+    if plan is None or plan.get("size") != size:
+        chunk_size = -(-size // jobs)
+        ranges = [
+            [start, min(start + chunk_size, size) - 1] for start in range(0, size, chunk_size)
+        ]
+        plan = {"url": url, "size": size, "ranges": ranges}
+        _write_json_file(plan_path, plan)
+    part_paths = [f"{path}.{i}" for i in range(len(plan["ranges"]))]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(_download_part, url, part_path, start, end)
+            for part_path, (start, end) in zip(part_paths, plan["ranges"])
+        ]
+        for future in futures:
+            future.result()
+
+    validators = {(_read_json_file(f"{p}.meta") or {}).get("validator") for p in part_paths}
+    if len(validators) > 1:
+        for part_path in part_paths:
+            os.remove(part_path)
+        raise DownloadError(f"{url} was modified during the download")
+    with open(path, "wb") as f:
+        for part_path in part_paths:
+            with open(part_path, "rb") as part:
+                shutil.copyfileobj(part, f, DOWNLOAD_CHUNK_SIZE)
+    for part_path in part_paths:
+        os.remove(part_path)
+        os.remove(f"{part_path}.meta")
+    os.remove(plan_path)
+
+
+def _download_to_cache(url: str, sha256: str | None, cache_dir: str, jobs: int) -> str:
+    # キャッシュの構成:
+    #   objects/<内容の SHA256>   ダウンロードしたファイル
+    #   urls/<URL の SHA256>.json  URL から objects への対応
+    #   partial/<URL の SHA256>    ダウンロード途中のファイル
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    objects_dir = os.path.join(cache_dir, "objects")
+    urls_dir = os.path.join(cache_dir, "urls")
+    partial_dir = os.path.join(cache_dir, "partial")
+    url_record_path = os.path.join(urls_dir, f"{key}.json")
+
+    if sha256 is not None:
+        sha256 = sha256.lower()
+    else:
+        record = _read_json_file(url_record_path)
+        if record is not None:
+            sha256 = record.get("sha256")
+    if sha256 is not None:
+        object_path = os.path.join(objects_dir, sha256)
+        if os.path.exists(object_path):
+            logger.info(f"Using cached download: {url}")
+            return object_path
+
+    for dir in (objects_dir, urls_dir, partial_dir):
+        mkdir_p(dir)
+    partial_path = os.path.join(partial_dir, key)
+    logger.info(f"Downloading {url}")
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            if os.path.exists(f"{partial_path}.plan"):
+                _download_parallel(
+                    url, partial_path, _read_json_file(f"{partial_path}.plan")["size"], jobs
+                )
+            elif jobs > 1 and not os.path.exists(partial_path):
+                size = _probe_download_size(url)
+                if size is not None and size >= DOWNLOAD_PARALLEL_MIN_SIZE:
+                    _download_parallel(url, partial_path, size, jobs)
+                else:
+                    _download_part(url, partial_path)
+            else:
+                _download_part(url, partial_path)
+            break
+        except urllib.error.HTTPError as e:
+            if e.code < 500 or attempt == DOWNLOAD_RETRIES:
+                raise
+            logger.warning(f"Download failed ({attempt}/{DOWNLOAD_RETRIES}), retrying: {e}")
+        except (urllib.error.URLError, OSError, http.client.HTTPException) as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            logger.warning(f"Download failed ({attempt}/{DOWNLOAD_RETRIES}), retrying: {e}")
+
+    actual = _sha256_file(partial_path)
+    if sha256 is not None and actual != sha256:
+        # 壊れたファイルから再開しないよう、途中のファイルも消しておく。
+        # 並列ダウンロードでは .meta を作らないため、存在するものだけを消す。
+        os.remove(partial_path)
+        for sidecar in (f"{partial_path}.meta", f"{partial_path}.plan"):
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
+        raise DownloadError(f"SHA256 mismatch: {url}: expected={sha256}, actual={actual}")
+    object_path = os.path.join(objects_dir, actual)
+    os.replace(partial_path, object_path)
+    if os.path.exists(f"{partial_path}.meta"):
+        os.remove(f"{partial_path}.meta")
+    _write_json_file(
+        url_record_path, {"url": url, "sha256": actual, "size": os.path.getsize(object_path)}
+    )
+    return object_path
+
+
+def download(
+    url: str,
+    output_dir: str | None = None,
+    filename: str | None = None,
+    sha256: str | None = None,
+    cache_dir: str | None = None,
+    jobs: int = 1,
+) -> str:
     if filename is None:
         output_path = urllib.parse.urlparse(url).path.split("/")[-1]
     else:
@@ -108,28 +350,145 @@ def download(url: str, output_dir: Optional[str] = None, filename: Optional[str]
     if output_dir is not None:
         output_path = os.path.join(output_dir, output_path)
 
-    if os.path.exists(output_path):
+    # ダウンロードしたファイルは内容の SHA256 をキーに cache_dir へ保存し、
+    # 一度取得した URL や SHA256 はネットワークに接続せずにキャッシュから取り出す。
+    # sha256 を指定した場合は、一致しないファイルをエラーにする。
+    # jobs が 2 以上なら、大きなファイルは分割して並列にダウンロードする。
+    if cache_dir is None:
+        cache_dir = os.path.join(BASE_DIR, "_cache", "download")
+    cached_path = _download_to_cache(url, sha256, cache_dir, jobs)
+
+    # 出力先が既に同じ内容なら何もしない。途中で途切れたファイルは置き換える。
+    if (
+        os.path.exists(output_path)
+        and os.path.getsize(output_path) == os.path.getsize(cached_path)
+        and _sha256_file(output_path) == os.path.basename(cached_path)
+    ):
         return output_path
 
+    # 書き込み途中のファイルが残らないよう、一時ファイルから rename する
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
     try:
-        if shutil.which("curl") is not None:
-            cmd(["curl", "-fLo", output_path, url])
-        else:
-            cmd(["wget", "-cO", output_path, url])
+        shutil.copyfile(cached_path, tmp_path)
+        shutil.copymode(cached_path, tmp_path)
+        os.replace(tmp_path, output_path)
     except Exception:
         # ゴミを残さないようにする
-        if os.path.exists(output_path):
-            os.remove(output_path)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         raise
 
     return output_path
 
 
-def downloadcap(url) -> str:
-    if shutil.which("curl") is not None:
-        return cmdcap(["curl", "-L", url])
-    else:
-        return cmdcap(["wget", "-O", "-", url])
+class HttpClientError(Exception):
+    """HttpClient でレスポンスを取得できなかったときに送出するエラー。"""
+
+
+# version_list や version_update で使う HTTP クライアント。
+# 同じホストへの接続をスレッドごとに使い回すので、複数のスレッドから並行に get() できる。
+# cache_dir を指定するとレスポンスを保存し、ttl 秒以内に取得したものはネットワークに接続せずに返す。
+# offline の場合はネットワークに接続せず、保存済みのレスポンスだけを期限に関係なく返す。
+class HttpClient:
+    def __init__(self, cache_dir: str | None = None, ttl: float = 0, offline: bool = False):
+        if offline and cache_dir is None:
+            raise ValueError("Offline mode requires a response cache directory")
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.offline = offline
+        self._local = threading.local()
+        self._connections: list[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, trace):
+        self.close()
+        return False
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+
+    def get(self, url: str) -> str:
+        cache_path = None
+        if self.cache_dir is not None:
+            key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+            cache_path = os.path.join(self.cache_dir, f"{key}.json")
+            entry = _read_json_file(cache_path)
+            # 途中で途切れたり手で編集されたりしたエントリは、キャッシュされていないものとして扱う
+            if (
+                not isinstance(entry, dict)
+                or not isinstance(entry.get("body"), str)
+                or not isinstance(entry.get("fetched_at"), (int, float))
+                or isinstance(entry.get("fetched_at"), bool)
+            ):
+                entry = None
+            if entry is not None and (self.offline or time.time() - entry["fetched_at"] < self.ttl):
+                logger.debug(f"GET {url} => cached")
+                return entry["body"]
+        if self.offline:
+            raise HttpClientError(f"Response is not cached: {url}")
+
+        body = self._fetch(url)
+        if cache_path is not None:
+            mkdir_p(self.cache_dir)
+            _write_json_file(cache_path, {"url": url, "fetched_at": time.time(), "body": body})
+        return body
+
+    def _connection(self, scheme: str, netloc: str, renew: bool = False):
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+        connection = connections.get((scheme, netloc))
+        if connection is not None and renew:
+            connection.close()
+            connection = None
+        if connection is None:
+            if scheme == "https":
+                connection = http.client.HTTPSConnection(netloc, timeout=60)
+            elif scheme == "http":
+                connection = http.client.HTTPConnection(netloc, timeout=60)
+            else:
+                raise HttpClientError(f"Unsupported URL scheme: {scheme}")
+            connections[(scheme, netloc)] = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def _fetch(self, url: str) -> str:
+        # リダイレクトは 5 回まで辿る
+        for _ in range(6):
+            logger.debug(f"GET {url}")
+            parsed = urllib.parse.urlsplit(url)
+            path = parsed.path or "/"
+            if parsed.query:
+                path += f"?{parsed.query}"
+            headers = {"User-Agent": "webrtc-build", "Accept-Encoding": "gzip"}
+            try:
+                connection = self._connection(parsed.scheme, parsed.netloc)
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                # 使い回した接続がサーバー側で閉じられていた場合に備えて、
+                # 接続し直して 1 回だけ再試行する
+                connection = self._connection(parsed.scheme, parsed.netloc, renew=True)
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            if response.status in (301, 302, 303, 307, 308):
+                url = urllib.parse.urljoin(url, response.headers["Location"])
+                continue
+            if response.status != 200:
+                raise HttpClientError(f"HTTP {response.status} {response.reason}: {url}")
+            if response.headers.get("Content-Encoding") == "gzip":
+                data = gzip.decompress(data)
+            return data.decode("utf-8")
+        raise HttpClientError(f"Too many redirects: {url}")
 
 
 def read_version_file(path: str) -> Dict[str, str]:
@@ -431,34 +790,267 @@ def _deps_dirs(src_dir):
     return rel_dirs
 
 
-def apply_patches(target, patch_dir, src_dir, patch_until, commit_patch):
+# パッチのコミットに、適用したパッチファイルの SHA256 を記録する trailer のキー。
+# 値は "<SHA256> <パッチ名>" で、まとめて適用したコミットには適用したパッチの数だけ並ぶ
+PATCH_SHA256_TRAILER = "Patch-SHA256"
+PATCH_COMMIT_PREFIX = "[shiguredo-patch] "
+
+
+def _split_patch_files(data: bytes) -> list[tuple[str, bytes]]:
+    # unified diff をファイルごとに分けて、(src からの相対パス, そのファイルの差分) の一覧を返す。
+    # パスは apply_patch と同じく先頭の 1 要素 (a/ や b/ など) を取り除いたもの
+    sections: list[list] = []
+    current = None
+    has_hunk = False
+    lines = data.splitlines(keepends=True)
+    for i, line in enumerate(lines):
+        if line.startswith(b"diff --git "):
+            current = [None, [line]]
+            sections.append(current)
+            has_hunk = False
+            continue
+        if (
+            line.startswith(b"--- ")
+            and i + 1 < len(lines)
+            and lines[i + 1].startswith(b"+++ ")
+            and (current is None or has_hunk)
+        ):
+            # diff --git の行が無い、ファイルの差分が連続しているだけのパッチ
+            current = [None, []]
+            sections.append(current)
+            has_hunk = False
+        if current is None:
+            # 最初の差分より前にあるコミットメッセージなどは無視する
+            continue
+        if line.startswith(b"@@"):
+            has_hunk = True
+        elif not has_hunk and current[0] is None and line.startswith((b"+++ ", b"--- ")):
+            path = line[4:].rstrip(b"\r\n").split(b"\t")[0]
+            if path != b"/dev/null":
+                current[0] = path
+        current[1].append(line)
+
+    files = []
+    for path, section in sections:
+        if path is None:
+            # リネームやモード変更だけの差分は diff --git の行からパスを取る
+            path = section[0].rstrip(b"\r\n").rsplit(b" ", 1)[-1]
+        path = path.decode("utf-8", errors="surrogateescape")
+        files.append((path.split("/", 1)[-1], b"".join(section)))
+    return files
+
+
+def _owning_repository(path: str, dirs: list[str]) -> str:
+    # path を管理しているリポジトリ (src からの相対パス) を返す。
+    # third_party/libvpx/source/libvpx のように入れ子になっているので、一番深いものを選ぶ
+    owner = "."
+    for dir in dirs:
+        dir = os.path.normpath(dir).replace("\\", "/")
+        if dir == ".":
+            continue
+        if path.startswith(dir + "/") and (owner == "." or len(dir) > len(owner)):
+            owner = dir
+    return owner
+
+
+def _read_patches(patch_dir, patches, dirs) -> list[tuple[str, str, dict[str, list[bytes]]]]:
+    # パッチごとに (パッチ名, SHA256, {リポジトリ: そのリポジトリに当てる差分の一覧}) を返す
+    result = []
+    for patch in patches:
+        with open(os.path.join(patch_dir, patch), "rb") as f:
+            data = f.read()
+        repos: dict[str, list[bytes]] = {}
+        for path, section in _split_patch_files(data):
+            repos.setdefault(_owning_repository(path, dirs), []).append(section)
+        result.append((patch, hashlib.sha256(data).hexdigest(), repos))
+    return result
+
+
+def _commit_patches(dir, subject, patches: list[tuple[str, str]]):
+    with cd(dir):
+        cmd(["git", "add", "--", *GIT_ADD_EXCLUDES])
+        trailers = "\n".join(f"{PATCH_SHA256_TRAILER}: {sha256} {name}" for name, sha256 in patches)
+        cmd(["git", "commit", "--allow-empty", "-q", "-am", subject, "-m", trailers])
+
+
+def _apply_patches_batched(src_dir, patches) -> bool:
+    # 全パッチの差分をリポジトリごとにまとめ、リポジトリごとに 1 回の git apply で当てる。
+    # コミットは差分を当てたリポジトリと、適用したパッチを記録する src だけに作る。
+    # どこかで当たらなければ、当てた差分だけを git apply -R で元に戻して False を返す。
+    # 手元で追加したファイルなどを消さないよう、reset --hard や clean は使わない
+    repos: dict[str, list[bytes]] = {}
+    for _, _, patch_repos in patches:
+        for dir, sections in patch_repos.items():
+            repos.setdefault(dir, []).extend(sections)
+    applied: list[tuple[str, list[str], bytes]] = []
+    for dir, sections in repos.items():
+        depth = 1 if dir == "." else 1 + len(dir.split("/"))
+        args = [
+            "git",
+            "apply",
+            f"-p{depth}",
+            "--ignore-space-change",
+            "--ignore-whitespace",
+            "--whitespace=nowarn",
+        ]
+        diff = b"".join(sections)
+        logger.info(f"git apply -p{depth} ({len(sections)} files) in {dir}")
+        try:
+            with cd(os.path.join(src_dir, dir)):
+                # git apply は全部当たるか何も当たらないかのどちらかになる
+                cmd(args, input=diff)
+        except subprocess.CalledProcessError as e:
+            logger.warning(
+                f"Failed to apply patches at once in {dir} ({e}); "
+                "reverting them and applying the patches one by one"
+            )
+            for applied_dir, applied_args, applied_diff in reversed(applied):
+                with cd(os.path.join(src_dir, applied_dir)):
+                    cmd([*applied_args, "-R"], input=applied_diff)
+            return False
+        applied.append((dir, args, diff))
+
+    names = [(name, sha256) for name, sha256, _ in patches]
+    if len(names) == 1:
+        subject = f"{PATCH_COMMIT_PREFIX}Apply {names[0][0]}"
+    else:
+        subject = f"{PATCH_COMMIT_PREFIX}Apply {len(names)} patches"
+    for dir in sorted(set(repos) | {"."}):
+        _commit_patches(os.path.join(src_dir, dir), subject, names)
+    return True
+
+
+def apply_patches(target, patch_dir, src_dir, patch_until, commit_patch, start=0, per_patch=False):
+    # PATCHES[target] の start 番目以降のパッチを当ててコミットする。
+    # 通常は全パッチをまとめて、リポジトリごとに 1 回の git apply と 1 つのコミットで当てる。
+    # per_patch を指定するか patch_until が指定されている場合は、パッチごとに当ててコミットする。
     # patch_until が指定されている場合、そのパッチファイルまで適用とコミットして、
     # patch_until のパッチに関しては適用だけ行う
     if patch_until is not None:
         if patch_until not in PATCHES[target]:
             raise Exception(f"{patch_until} file is not in PATCHES")
 
+    patches = PATCHES[target][start:]
+    if len(patches) == 0:
+        return
+    with cd(src_dir):
+        dirs = _deps_dirs(src_dir)
+    patches = _read_patches(patch_dir, patches, dirs)
+
+    if not per_patch and patch_until is None and _apply_patches_batched(src_dir, patches):
+        return
+
     with cd(src_dir):
-        for patch in PATCHES[target]:
+        for patch, patch_sha256, repos in patches:
             apply_patch(os.path.join(patch_dir, patch), src_dir, 1)
             if patch == patch_until and not commit_patch:
                 break
-            cmd(["gclient", "recurse", "git", "add", "--", *GIT_ADD_EXCLUDES])
-            cmd(
-                [
-                    "gclient",
-                    "recurse",
-                    "git",
-                    "commit",
-                    "--allow-empty",
-                    "-am",
-                    f"[shiguredo-patch] Apply {patch}",
-                ]
-            )
+            for dir in sorted(set(repos) | {"."}):
+                _commit_patches(
+                    os.path.join(src_dir, dir),
+                    f"{PATCH_COMMIT_PREFIX}Apply {patch}",
+                    [(patch, patch_sha256)],
+                )
             if patch == patch_until and commit_patch:
                 break
 
 
+def _applied_patch_commits(n=100) -> list[list[tuple[str, str | None]]]:
+    # カレントディレクトリのリポジトリに積まれている時雨堂パッチのコミットを古い順に返す。
+    # 各コミットは、そのコミットで適用した (パッチ名, 記録された SHA256) の一覧になる。
+    # SHA256 を記録する前に作られたコミットの場合は None になる
+    out = cmdcap(
+        [
+            "git",
+            "log",
+            f"--format=%s%x00%(trailers:key={PATCH_SHA256_TRAILER},valueonly,separator=%x2C)",
+            f"-n{n}",
+        ]
+    )
+    commits = []
+    for line in out.split("\n"):
+        subject, _, values = line.partition("\x00")
+        if not subject.startswith(f"{PATCH_COMMIT_PREFIX}Apply "):
+            break
+        name = subject[len(f"{PATCH_COMMIT_PREFIX}Apply ") :]
+        patches = []
+        for value in values.split(","):
+            sha256, _, patch = value.strip().partition(" ")
+            if sha256 != "":
+                # 以前は SHA256 だけを記録していたので、その場合は件名からパッチ名を取る
+                patches.append((patch or name, sha256))
+        commits.append(patches or [(name, None)])
+    return list(reversed(commits))
+
+
+def _applied_patches(n=100) -> list[tuple[str, str | None]]:
+    # カレントディレクトリのリポジトリに適用済みのパッチを、古い順に (パッチ名, SHA256) の一覧で返す
+    return [patch for commit in _applied_patch_commits(n) for patch in commit]
+
+
+def reapply_changed_patches(target, patch_dir, src_dir, force=False) -> bool:
+    # 適用済みのパッチと PATCHES[target] を先頭から比べ、最初に変わったパッチ以降だけを適用し直す。
+    # src には適用したパッチが全て記録されているので、src のコミット単位で戻す位置を決め、
+    # 他のリポジトリでは戻した src のコミットと同じときに作られたコミットを戻す。
+    # force でなければ、手元の変更を消さないよう、未コミットの変更がある場合は何もしない。
+    # また、build のたびに呼ばれるので追加されたファイルは消さず、パッチのコミットを戻すだけにする
+    desired = [(name, sha256) for name, sha256 in _patch_set(patch_dir, target)]
+    with cd(src_dir):
+        commits = _applied_patch_commits(len(desired) + 30)
+    applied = [patch for commit in commits for patch in commit]
+    start = 0
+    while start < min(len(desired), len(applied)) and applied[start] == desired[start]:
+        start += 1
+    if start == len(desired) == len(applied):
+        return False
+    if start == len(desired):
+        reason = f"{applied[start][0]} was removed"
+    elif start == len(applied):
+        reason = f"{desired[start][0]} was added"
+    else:
+        reason = f"{desired[start][0]} changed"
+
+    # まとめて適用したコミットは途中から戻せないので、start を含むコミットの手前まで戻す
+    keep = 0
+    kept = 0
+    while keep < len(commits) and kept + len(commits[keep]) <= start:
+        kept += len(commits[keep])
+        keep += 1
+    start = kept
+    kept_commits = [tuple(commit) for commit in commits[:keep]]
+
+    with cd(src_dir):
+        dirs = _deps_dirs(src_dir)
+        if not force:
+            for dir in dirs:
+                with cd(dir):
+                    if cmdcap(["git", "status", "--porcelain", "--untracked-files=no"]) != "":
+                        logger.warning(
+                            f"Patches have changed ({reason}) but {dir} has local changes; "
+                            "run `python3 run.py fetch` to re-apply them"
+                        )
+                        return False
+        logger.info(
+            f"Re-applying {len(desired) - start} patches because {reason}; "
+            f"reverting {len(applied) - start} applied patches"
+        )
+        for dir in dirs:
+            with cd(dir):
+                repo_commits = _applied_patch_commits(len(desired) + 30)
+                drop = 0
+                for commit in reversed(repo_commits):
+                    if tuple(commit) in kept_commits:
+                        break
+                    drop += 1
+                if drop == 0:
+                    continue
+                cmd(["git", "reset", "-q", "--hard", f"HEAD~{drop}"])
+                if force:
+                    cmd(["git", "clean", "-df"])
+    apply_patches(target, patch_dir, src_dir, None, False, start=start)
+    return True
+
+
 # 時雨堂パッチが当たっていない最新のコミットを取得する
 def get_base_commit(n=30):
     lines = cmdcap(["git", "log", "--format=%H %s", f"-n{n}"]).split("\n")
@@ -469,31 +1061,225 @@ def get_base_commit(n=30):
     raise Exception("base commit not found")
 
 
-def get_webrtc(source_dir, patch_dir, version, target, webrtc_source_dir, no_history=False):
+def _read_gclient_cache_dir(webrtc_source_dir) -> str | None:
+    # .gclient に記録した cache_dir を返す
+    path = os.path.join(webrtc_source_dir, ".gclient")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        m = re.search(r"^cache_dir = (.*)$", f.read(), re.MULTILINE)
+    if m is None:
+        return None
+    return ast.literal_eval(m.group(1))
+
+
+def _use_git_cache(webrtc_source_dir, git_cache_dir: str | None) -> str | None:
+    # gclient は GIT_CACHE_PATH (.gclient の cache_dir) にリポジトリごとの bare ミラーを作り、
+    # 各ターゲットのチェックアウトはミラーのオブジェクトを参照するだけになる。
+    # そのため複数のターゲットで同じキャッシュを使えば、取得もディスク使用量も 1 つ分で済む。
+    if git_cache_dir is None:
+        git_cache_dir = _read_gclient_cache_dir(webrtc_source_dir)
+    if git_cache_dir is None:
+        return None
+    git_cache_dir = os.path.abspath(git_cache_dir)
+    mkdir_p(git_cache_dir)
+    os.environ["GIT_CACHE_PATH"] = git_cache_dir
+    return git_cache_dir
+
+
+def _fetch_webrtc_src(version, no_history, git_cache_dir: str | None):
+    if git_cache_dir is not None:
+        # origin はミラーを指しているので、ミラーを更新してからそこから取得する
+        cmd(["git", "cache", "fetch"])
+    elif no_history:
+        cmd(["git", "fetch", "--depth=1", "origin", version])
+    else:
+        cmd(["git", "fetch"])
+
+
+def _gclient_target_os(target) -> list[str]:
+    # .gclient の target_os に追加する OS
+    if target in ("android", "android_sdk"):
+        return ["android"]
+    if target in ("ios", "ios_sdk"):
+        return ["ios"]
+    return []
+
+
+def _sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _patch_set(patch_dir, target) -> list[list[str]]:
+    # ターゲットに適用するパッチの名前と内容の SHA256 の一覧
+    patches = []
+    for patch in PATCHES[target]:
+        with open(os.path.join(patch_dir, patch), "rb") as f:
+            patches.append([patch, _sha256_bytes(f.read())])
+    return patches
+
+
+# fetch で最後に同期したときの状態を記録するファイル。webrtc_source_dir 直下に置く
+WEBRTC_FETCH_FINGERPRINT = ".webrtc-build-fetch.json"
+
+
+def webrtc_fetch_fingerprint(webrtc_source_dir, patch_dir, version, target) -> dict[str, str]:
+    # gclient sync とパッチの適用の結果は、コミット、そのコミットの DEPS、.gclient、パッチで決まる
+    with cd(os.path.join(webrtc_source_dir, "src")):
+        deps = cmd(["git", "show", f"{version}:DEPS"], stdout=subprocess.PIPE).stdout
+    with open(os.path.join(webrtc_source_dir, ".gclient"), "rb") as f:
+        gclient = f.read()
+    patches = json.dumps(_patch_set(patch_dir, target), separators=(",", ":"))
+    return {
+        "commit": version,
+        "deps": _sha256_bytes(deps),
+        "gclient": _sha256_bytes(gclient),
+        "patches": _sha256_bytes(patches.encode("utf-8")),
+    }
+
+
+def _write_fetch_fingerprint(webrtc_source_dir, patch_dir, version, target):
+    fingerprint = webrtc_fetch_fingerprint(webrtc_source_dir, patch_dir, version, target)
+    _write_json_file(os.path.join(webrtc_source_dir, WEBRTC_FETCH_FINGERPRINT), fingerprint)
+
+
+def _webrtc_fetch_fingerprint_changes(webrtc_source_dir, patch_dir, version, target) -> list[str]:
+    # 記録した fingerprint と現在の状態で値の異なる項目の一覧を返す。
+    # 記録がない場合や、コミットがまだ取得されていない場合は全ての項目を返す
+    recorded = _read_json_file(os.path.join(webrtc_source_dir, WEBRTC_FETCH_FINGERPRINT)) or {}
+    try:
+        current = webrtc_fetch_fingerprint(webrtc_source_dir, patch_dir, version, target)
+    except (OSError, subprocess.CalledProcessError):
+        return ["commit", "deps", "gclient", "patches"]
+    return [key for key, value in current.items() if recorded.get(key) != value]
+
+
+def _webrtc_source_is_synced(webrtc_source_dir, patch_dir, version, target) -> bool:
+    # fingerprint のうち gclient sync に関わる値が一致し、チェックアウトが同期した直後の状態のままなら
+    # True を返す。パッチの変更は gclient sync をやり直さなくても reapply_changed_patches で反映できる
+    changes = _webrtc_fetch_fingerprint_changes(webrtc_source_dir, patch_dir, version, target)
+    if any(key != "patches" for key in changes):
+        return False
+
+    # src は指定したコミットの上に、パッチのコミットだけが積まれているはず
+    src_dir = os.path.join(webrtc_source_dir, "src")
+    with cd(src_dir):
+        if get_base_commit(max(len(x) for x in PATCHES.values()) + 30) != version:
+            return False
+        # fetch は手で書き換えたファイルも元に戻すので、変更がある場合は通常どおり同期し直す。
+        # 追加されたファイルまで調べると src 全体を走査して遅くなるので、依存リポジトリと同じく
+        # 追跡しているファイルだけを見る。ビルドに影響しない追加ファイルは残る
+        if cmdcap(["git", "status", "--porcelain", "--untracked-files=no"]) != "":
+            return False
+        for dir in _deps_dirs(src_dir):
+            if os.path.normpath(dir) == ".":
+                continue
+            with cd(dir):
+                if cmdcap(["git", "status", "--porcelain", "--untracked-files=no"]) != "":
+                    return False
+    return True
+
+
+def webrtc_snapshot_key(patch_dir, version, target) -> str:
+    # パッチを当てた WebRTC のソースは、コミット、適用するパッチの内容、target_os と、
+    # gclient sync がホスト向けのツールを取得するのでホストの OS とアーキテクチャで決まる
+    payload = {
+        "commit": version,
+        "patches": _patch_set(patch_dir, target),
+        "target_os": _gclient_target_os(target),
+        "host": f"{platform.system()}_{platform.machine()}",
+    }
+    encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def _webrtc_snapshot_paths(snapshot_dir, key) -> list[str]:
+    return [os.path.join(snapshot_dir, f"webrtc-{key}{ext}") for ext in (".tar.zst", ".tar.gz")]
+
+
+def restore_webrtc_snapshot(snapshot_dir, key, webrtc_source_dir) -> bool:
+    # スナップショットがあれば webrtc_source_dir へ展開する。
+    # tar は圧縮形式を自動で判別し、ファイルを読みながら展開する
+    for path in _webrtc_snapshot_paths(snapshot_dir, key):
+        if not os.path.exists(path):
+            continue
+        logger.info(f"Restoring WebRTC source snapshot: {path}")
+        mkdir_p(webrtc_source_dir)
+        try:
+            cmd(["tar", "-xf", path, "-C", webrtc_source_dir])
+        except subprocess.CalledProcessError as e:
+            # 壊れたスナップショットの場合は、展開途中のものを消して通常の取得に切り替える
+            logger.warning(f"Failed to restore WebRTC source snapshot: {e}")
+            rm_rf(os.path.join(webrtc_source_dir, "src"))
+            rm_rf(os.path.join(webrtc_source_dir, ".gclient"))
+            rm_rf(os.path.join(webrtc_source_dir, ".gclient_entries"))
+            return False
+        return True
+    return False
+
+
+def save_webrtc_snapshot(snapshot_dir, key, webrtc_source_dir):
+    mkdir_p(snapshot_dir)
+    if shutil.which("zstd") is not None:
+        ext, compress_flag = ".tar.zst", "--zstd"
+    else:
+        ext, compress_flag = ".tar.gz", "-z"
+    path = os.path.join(snapshot_dir, f"webrtc-{key}{ext}")
+    # 書き込み途中のファイルが使われないよう、一時ファイルから rename する
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    logger.info(f"Saving WebRTC source snapshot: {path}")
+    try:
+        cmd(["tar", compress_flag, "-cf", tmp_path, "-C", webrtc_source_dir, "."])
+        os.replace(tmp_path, path)
+    except Exception:
+        # ゴミを残さないようにする
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def get_webrtc(
+    source_dir,
+    patch_dir,
+    version,
+    target,
+    webrtc_source_dir,
+    no_history=False,
+    git_cache_dir: str | None = None,
+    snapshot_dir: str | None = None,
+):
     if webrtc_source_dir is None:
         webrtc_source_dir = os.path.join(source_dir, "webrtc")
 
     mkdir_p(webrtc_source_dir)
+    git_cache_dir = _use_git_cache(webrtc_source_dir, git_cache_dir)
 
     no_history_flag = ["--no-history"] if no_history else []
 
     src_dir = os.path.join(webrtc_source_dir, "src")
     if not os.path.exists(src_dir):
+        # パッチを当てた状態のスナップショットがあれば、取得からパッチの適用までを省略する
+        snapshot_key = None
+        if snapshot_dir is not None:
+            snapshot_key = webrtc_snapshot_key(patch_dir, version, target)
+            if restore_webrtc_snapshot(snapshot_dir, snapshot_key, webrtc_source_dir):
+                return
+
         with cd(webrtc_source_dir):
             cmd(["gclient"])
             cmd(["fetch", *no_history_flag, "webrtc"])
-            if target in ("android", "android_sdk"):
+            # 以降の gclient sync でも同じキャッシュを使うよう記録しておく
+            if git_cache_dir is not None:
                 with open(".gclient", "a") as f:
-                    f.write("target_os = [ 'android' ]\n")
-            if target in ("ios", "ios_sdk"):
+                    f.write(f"cache_dir = {git_cache_dir!r}\n")
+            # target_os の追加分は、次の gclient sync でその OS 向けの依存だけが追加で取得される
+            target_os = _gclient_target_os(target)
+            if len(target_os) != 0:
                 with open(".gclient", "a") as f:
-                    f.write("target_os = [ 'ios' ]\n")
+                    f.write(f"target_os = [ {', '.join(repr(x) for x in target_os)} ]\n")
 
         with cd(src_dir):
-            if no_history:
-                cmd(["git", "fetch", "--depth=1", "origin", version])
-            else:
-                cmd(["git", "fetch"])
+            _fetch_webrtc_src(version, no_history, git_cache_dir)
             cmd(["git", "checkout", "-f", version])
             cmd(["git", "clean", "-df"])
             cmd(
@@ -508,19 +1294,44 @@ def get_webrtc(source_dir, patch_dir, version, target, webrtc_source_dir, no_his
                 ]
             )
             apply_patches(target, patch_dir, src_dir, None, False)
+        _write_fetch_fingerprint(webrtc_source_dir, patch_dir, version, target)
+
+        if snapshot_key is not None:
+            if git_cache_dir is not None:
+                # git のキャッシュを参照するチェックアウトは、キャッシュがない環境では使えない
+                logger.warning("WebRTC source snapshot is not saved when --git-cache-dir is used")
+            else:
+                save_webrtc_snapshot(snapshot_dir, snapshot_key, webrtc_source_dir)
+    else:
+        # 既存のソースは取得し直さず、変更されたパッチ以降だけを適用し直す
+        reapply_changed_patches(target, patch_dir, src_dir)
 
 
-def fetch_webrtc(source_dir, patch_dir, version, target, webrtc_source_dir):
+def fetch_webrtc(
+    source_dir, patch_dir, version, target, webrtc_source_dir, git_cache_dir: str | None = None
+):
     if webrtc_source_dir is None:
         webrtc_source_dir = os.path.join(source_dir, "webrtc")
 
+    git_cache_dir = _use_git_cache(webrtc_source_dir, git_cache_dir)
     src_dir = os.path.join(webrtc_source_dir, "src")
+    # 前回の fetch からコミットや DEPS が変わっていなければ、全依存リポジトリを辿る
+    # gclient sync を省略し、変更されたパッチ以降だけを適用し直す
+    if _webrtc_source_is_synced(webrtc_source_dir, patch_dir, version, target):
+        logger.info("WebRTC source is already synced; skipping gclient sync")
+        if _webrtc_fetch_fingerprint_changes(webrtc_source_dir, patch_dir, version, target):
+            reapply_changed_patches(target, patch_dir, src_dir, force=True)
+            _write_fetch_fingerprint(webrtc_source_dir, patch_dir, version, target)
+        return
+    # 途中で失敗した状態を同期済みと判断しないよう、先に記録を消しておく
+    rm_rf(os.path.join(webrtc_source_dir, WEBRTC_FETCH_FINGERPRINT))
     with cd(src_dir):
-        cmd(["git", "fetch"])
+        _fetch_webrtc_src(version, False, git_cache_dir)
         cmd(["git", "checkout", "-f", version])
         cmd(["git", "clean", "-df"])
         cmd(["gclient", "sync", "-D", "--force", "--reset", "--with_branch_heads"])
         apply_patches(target, patch_dir, src_dir, None, False)
+    _write_fetch_fingerprint(webrtc_source_dir, patch_dir, version, target)
 
 
 def revert_webrtc(source_dir, patch_dir, target, webrtc_source_dir, patch, commit):
@@ -537,7 +1348,8 @@ def revert_webrtc(source_dir, patch_dir, target, webrtc_source_dir, patch, commi
                 cmd(["git", "reset", "--soft", commit_hash])
         cmd(["gclient", "recurse", "git", "reset", "--hard"])
         cmd(["gclient", "recurse", "git", "clean", "-df"])
-        apply_patches(target, patch_dir, src_dir, patch, commit)
+        # パッチを編集しやすいよう、パッチごとにコミットする
+        apply_patches(target, patch_dir, src_dir, patch, commit, per_patch=True)
 
 
 def diff_webrtc(source_dir, webrtc_source_dir):
@@ -572,6 +1384,202 @@ def diff_webrtc(source_dir, webrtc_source_dir):
                 )
 
 
+def _check_repository_patches(repo_dir, depth, tree, patches) -> list[tuple[str, bool, list[str]]]:
+    # 使い捨てのインデックスに tree を読み込み、patches の差分を順に
+    # git apply --cached で当てていく。当たらなかったパッチはインデックスに反映されないので、
+    # 後続のパッチはそれを除いた状態で確認する。
+    # 作業ツリーには触らないので、複数のリポジトリを並列に確認できる
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmp, "index"))
+        cmd(["git", "read-tree", tree], cwd=repo_dir, env=env)
+        for patch, sections in patches:
+            r = cmd(
+                [
+                    "git",
+                    "apply",
+                    "--cached",
+                    "-v",
+                    f"-p{depth}",
+                    "--ignore-space-change",
+                    "--ignore-whitespace",
+                    "--whitespace=nowarn",
+                ],
+                cwd=repo_dir,
+                env=env,
+                input=b"".join(sections),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                check=False,
+            )
+            # ハンクごとの結果 (ずれて当たった行数やエラー) だけを、ファイル名を付けて残す
+            report = []
+            path = ""
+            for line in r.stderr.decode("utf-8", errors="replace").splitlines():
+                m = re.match(r"Checking patch (.*)\.\.\.$", line)
+                if m is not None:
+                    path = m.group(1)
+                elif line.startswith(("Hunk #", "error:")):
+                    report.append(f"{path}: {line}")
+            results.append((patch, r.returncode == 0, report))
+    return results
+
+
+class PatchCheckError(Exception):
+    """パッチを確認する元のソースが決められないときに送出するエラー。"""
+
+
+def _eval_deps_expression(node, vars):
+    # DEPS の式を評価する。gclient と同じく Var() と文字列中の {name} を vars の値に置き換える。
+    # DEPS は Python のコードとしては実行せず、依存の指定に使われる式だけを扱う
+    if isinstance(node, ast.Constant):
+        value = node.value
+    elif isinstance(node, ast.Dict):
+        return {
+            _eval_deps_expression(k, vars): _eval_deps_expression(v, vars)
+            for k, v in zip(node.keys, node.values)
+            if k is not None
+        }
+    elif isinstance(node, ast.List):
+        return [_eval_deps_expression(x, vars) for x in node.elts]
+    elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        value = _eval_deps_expression(node.left, vars) + _eval_deps_expression(node.right, vars)
+    elif (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Name)
+        and node.func.id in ("Var", "Str")
+        and len(node.args) == 1
+    ):
+        value = _eval_deps_expression(node.args[0], vars)
+        if node.func.id == "Var":
+            value = vars[value]
+    else:
+        raise ValueError(f"Unsupported expression in DEPS: {ast.dump(node)}")
+    if isinstance(value, str):
+        value = re.sub(r"\{(\w+)\}", lambda m: str(vars.get(m.group(1), m.group(0))), value)
+    return value
+
+
+def _deps_revisions(version) -> dict[str, str]:
+    # カレントディレクトリの src にある version の DEPS から、git の依存リポジトリごとに
+    # 固定されたリビジョンを {src からの相対パス: リビジョン} で返す
+    tree = ast.parse(cmdcap(["git", "show", f"{version}:DEPS"]))
+    assignments = {
+        node.targets[0].id: node.value
+        for node in tree.body
+        if isinstance(node, ast.Assign)
+        and len(node.targets) == 1
+        and isinstance(node.targets[0], ast.Name)
+    }
+    vars = {}
+    if "vars" in assignments:
+        vars = _eval_deps_expression(assignments["vars"], {})
+    revisions = {}
+    deps = assignments.get("deps")
+    if not isinstance(deps, ast.Dict):
+        return revisions
+    for key, value in zip(deps.keys, deps.values):
+        try:
+            path = _eval_deps_expression(key, vars)
+            dep = _eval_deps_expression(value, vars)
+        except (ValueError, KeyError, TypeError):
+            # 条件付きの特殊な指定などは確認の対象にしない
+            continue
+        if isinstance(dep, dict):
+            if dep.get("dep_type", "git") != "git":
+                continue
+            dep = dep.get("url")
+        if not isinstance(path, str) or not isinstance(dep, str) or "@" not in dep:
+            continue
+        if path.startswith("src/"):
+            revisions[path[len("src/") :]] = dep.rsplit("@", 1)[1]
+    return revisions
+
+
+def _is_fetched(dir, revision) -> bool:
+    with cd(dir):
+        r = cmd(["git", "cat-file", "-e", f"{revision}^{{commit}}"], check=False)
+    return r.returncode == 0
+
+
+def check_patches(source_dir, patch_dir, target, webrtc_source_dir, version) -> bool:
+    # PATCHES[target] の全パッチが、パッチを当てる前のソースに順番通り当たるかを確認する。
+    # VERSION のコミットが手元にあれば、src はそのコミット、依存リポジトリはその DEPS で
+    # 固定されたリビジョンを使う。取得されていないリビジョンの依存リポジトリは確認しない。
+    # VERSION のコミットが無ければ、今のパッチの下のコミットを使う
+    if webrtc_source_dir is None:
+        webrtc_source_dir = os.path.join(source_dir, "webrtc")
+
+    src_dir = os.path.join(webrtc_source_dir, "src")
+    with cd(src_dir):
+        dirs = _deps_dirs(src_dir)
+    patches = _read_patches(patch_dir, PATCHES[target], dirs)
+
+    repos: dict[str, list[tuple[str, list[bytes]]]] = {}
+    for patch, _, patch_repos in patches:
+        for dir, sections in patch_repos.items():
+            repos.setdefault(dir, []).append((patch, sections))
+
+    # パッチが触るリポジトリについてだけ、確認する元のリビジョンを決める
+    trees: dict[str, str] = {}
+    skipped: dict[str, str] = {}
+    with cd(src_dir):
+        if _is_fetched(".", version):
+            revisions = _deps_revisions(version)
+            for dir in repos:
+                revision = version if dir == "." else revisions.get(dir)
+                if revision is None:
+                    skipped[dir] = f"not pinned in the DEPS of {version}"
+                elif not _is_fetched(dir, revision):
+                    skipped[dir] = f"{revision} is not fetched"
+                else:
+                    trees[dir] = revision
+        else:
+            # パッチを当てていない src の HEAD は、どのコミットか分からないので使わない
+            if not _applied_patch_commits(1):
+                raise PatchCheckError(
+                    f"{version} is not fetched and {src_dir} has no patches applied; "
+                    "run `python3 run.py fetch` first"
+                )
+            logger.warning(f"{version} is not fetched yet, checking against the unpatched commits")
+            for dir in repos:
+                with cd(dir):
+                    trees[dir] = get_base_commit()
+    for dir, reason in skipped.items():
+        logger.warning(f"Skipping patches for {dir}: {reason}")
+
+    reports: dict[str, list[str]] = {patch: [] for patch, _, _ in patches}
+    for dir, reason in skipped.items():
+        for patch, _ in repos[dir]:
+            reports[patch].append(f"{dir}: skipped, {reason}")
+    failed = set()
+    with ThreadPoolExecutor(max_workers=min(len(trees), os.cpu_count() or 1) or 1) as executor:
+        futures = {
+            executor.submit(
+                _check_repository_patches,
+                os.path.join(src_dir, dir),
+                1 if dir == "." else 1 + len(dir.split("/")),
+                trees[dir],
+                repo_patches,
+            ): dir
+            for dir, repo_patches in repos.items()
+            if dir in trees
+        }
+        for future in as_completed(futures):
+            dir = futures[future]
+            for patch, ok, report in future.result():
+                if not ok:
+                    failed.add(patch)
+                prefix = "" if dir == "." else f"{dir}/"
+                reports[patch].extend(f"{prefix}{line}" for line in report)
+
+    for patch, _, _ in patches:
+        print(f"{'FAILED' if patch in failed else 'OK':>6}  {patch}")
+        for line in sorted(reports[patch]):
+            print(f"        {line}")
+    return len(failed) == 0
+
+
 def git_get_url_and_revision(dir):
     with cd(dir):
         rev = get_base_commit()
@@ -608,17 +1616,208 @@ SYSROOT_CONFIGS = {
     "ubuntu-22.04_armv8": "ubuntu-22.04_armv8.json",
     "ubuntu-24.04_armv8": "ubuntu-24.04_armv8.json",
     "ubuntu-26.04_armv8": "ubuntu-26.04_armv8.json",
+    "ubuntu-22.04_x86_64": "ubuntu-22.04_x86_64.json",
+    "ubuntu-24.04_x86_64": "ubuntu-24.04_x86_64.json",
+    "ubuntu-26.04_x86_64": "ubuntu-26.04_x86_64.json",
 }
 
 
-def init_sysroot(target: str, output_dir: str, force: bool) -> None:
+def resolve_artifact_source(value: str | None) -> str | None:
+    # URL 以外はローカルのディレクトリとして、カレントディレクトリ基準の絶対パスにする
+    if value is None or "://" in value:
+        return value
+    return os.path.abspath(value)
+
+
+def load_target_sysroot_config(target: str) -> SysrootConfig:
     config_path = Path(BASE_DIR) / "sysroot" / SYSROOT_CONFIGS[target]
     config = load_sysroot_config(config_path)
     if config.name != target:
         raise RuntimeError(
             f"Sysroot config name does not match target: expected={target}, actual={config.name}"
         )
-    build_sysroot(config, Path(output_dir), force=force)
+    return config
+
+
+def init_sysroot_lock(target: str) -> None:
+    # 依存解決の結果を sysroot/<target>.lock.json に固定する
+    config_path = Path(BASE_DIR) / "sysroot" / SYSROOT_CONFIGS[target]
+    lock_sysroot(
+        load_target_sysroot_config(target),
+        sysroot_lock_path(config_path),
+        cache_dir=Path(BASE_DIR) / "_cache" / "sysroot",
+    )
+
+
+def init_sysroot(
+    target: str,
+    output_dir: str,
+    force: bool,
+    cache_dir: str | None = None,
+    incremental: bool = False,
+    artifact_source: str | None = None,
+    artifact_dir: str | None = None,
+    use_cache: bool = True,
+    metrics_dir: str | None = None,
+) -> bool:
+    config = load_target_sysroot_config(target)
+    # lockfile があれば apt による依存解決を省略し、固定した deb から生成する
+    lock_path = sysroot_lock_path(Path(BASE_DIR) / "sysroot" / SYSROOT_CONFIGS[target])
+    if lock_path.exists():
+        config = load_sysroot_lock(lock_path, config)
+    # ダウンロードした deb はターゲット間で共有するキャッシュに保存して使い回す
+    if cache_dir is None:
+        cache_dir = os.path.join(BASE_DIR, "_cache", "sysroot")
+    return build_sysroot(
+        config,
+        Path(output_dir),
+        force=force,
+        incremental=incremental,
+        cache_dir=Path(cache_dir) if use_cache else None,
+        artifact_source=artifact_source,
+        artifact_dir=Path(artifact_dir) if artifact_dir is not None else None,
+        # 生成にかかった時間や量を <metrics_dir>/<target>.json にも書き出す
+        metrics_path=Path(metrics_dir) / f"{target}.json" if metrics_dir is not None else None,
+    )
+
+
+class SysrootWorkerError(Exception):
+    """別プロセスでの sysroot の生成に失敗したときに、そのターゲットの所要時間を添えて送出するエラー。"""
+
+    def __init__(self, message: str, elapsed: float):
+        super().__init__(message, elapsed)
+        self.message = message
+        self.elapsed = elapsed
+
+    def __str__(self) -> str:
+        return self.message
+
+
+def _init_sysroot_worker(
+    target: str, output_dir: str, log_path: str, options: dict
+) -> tuple[bool, float]:
+    # 別プロセスで 1 ターゲット分の sysroot を生成する。
+    # 並列に生成するターゲットのログが混ざらないよう、ログはターゲットごとのファイルに書く
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    handler = logging.FileHandler(log_path, mode="w", encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    root_logger.addHandler(handler)
+    start = time.monotonic()
+    try:
+        built = init_sysroot(target, output_dir, **options)
+    except Exception as error:
+        logger.exception(f"Failed to build sysroot: {target}")
+        # 失敗したターゲットもプール全体ではなく、そのターゲットの所要時間を集計に出す
+        raise SysrootWorkerError(str(error), time.monotonic() - start) from error
+    return built, time.monotonic() - start
+
+
+def verify_sysroots(targets: list[str], source_dir: str | None) -> None:
+    # manifest のファイル一覧と照合し、変更のあった sysroot があれば失敗にする
+    failed = []
+    for target in targets:
+        target_source_dir = source_dir or os.path.join(BASE_DIR, "_source", target)
+        sysroot_dir = os.path.join(target_source_dir, "rootfs")
+        problems = verify_sysroot(Path(sysroot_dir))
+        for problem in problems:
+            logger.error(f"{target}: {problem}")
+        if problems:
+            logger.error(f"{target}: {len(problems)} problems found in {sysroot_dir}")
+            failed.append(target)
+        else:
+            logger.info(f"{target}: OK")
+    if failed:
+        raise SysrootBuildError(f"Modified sysroots: {', '.join(failed)}")
+
+
+def explain_sysroots(targets: list[str]) -> None:
+    # deb ごとのサイズと引き込んだ packages の要素を表示し、packages の要素ごとに
+    # 依存の閉包全体のサイズと、その要素だけが引き込んでいるサイズを集計する
+    for target in targets:
+        packages = explain_sysroot(
+            load_target_sysroot_config(target), cache_dir=Path(BASE_DIR) / "_cache" / "sysroot"
+        )
+        included = [package for package in packages if not package.excluded]
+        excluded = [package for package in packages if package.excluded]
+        print(f"# {target}")
+        print(
+            f"{len(included)} packages, {sum(p.size for p in included):,} bytes to download, "
+            f"{sum(p.installed_size for p in included):,} bytes installed"
+        )
+        if excluded:
+            print(
+                f"{len(excluded)} packages excluded, {sum(p.size for p in excluded):,} bytes "
+                "not downloaded (excluding their dependencies)"
+            )
+        print(f"{'download':>14} {'installed':>14}  package")
+        for package in packages:
+            mark = " (excluded)" if package.excluded else ""
+            print(
+                f"{package.size:>14,} {package.installed_size:>14,}  "
+                f"{package.name}={package.version}{mark} <- {', '.join(package.roots)}"
+            )
+        print(f"{'closure':>14} {'exclusive':>14}  root")
+        totals = []
+        for root in {root for package in included for root in package.roots}:
+            closure = sum(package.size for package in included if root in package.roots)
+            exclusive = sum(package.size for package in included if package.roots == (root,))
+            totals.append((closure, exclusive, root))
+        for closure, exclusive, root in sorted(totals, key=lambda total: (-total[0], total[2])):
+            print(f"{closure:>14,} {exclusive:>14,}  {root}")
+        print()
+
+
+def init_sysroots(targets: list[str], jobs: int | None, **options) -> None:
+    # 複数のターゲットの sysroot を並列に生成する。
+    # tar の展開は CPU を使うのでターゲットごとにプロセスを分ける。
+    # deb と APT インデックスのキャッシュはファイルロックと atomic な置き換えで共有される
+    jobs = jobs if jobs is not None else len(targets)
+    results: dict[str, tuple[str, float]] = {}
+    log_paths: dict[str, str] = {}
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for target in targets:
+            source_dir = os.path.join(BASE_DIR, "_source", target)
+            mkdir_p(source_dir)
+            log_paths[target] = os.path.join(source_dir, "sysroot.log")
+            future = executor.submit(
+                _init_sysroot_worker,
+                target,
+                os.path.join(source_dir, "rootfs"),
+                log_paths[target],
+                options,
+            )
+            futures[future] = target
+        logger.info(f"Building {len(targets)} sysroots with {jobs} jobs")
+        for count, future in enumerate(as_completed(futures), start=1):
+            target = futures[future]
+            try:
+                built, elapsed = future.result()
+                status = "built" if built else "up-to-date"
+            except SysrootWorkerError as e:
+                elapsed = e.elapsed
+                status = "failed"
+                logger.error(f"[{count}/{len(targets)}] {target}: {e}")
+            except BrokenProcessPool as e:
+                # メモリ不足やシグナルでプロセスが落ちると、そのターゲットの所要時間は分からないので、
+                # 開始から失敗に気づくまでの時間を出す。他の実行中や未実行のターゲットも失敗になる
+                elapsed = time.monotonic() - start
+                status = "failed"
+                logger.error(f"[{count}/{len(targets)}] {target}: {e}")
+            results[target] = (status, elapsed)
+            progress = f"[{count}/{len(targets)}] {target}: {status} ({elapsed:.1f}s)"
+            logger.info(f"{progress} log={log_paths[target]}")
+
+    logger.info("Sysroot summary:")
+    for target in targets:
+        status, elapsed = results[target]
+        logger.info(f"  {target:<24} {status:<10} {elapsed:>7.1f}s")
+    failed = [target for target in targets if results[target][0] == "failed"]
+    if failed:
+        raise SysrootBuildError(f"Failed to build sysroots: {', '.join(failed)}")
 
 
 COMMON_GN_ARGS = [
@@ -742,7 +1941,7 @@ def build_webrtc_ios(
         [device, arch] = device_arch.split(":")
         work_dir = os.path.join(webrtc_build_dir, device, arch)
         if gen_force:
-            rm_rf(work_dir)
+            rm_rf_deferred(work_dir)
 
         with cd(os.path.join(webrtc_src_dir, "tools_webrtc", "ios")):
             ios_deployment_target = cmdcap(
@@ -876,7 +2075,7 @@ def build_webrtc_android(
     for arch in ANDROID_ARCHS:
         work_dir = os.path.join(webrtc_build_dir, arch)
         if gen_force:
-            rm_rf(work_dir)
+            rm_rf_deferred(work_dir)
         if not os.path.exists(os.path.join(work_dir, "args.gn")) or gen:
             gn_args = [
                 f"is_debug={'true' if debug else 'false'}",
@@ -987,7 +2186,7 @@ def build_webrtc(
 
     # ビルド
     if gen_force:
-        rm_rf(webrtc_build_dir)
+        rm_rf_deferred(webrtc_build_dir)
     if not os.path.exists(os.path.join(webrtc_build_dir, "args.gn")) or gen:
         gn_args = [
             f"is_debug={'true' if debug else 'false'}",
@@ -1036,8 +2235,12 @@ def build_webrtc(
                 "rtc_use_pipewire=false",
             ]
         elif target in ("ubuntu-22.04_x86_64", "ubuntu-24.04_x86_64", "ubuntu-26.04_x86_64"):
+            # ホストの Ubuntu のバージョンに依存しないよう、対象バージョンの sysroot を使う
+            sysroot = os.path.join(source_dir, "rootfs")
             gn_args += [
                 'target_os="linux"',
+                'target_cpu="x64"',
+                f'target_sysroot="{sysroot}"',
                 "rtc_use_pipewire=false",
             ]
         else:
@@ -1381,8 +2584,13 @@ def check_target(target):
         if arch not in ("AMD64", "x86_64"):
             return False
 
-        # クロスコンパイルなので Ubuntu だったら任意のバージョンでビルド可能（なはず）
-        if target in (
+        # クロスコンパイルか、対象バージョンの sysroot を使うビルドなので、
+        # Ubuntu だったら任意のバージョンでビルド可能（なはず）
+        logger.info(f"OS Version: {release['VERSION_ID']}")
+        return target in (
+            "ubuntu-22.04_x86_64",
+            "ubuntu-24.04_x86_64",
+            "ubuntu-26.04_x86_64",
             "ubuntu-20.04_armv8",
             "ubuntu-22.04_armv8",
             "ubuntu-24.04_armv8",
@@ -1390,39 +2598,29 @@ def check_target(target):
             "raspberry-pi-os_armv8",
             "android",
             "android_sdk",
-        ):
-            return True
-
-        # x86_64 用ビルドはバージョンが合っている必要がある
-        osver = release["VERSION_ID"]
-        logging.info(f"OS Version: {osver}")
-        if target == "ubuntu-22.04_x86_64" and osver == "22.04":
-            return True
-        if target == "ubuntu-24.04_x86_64" and osver == "24.04":
-            return True
-        if target == "ubuntu-26.04_x86_64" and osver == "26.04":
-            return True
-
-        return False
+        )
     else:
         return False
 
 
-def get_webrtc_branch_info(branch: str) -> Tuple[str, str]:
+def get_webrtc_branch_info(branch: str, client: HttpClient | None = None) -> tuple[str, str]:
     # 指定されたブランチのコミットハッシュとコミットポジションを取得する
-    src_commits = downloadcap(
-        f"https://webrtc.googlesource.com/src.git/+log/refs/branch-heads/{branch}"
+    if client is None:
+        client = HttpClient()
+    # Gitiles の JSON はコミットメッセージも含むので、1 回のリクエストで済む
+    text = client.get(
+        f"https://webrtc.googlesource.com/src.git/+log/refs/branch-heads/{branch}?format=JSON&n=1"
     )
-    r = re.search(r'\<a href="(.*?)"\>', src_commits)
-    if r is None:
+    # 先頭に XSSI 対策の )]}' という行が付いているので取り除く
+    log = json.loads(text[text.index("\n") + 1 :])["log"]
+    if len(log) == 0:
         raise Exception("Could not find commit hash")
-    url = r.group(1)
-    commit = url.split("/")[-1]
-    src_commit = downloadcap(f"https://webrtc.googlesource.com{url}")
+    commit = log[0]["commit"]
+    message = log[0]["message"]
     r = re.search(
-        r"^Cr-Commit-Position: refs/branch-heads/([0-9]+)@\{#([0-9]+)\}", src_commit, re.MULTILINE
+        r"^Cr-Commit-Position: refs/branch-heads/([0-9]+)@\{#([0-9]+)\}", message, re.MULTILINE
     )
-    r2 = re.search(r"^Cr-Commit-Position: refs/heads/main@{#[0-9]+}", src_commit, re.MULTILINE)
+    r2 = re.search(r"^Cr-Commit-Position: refs/heads/main@{#[0-9]+}", message, re.MULTILINE)
     if r is None and r2 is None:
         raise Exception("Could not find commit position")
     if r is not None:
@@ -1435,17 +2633,43 @@ def get_webrtc_branch_info(branch: str) -> Tuple[str, str]:
     return commit, position
 
 
+# version_list や version_update のレスポンスを保存するディレクトリと、再利用する期間 (秒)
+HTTP_CACHE_DIR = os.path.join("_cache", "http")
+HTTP_CACHE_TTL = 300
+
+
+def create_version_http_client(args) -> HttpClient:
+    cache_dir = args.http_cache_dir
+    if cache_dir is None:
+        cache_dir = os.path.join(BASE_DIR, HTTP_CACHE_DIR)
+    return HttpClient(cache_dir=cache_dir, ttl=args.http_cache_ttl, offline=args.offline)
+
+
+def get_milestones(client: HttpClient) -> list[dict]:
+    return json.loads(client.get("https://chromiumdash.appspot.com/fetch_milestones"))
+
+
 def version_list(args):
-    milestones = json.loads(downloadcap("https://chromiumdash.appspot.com/fetch_milestones"))
-    for m in milestones[:5]:
-        milestone = m["milestone"]
-        branch = m["webrtc_branch"]
-        commit, position = get_webrtc_branch_info(branch)
-        print(f"m{milestone} {branch} {position} {commit}")
+    with create_version_http_client(args) as client:
+        milestones = get_milestones(client)[:5]
+        # 各ブランチの情報は独立しているので並行に取得する
+        with ThreadPoolExecutor(max_workers=len(milestones) or 1) as executor:
+            infos = list(
+                executor.map(
+                    lambda m: get_webrtc_branch_info(m["webrtc_branch"], client), milestones
+                )
+            )
+    for m, (commit, position) in zip(milestones, infos):
+        print(f"m{m['milestone']} {m['webrtc_branch']} {position} {commit}")
 
 
 def version_update(args):
-    milestones = json.loads(downloadcap("https://chromiumdash.appspot.com/fetch_milestones"))
+    with create_version_http_client(args) as client:
+        milestones = get_milestones(client)
+        update_version_file(client, milestones, args.target)
+
+
+def update_version_file(client: HttpClient, milestones: list[dict], target: str):
     # milestones は以下のようなデータになっている
     # [
     #   {
@@ -1478,11 +2702,11 @@ def version_update(args):
     for m in milestones:
         milestone = m["milestone"]
         branch = m["webrtc_branch"]
-        if args.target == f"m{milestone}":
+        if target == f"m{milestone}":
             version_file = read_version_file(version_path)
             rmilestone, rbranch, rposition, rbuild = version_file["WEBRTC_BUILD_VERSION"].split(".")
 
-            commit, position = get_webrtc_branch_info(branch)
+            commit, position = get_webrtc_branch_info(branch, client)
 
             # 同じバージョンなら元のビルド番号を利用する
             if rmilestone == str(milestone) and rbranch == branch and rposition == position:
@@ -1497,7 +2721,7 @@ def version_update(args):
                 f.write(f"WEBRTC_COMMIT={commit}\n")
             return
     else:
-        raise Exception(f"Could not find milestone {args.target}")
+        raise ValueError(f"Could not find milestone {target}")
 
 
 def main():
@@ -1523,6 +2747,9 @@ def main():
     bp.add_argument("--source-dir")
     bp.add_argument("--build-dir")
     bp.add_argument("--rootfs-fetch-force", action="store_true")
+    bp.add_argument("--rootfs-incremental", action="store_true")
+    bp.add_argument("--rootfs-artifact-source")
+    bp.add_argument("--rootfs-artifact-dir")
     bp.add_argument("--depottools-fetch", action="store_true")
     bp.add_argument("--webrtc-gen", action="store_true")
     bp.add_argument("--webrtc-gen-force", action="store_true")
@@ -1531,12 +2758,38 @@ def main():
     bp.add_argument("--webrtc-build-dir")
     bp.add_argument("--webrtc-source-dir")
     bp.add_argument("--no-history", action="store_true")
+    # 複数のターゲットで共有する git のキャッシュ (gclient の cache_dir)
+    bp.add_argument("--git-cache-dir")
+    # パッチを当てた WebRTC のソースのスナップショットを保存・復元するディレクトリ
+    bp.add_argument("--webrtc-snapshot-dir")
     # WebRTC の取得やビルドを行わず、クロスコンパイル用 sysroot だけを生成する
     sp_sysroot = sp.add_parser("sysroot")
     sp_sysroot.set_defaults(op="sysroot")
-    sp_sysroot.add_argument("target", choices=SYSROOT_CONFIGS)
+    # 複数のターゲットか all を指定すると並列に生成する
+    sp_sysroot.add_argument("target", nargs="+", choices=[*SYSROOT_CONFIGS, "all"])
     sp_sysroot.add_argument("--source-dir")
+    # 複数のターゲットを生成するときの同時実行数。省略時はターゲット数
+    sp_sysroot.add_argument("--jobs", type=int)
     sp_sysroot.add_argument("--force", action="store_true")
+    # 生成せずに、既存の sysroot が生成時から変更されていないかを確認する
+    sp_sysroot.add_argument("--verify", action="store_true")
+    # 生成せずに、依存解決の結果に含まれる deb のサイズと引き込んだパッケージを表示する
+    sp_sysroot.add_argument("--explain", action="store_true")
+    # 設定変更時に既存の sysroot を作り直さず、deb の差分だけを反映する
+    sp_sysroot.add_argument("--incremental", action="store_true")
+    sp_sysroot.add_argument("--cache-dir")
+    # deb をキャッシュに保存しない。lockfile を使う場合は deb をディスクに書かずに展開する
+    sp_sysroot.add_argument("--no-cache", action="store_true")
+    # 生成済み sysroot のアーティファクトを取得するディレクトリか HTTP サーバーの URL
+    sp_sysroot.add_argument("--artifact-source")
+    # 完成した sysroot をアーティファクトとして書き出すディレクトリ
+    sp_sysroot.add_argument("--artifact-dir")
+    # 生成にかかった時間や量をターゲットごとの JSON として書き出すディレクトリ
+    sp_sysroot.add_argument("--metrics-dir")
+    # sysroot の依存解決の結果を lockfile に固定する
+    sp_sysroot_lock = sp.add_parser("sysroot_lock")
+    sp_sysroot_lock.set_defaults(op="sysroot_lock")
+    sp_sysroot_lock.add_argument("target", choices=SYSROOT_CONFIGS)
     # VERSION で指定されたバージョンのソースを取得する
     fp = sp.add_parser("fetch")
     fp.set_defaults(op="fetch")
@@ -1546,6 +2799,7 @@ def main():
     fp.add_argument("--build-dir")
     fp.add_argument("--webrtc-source-dir")
     fp.add_argument("--webrtc-build-dir")
+    fp.add_argument("--git-cache-dir")
     # ソースコードの状態を現在のバージョンに戻す
     rp = sp.add_parser("revert")
     rp.set_defaults(op="revert")
@@ -1566,6 +2820,15 @@ def main():
     dp.add_argument("--build-dir")
     dp.add_argument("--webrtc-source-dir")
     dp.add_argument("--webrtc-build-dir")
+    # 全パッチがパッチを当てる前のソースに当たるかを、作業ツリーに触らずに確認する
+    cp = sp.add_parser("check_patches", aliases=["check-patches"])
+    cp.set_defaults(op="check_patches")
+    cp.add_argument("target", choices=TARGETS)
+    cp.add_argument("--debug", action="store_true")
+    cp.add_argument("--source-dir")
+    cp.add_argument("--build-dir")
+    cp.add_argument("--webrtc-source-dir")
+    cp.add_argument("--webrtc-build-dir")
     # 現在 build と package を分ける意味は無いのだけど、
     # 今後複数のビルドを纏めてパッケージングする時に備えて別コマンドにしておく
     pp = sp.add_parser("package")
@@ -1585,6 +2848,12 @@ def main():
     vup.add_argument("target")
     vlp = sp.add_parser("version_list")
     vlp.set_defaults(op="version_list")
+    for vp in (vup, vlp):
+        # レスポンスは --http-cache-dir に保存し、--http-cache-ttl 秒以内なら再利用する。
+        # --offline は保存済みのレスポンスだけを使い、ネットワークに接続しない
+        vp.add_argument("--http-cache-dir")
+        vp.add_argument("--http-cache-ttl", type=float, default=HTTP_CACHE_TTL)
+        vp.add_argument("--offline", action="store_true")
 
     args = parser.parse_args()
 
@@ -1599,12 +2868,46 @@ def main():
         version_update(args)
         return
 
+    if args.op == "sysroot_lock":
+        init_sysroot_lock(args.target)
+        return
+
     if args.op == "sysroot":
-        source_dir = os.path.join(BASE_DIR, "_source", args.target)
+        targets = (
+            list(SYSROOT_CONFIGS) if "all" in args.target else list(dict.fromkeys(args.target))
+        )
+        cache_dir = os.path.abspath(args.cache_dir) if args.cache_dir is not None else None
+        artifact_dir = os.path.abspath(args.artifact_dir) if args.artifact_dir is not None else None
+        options = {
+            "force": args.force,
+            "cache_dir": cache_dir,
+            "incremental": args.incremental,
+            "artifact_source": resolve_artifact_source(args.artifact_source),
+            "artifact_dir": artifact_dir,
+            "use_cache": not args.no_cache,
+            "metrics_dir": (
+                os.path.abspath(args.metrics_dir) if args.metrics_dir is not None else None
+            ),
+        }
+        if len(targets) > 1 and args.source_dir is not None:
+            parser.error("--source-dir cannot be used with multiple sysroot targets")
+        if args.explain:
+            explain_sysroots(targets)
+            return
+        if args.verify:
+            source_dir = os.path.abspath(args.source_dir) if args.source_dir is not None else None
+            verify_sysroots(targets, source_dir)
+            return
+        if len(targets) > 1:
+            if args.jobs is not None and args.jobs < 1:
+                parser.error("--jobs must be at least 1")
+            init_sysroots(targets, args.jobs, **options)
+            return
+        source_dir = os.path.join(BASE_DIR, "_source", targets[0])
         if args.source_dir is not None:
             source_dir = os.path.abspath(args.source_dir)
         mkdir_p(source_dir)
-        init_sysroot(args.target, os.path.join(source_dir, "rootfs"), args.force)
+        init_sysroot(targets[0], os.path.join(source_dir, "rootfs"), **options)
         return
 
     if not check_target(args.target):
@@ -1628,6 +2931,12 @@ def main():
     webrtc_build_dir = (
         os.path.abspath(args.webrtc_build_dir) if args.webrtc_build_dir is not None else None
     )
+    git_cache_dir = None
+    if args.op in ("build", "fetch") and args.git_cache_dir is not None:
+        git_cache_dir = os.path.abspath(args.git_cache_dir)
+    webrtc_snapshot_dir = None
+    if args.op == "build" and args.webrtc_snapshot_dir is not None:
+        webrtc_snapshot_dir = os.path.abspath(args.webrtc_snapshot_dir)
 
     if args.op == "package":
         if args.package_dir is not None:
@@ -1679,11 +2988,25 @@ def main():
     if args.op == "build":
         mkdir_p(source_dir)
         mkdir_p(build_dir)
+        # BASE_DIR へ移動する前に、カレントディレクトリ基準で解決しておく
+        rootfs_artifact_source = resolve_artifact_source(args.rootfs_artifact_source)
+        rootfs_artifact_dir = (
+            os.path.abspath(args.rootfs_artifact_dir)
+            if args.rootfs_artifact_dir is not None
+            else None
+        )
 
         with cd(BASE_DIR):
             if args.target in SYSROOT_CONFIGS:
                 sysroot = os.path.join(source_dir, "rootfs")
-                init_sysroot(args.target, sysroot, args.rootfs_fetch_force)
+                init_sysroot(
+                    args.target,
+                    sysroot,
+                    args.rootfs_fetch_force,
+                    incremental=args.rootfs_incremental,
+                    artifact_source=rootfs_artifact_source,
+                    artifact_dir=rootfs_artifact_dir,
+                )
 
             dir = get_depot_tools(source_dir, fetch=args.depottools_fetch)
             add_path(dir, is_after=True)
@@ -1698,6 +3021,8 @@ def main():
                 args.target,
                 webrtc_source_dir=webrtc_source_dir,
                 no_history=args.no_history,
+                git_cache_dir=git_cache_dir,
+                snapshot_dir=webrtc_snapshot_dir,
             )
 
             # ビルド
@@ -1755,6 +3080,7 @@ def main():
                 version=version_info.webrtc_commit,
                 target=args.target,
                 webrtc_source_dir=webrtc_source_dir,
+                git_cache_dir=git_cache_dir,
             )
 
     if args.op == "revert":
@@ -1783,6 +3109,20 @@ def main():
                 webrtc_source_dir=webrtc_source_dir,
             )
 
+    if args.op == "check_patches":
+        with cd(BASE_DIR):
+            dir = get_depot_tools(source_dir, fetch=False)
+            add_path(dir, is_after=True)
+            ok = check_patches(
+                source_dir=source_dir,
+                patch_dir=patch_dir,
+                target=args.target,
+                webrtc_source_dir=webrtc_source_dir,
+                version=version_info.webrtc_commit,
+            )
+        if not ok:
+            parser.exit(1, "Some patches do not apply\n")
+
     if args.op == "package":
         mkdir_p(package_dir)
         with cd(BASE_DIR):
@@ -1,7 +1,7 @@
 """クロスコンパイル用 sysroot を APT リポジトリから直接生成するモジュール。
 
-multistrap や debootstrap に依存せず、apt-get の --download-only と
-dpkg-deb --extract だけで sysroot を組み立てる。この構成には次の制約がある。
+multistrap や debootstrap に依存せず、apt-get による依存解決とダウンロード、
+および Python で実装した deb の展開だけで sysroot を組み立てる。この構成には次の制約がある。
 
 - root 権限を要求しない（chroot もパッケージの maintainer script も実行しない）
 - ホストの APT 状態（/var/lib/apt など）を一切読み書きしない
@@ -9,34 +9,68 @@ dpkg-deb --extract だけで sysroot を組み立てる。この構成には次
 
 maintainer script を実行しないため、通常はスクリプトが行う後処理
 （usrmerge のシンボリックリンク作成など）は _postprocess_sysroot で自前で補う。
+
+deb の展開は並列に行うが、同じパスを複数の deb が含む場合も
+ファイル名順に逐次展開したときと同じ結果になるよう統合する。
 """
 
 from __future__ import annotations
 
+import fnmatch
 import hashlib
+import http.client
+import io
 import json
 import logging
 import os
 import re
 import shlex
 import shutil
+import stat
 import subprocess
+import sys
+import tarfile
 import tempfile
-from dataclasses import dataclass
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import cast
-from urllib.parse import urlparse
+from typing import TYPE_CHECKING, BinaryIO, cast
+from urllib.parse import unquote, urljoin, urlparse
+
+if TYPE_CHECKING:
+    # typing.Self は Python 3.11 からなので、型検査のときだけ読み込む。
+    from typing import Self
 
 __all__ = [
+    "LockedPackage",
+    "PruneConfig",
     "RepositoryConfig",
     "SysrootConfig",
     "SysrootBuildError",
     "SysrootConfigError",
+    "PackageExplanation",
     "build_sysroot",
+    "empty_trash",
+    "explain_sysroot",
+    "export_sysroot_artifact",
     "load_sysroot_config",
+    "load_sysroot_lock",
+    "lock_sysroot",
+    "move_to_trash",
+    "sysroot_artifact_name",
     "sysroot_config_fingerprint",
+    "sysroot_lock_path",
+    "verify_sysroot",
 ]
 
+logger = logging.getLogger(__name__)
+
 
 # sysroot 直下に置く生成記録ファイル。設定のフィンガープリントを保存し、
 # 次回のビルドで同一設定なら再生成をスキップする判定に使う。
@@ -44,13 +78,63 @@ MANIFEST_NAME = ".webrtc-build-sysroot.json"
 
 # sysroot の生成形式（後処理の内容など）を変えたらインクリメントする。
 # 古い形式の sysroot は fingerprint が一致しても再利用しない。
-MANIFEST_VERSION = 1
+# 2: manifest にファイル一覧 (files, symlinks) を記録するようにした。
+MANIFEST_VERSION = 2
+
+# 入れ替えで不要になった sysroot を削除するまで置いておくディレクトリ。
+# rename で移せるよう、出力先と同じ親ディレクトリに作る。
+TRASH_DIR_NAME = ".trash"
+
+# lockfile の形式を変えたらインクリメントする。
+LOCK_VERSION = 1
 
 # 設定値のうち APT の設定ファイルやコマンドラインへ埋め込むものに許可する文字。
 # sources.list の [] オプションや空白による区切りを壊す文字を弾き、
 # 設定ファイル経由のインジェクションを構文レベルで防ぐ。
 CONFIG_TOKEN_PATTERN = re.compile(r"^[A-Za-z0-9._+:/-]+$")
 
+# 共有する APT インデックスを、前回の更新からこの秒数が経つまでは再検証せずに使う。
+DEFAULT_APT_LISTS_MAX_AGE = 5 * 60
+
+# deb キャッシュの既定の上限サイズ。超えた分は最終利用日時の古いものから削除する。
+DEFAULT_CACHE_MAX_BYTES = 10 * 1024 * 1024 * 1024
+
+# apt-get --print-uris の出力 1 行分。'URL' ファイル名 サイズ ハッシュ の形式になっている。
+# apt が出力するのは MD5Sum だけで、Packages インデックスに MD5Sum がなければハッシュは空になる。
+PRINT_URIS_PATTERN = re.compile(
+    r"^'(?P<url>[^']+)' (?P<filename>\S+) (?P<size>\d+)(?: (?P<hash>\S+))?$"
+)
+
+# キャッシュのキーとして信頼できるハッシュ。MD5Sum や SHA1 は受け付けない。
+HASH_ALGORITHMS = {"SHA256": "sha256", "SHA512": "sha512"}
+
+# prune で include を省略したときに残すパス。WebRTC のクロスビルドが参照する
+# ヘッダー、ライブラリ、pkg-config の定義、crt オブジェクトと、
+# usrmerge によるトップレベルのリンクだけを残す。
+DEFAULT_PRUNE_INCLUDE = (
+    "bin",
+    "sbin",
+    "lib",
+    "lib64",
+    "usr/include/*",
+    "lib/*.so",
+    "lib/*.so.*",
+    "lib/*.a",
+    "lib/*.o",
+    "usr/lib/*.so",
+    "usr/lib/*.so.*",
+    "usr/lib/*.a",
+    "usr/lib/*.o",
+    # glib-2.0/include/glibconfig.h のように、アーキテクチャ依存のヘッダーは
+    # usr/lib/<triplet>/<package>/include 以下に置かれる。
+    "usr/lib/*/include/*",
+    "usr/lib/*/pkgconfig/*",
+    "usr/lib/pkgconfig/*",
+    "usr/share/pkgconfig/*",
+    # crtbegin.o や libgcc.a、コンパイラ組み込みのヘッダー
+    "usr/lib/gcc/*",
+)
+
 
 class SysrootConfigError(ValueError):
     """設定ファイル (sysroot/*.json) の内容が不正なときに送出するエラー。"""
@@ -75,6 +159,82 @@ class RepositoryConfig:
     signed_by: Path
 
 
+@dataclass(frozen=True)
+class PruneConfig:
+    """sysroot へ展開するファイルを絞り込む設定。
+
+    パターンは sysroot からの相対パスに fnmatch で照合し、"*" は "/" も含めて一致する。
+    include のいずれかに一致し、exclude のどれにも一致しないファイルと symlink だけを展開する。
+    ディレクトリは中に残すものがある場合だけ作る。
+    """
+
+    include: tuple[str, ...] = DEFAULT_PRUNE_INCLUDE
+    exclude: tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class LockedPackage:
+    """lockfile で固定した deb 1 つ分の情報。"""
+
+    url: str
+    filename: str
+    version: str
+    size: int
+    sha256: str
+
+
+@dataclass(frozen=True)
+class _DebPackage:
+    """依存解決の結果得られた deb 1 つ分の情報。apt-get --print-uris の 1 行に対応する。"""
+
+    url: str
+    filename: str
+    size: int
+    # "SHA256:<hex>" の形式。Packages インデックスに記載されたハッシュ。
+    hash: str
+
+    @property
+    def name(self) -> str:
+        # apt はファイル名を "<name>_<version>_<arch>.deb" で保存し、
+        # バージョン中の ":" を "%3a" にエスケープする。
+        return self.filename.split("_")[0]
+
+    @property
+    def version(self) -> str:
+        return unquote(self.filename.split("_")[1])
+
+
+@dataclass(frozen=True)
+class _IndexEntry:
+    """deb の展開時に記録する 1 パス分の情報。後続の処理がファイルシステムを走査せずに使う。"""
+
+    # sysroot からの相対パス。先頭の "./" や "/" は含まない。
+    path: str
+    # "dir"、"file"、"symlink" のいずれか。deb 内のハードリンクは "file" として扱う。
+    kind: str
+    size: int
+    # symlink のリンク先。symlink 以外は None。
+    link: str | None = None
+    # 通常ファイルの内容の SHA256。展開しながら計算し、manifest のファイル一覧に使う。
+    sha256: str | None = None
+
+
+@dataclass(frozen=True)
+class PackageExplanation:
+    """explain_sysroot が返す、依存解決の結果に含まれる deb 1 つ分の内訳。"""
+
+    name: str
+    version: str
+    # deb のサイズ (バイト)
+    size: int
+    # 展開後のサイズ (バイト)。Packages インデックスの Installed-Size から求める。
+    installed_size: int
+    # このパッケージを依存関係で引き込んだ packages の要素
+    roots: tuple[str, ...]
+    # exclude_packages によって取り除かれた場合は True
+    excluded: bool = False
+
+
 @dataclass(frozen=True)
 class SysrootConfig:
     """sysroot 1 つ分の設定。sysroot/*.json を検証済みの形で保持する。"""
@@ -86,6 +246,13 @@ class SysrootConfig:
     triplet: str
     packages: tuple[str, ...]
     repositories: tuple[RepositoryConfig, ...]
+    # 省略時は deb の中身をすべて展開する。
+    prune: PruneConfig | None = None
+    # インストール済みとして扱い、ダウンロードも展開もしないパッケージ。
+    # これらのパッケージの依存関係もたどらないため、依存の閉包ごと取り除ける。
+    exclude_packages: tuple[str, ...] = ()
+    # lockfile を読み込んだ場合に設定される。apt による依存解決の代わりにこの一覧を使う。
+    lock: tuple[LockedPackage, ...] | None = None
 
 
 # 以下の _require_* は JSON から読んだ値の検証ヘルパー。
@@ -162,6 +329,17 @@ def _load_repository(value: object, config_dir: Path, index: int) -> RepositoryC
     )
 
 
+def _load_prune(value: object) -> PruneConfig:
+    raw = _require_object(value, "prune")
+    include = DEFAULT_PRUNE_INCLUDE
+    if "include" in raw:
+        include = _require_string_array(raw["include"], "prune.include")
+    exclude: tuple[str, ...] = ()
+    if "exclude" in raw:
+        exclude = _require_string_array(raw["exclude"], "prune.exclude")
+    return PruneConfig(include=include, exclude=exclude)
+
+
 def load_sysroot_config(path: Path) -> SysrootConfig:
     """sysroot 設定 JSON を読み込み、検証済みの SysrootConfig を返す。"""
     try:
@@ -185,6 +363,18 @@ def load_sysroot_config(path: Path) -> SysrootConfig:
         _load_repository(repository, path.parent, index)
         for index, repository in enumerate(repositories_value)
     )
+    prune = _load_prune(raw["prune"]) if "prune" in raw else None
+    exclude_packages: tuple[str, ...] = ()
+    if "exclude_packages" in raw:
+        exclude_packages = tuple(
+            _require_token(package, "exclude_packages[]")
+            for package in _require_string_array(raw["exclude_packages"], "exclude_packages")
+        )
+    overlap = sorted(set(packages) & set(exclude_packages))
+    if overlap:
+        raise SysrootConfigError(
+            f"exclude_packages must not contain packages: {', '.join(overlap)}"
+        )
 
     return SysrootConfig(
         name=name,
@@ -192,9 +382,68 @@ def load_sysroot_config(path: Path) -> SysrootConfig:
         triplet=triplet,
         packages=packages,
         repositories=repositories,
+        prune=prune,
+        exclude_packages=exclude_packages,
+    )
+
+
+def sysroot_lock_path(config_path: Path) -> Path:
+    """設定ファイルに対応する lockfile のパスを返す。設定ファイルと同じディレクトリに置く。"""
+    return config_path.with_name(f"{config_path.stem}.lock.json")
+
+
+def _load_locked_package(value: object, index: int) -> LockedPackage:
+    label = f"packages[{index}]"
+    raw = _require_object(value, label)
+    url = _require_string(raw.get("url"), f"{label}.url")
+    if urlparse(url).scheme != "https":
+        raise SysrootConfigError(f"{label}.url must be an HTTPS URL: {url}")
+    filename = _require_string(raw.get("filename"), f"{label}.filename")
+    if "/" in filename or not filename.endswith(".deb"):
+        raise SysrootConfigError(f"{label}.filename must be a deb file name: {filename}")
+    size = raw.get("size")
+    if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        raise SysrootConfigError(f"{label}.size must be a non-negative integer")
+    sha256 = _require_string(raw.get("sha256"), f"{label}.sha256")
+    if re.fullmatch(r"[0-9a-f]{64}", sha256) is None:
+        raise SysrootConfigError(f"{label}.sha256 must be a SHA-256 hex digest")
+    return LockedPackage(
+        url=url,
+        filename=filename,
+        version=_require_string(raw.get("version"), f"{label}.version"),
+        size=size,
+        sha256=sha256,
     )
 
 
+def load_sysroot_lock(path: Path, config: SysrootConfig) -> SysrootConfig:
+    """lockfile を読み込み、固定した deb の一覧を設定した SysrootConfig を返す。
+
+    lockfile は作成時の設定の fingerprint を記録しており、設定が変わっていればエラーにする。
+    """
+    try:
+        raw_value: object = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, json.JSONDecodeError) as error:
+        raise SysrootConfigError(f"Failed to read sysroot lockfile: {path}: {error}") from error
+
+    raw = _require_object(raw_value, "lock")
+    if raw.get("format_version") != LOCK_VERSION:
+        raise SysrootConfigError(f"Unsupported sysroot lockfile format: {path}")
+    if raw.get("fingerprint") != sysroot_config_fingerprint(replace(config, lock=None)):
+        raise SysrootConfigError(
+            f"Sysroot lockfile does not match the config: {path}; run sysroot_lock again"
+        )
+    packages_value = raw.get("packages")
+    if not isinstance(packages_value, list) or not packages_value:
+        raise SysrootConfigError("packages must be a non-empty array")
+    lock = tuple(
+        _load_locked_package(package, index) for index, package in enumerate(packages_value)
+    )
+    if len({package.filename for package in lock}) != len(lock):
+        raise SysrootConfigError("packages must not contain duplicate file names")
+    return replace(config, lock=lock)
+
+
 def _file_sha256(path: Path) -> str:
     digest = hashlib.sha256()
     with path.open("rb") as file:
@@ -203,6 +452,32 @@ def _file_sha256(path: Path) -> str:
     return digest.hexdigest()
 
 
+def _prune_payload(config: SysrootConfig) -> dict[str, object] | None:
+    # fingerprint と manifest に記録する prune の内容。
+    if config.prune is None:
+        return None
+    return {"include": list(config.prune.include), "exclude": list(config.prune.exclude)}
+
+
+def _prune_matcher(prune: PruneConfig | None) -> Callable[[str], bool] | None:
+    # パターンごとに fnmatch を呼ばず、1 つの正規表現にまとめて照合する。
+    if prune is None:
+        return None
+    include = re.compile("|".join(fnmatch.translate(pattern) for pattern in prune.include))
+    exclude = (
+        re.compile("|".join(fnmatch.translate(pattern) for pattern in prune.exclude))
+        if prune.exclude
+        else None
+    )
+
+    def keep(path: str) -> bool:
+        if include.match(path) is None:
+            return False
+        return exclude is None or exclude.match(path) is None
+
+    return keep
+
+
 def sysroot_config_fingerprint(config: SysrootConfig) -> str:
     """設定内容から sysroot の同一性を判定するためのハッシュを計算する。
 
@@ -211,7 +486,7 @@ def sysroot_config_fingerprint(config: SysrootConfig) -> str:
     ファイル内容のハッシュで表現し、checkout の場所が違っても
     同一内容なら同じ fingerprint になるようにする。
     """
-    payload = {
+    payload: dict[str, object] = {
         "name": config.name,
         "arch": config.arch,
         "triplet": config.triplet,
@@ -226,6 +501,16 @@ def sysroot_config_fingerprint(config: SysrootConfig) -> str:
             for repository in config.repositories
         ],
     }
+    # 絞り込んだ sysroot と全体を展開した sysroot を取り違えないよう、prune も含める。
+    # prune を使わない設定の fingerprint は従来と変わらない。
+    prune = _prune_payload(config)
+    if prune is not None:
+        payload["prune"] = prune
+    if config.exclude_packages:
+        payload["exclude_packages"] = config.exclude_packages
+    # lockfile を使う場合は、固定した deb の内容が同じときだけ同じ sysroot とみなす。
+    if config.lock is not None:
+        payload["lock"] = [[package.filename, package.sha256] for package in config.lock]
     # キー順序と区切り文字を固定した正規化 JSON をハッシュ対象にする。
     encoded = json.dumps(payload, ensure_ascii=True, separators=(",", ":"), sort_keys=True)
     return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
@@ -239,12 +524,486 @@ def _require_command(name: str) -> str:
 
 
 def _run_command(
-    args: list[str], *, environment: dict[str, str] | None = None, log_command: bool = True
+    args: list[str],
+    *,
+    environment: dict[str, str] | None = None,
+    log_command: bool = True,
+    cwd: Path | None = None,
 ) -> None:
     # log_command=False はパッケージごとの展開のようにログが冗長になる場合に使う。
     if log_command:
-        logging.info("Running command: %s", shlex.join(args))
-    subprocess.run(args, check=True, env=environment)
+        logger.info("Running command: %s", shlex.join(args))
+    subprocess.run(args, check=True, env=environment, cwd=cwd)
+
+
+def _run_command_output(args: list[str], *, environment: dict[str, str] | None = None) -> str:
+    logger.info("Running command: %s", shlex.join(args))
+    return subprocess.run(
+        args, check=True, env=environment, stdout=subprocess.PIPE, encoding="utf-8"
+    ).stdout
+
+
+def _default_jobs() -> int:
+    return os.cpu_count() or 1
+
+
+def _find_owner(owners: dict[str, str], relative_path: str) -> str:
+    # ディレクトリごと rename した場合は配下のパスを個別に記録していないため、
+    # 親ディレクトリを遡って最初に見つかった所有者を返す。
+    path = relative_path
+    while True:
+        owner = owners.get(path)
+        if owner is not None:
+            return owner
+        if "/" not in path:
+            return "<unknown>"
+        path = path.rsplit("/", 1)[0]
+
+
+def _is_directory_in_root(path: Path, root: Path) -> bool:
+    # 絶対パスのリンク (例: foo -> /usr/lib/bar) を辿るとホスト側を指すため、
+    # symlink は sysroot 内のディレクトリへ解決される場合だけディレクトリとして扱う。
+    if not path.is_symlink():
+        return path.is_dir()
+    resolved = path.resolve()
+    return resolved.is_dir() and resolved.is_relative_to(root.resolve())
+
+
+def _remove_path(path: Path) -> None:
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    else:
+        path.unlink()
+
+
+def _merge_extracted_tree(
+    staging_dir: Path, root: Path, deb_name: str, owners: dict[str, str]
+) -> list[tuple[str, str, str]]:
+    """deb 1 つ分の展開結果を staging_dir から root へ rename で統合する。
+
+    root 側に存在しないディレクトリは中身ごと 1 回の rename で移し、
+    既存ディレクトリだけを再帰的に辿る。既に別の deb が配置したパスへ
+    書き込む場合は後から統合した deb を優先し、(パス, 既存の所有者, 新しい所有者)
+    を衝突として返す。
+    """
+    conflicts: list[tuple[str, str, str]] = []
+    pending = [""]
+    while pending:
+        relative_dir = pending.pop()
+        with os.scandir(staging_dir / relative_dir) as entries:
+            for entry in entries:
+                relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                destination = root / relative_path
+                if entry.is_dir(follow_symlinks=False) and _is_directory_in_root(destination, root):
+                    pending.append(relative_path)
+                    continue
+                if destination.is_symlink() or destination.exists():
+                    conflicts.append((relative_path, _find_owner(owners, relative_path), deb_name))
+                    _remove_path(destination)
+                os.rename(entry.path, destination)
+                owners[relative_path] = deb_name
+    return conflicts
+
+
+class _BoundedReader:
+    """ストリームから ar メンバー 1 つ分のバイト数だけを読み出すファイルオブジェクト。"""
+
+    def __init__(self, stream: BinaryIO, size: int) -> None:
+        self._stream = stream
+        self._size = size
+        self._remaining = size
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._stream.read(size)
+        if len(data) != size:
+            raise SysrootBuildError("Unexpected end of deb archive")
+        self._remaining -= size
+        return data
+
+    def skip_rest(self) -> None:
+        # メンバーの読み残しと、2 バイト境界に揃えるための ar のパディングを読み捨てる。
+        # ネットワークからのストリームのように seek できない入力でも使える。
+        padding = self._size % 2
+        while self.read(1024 * 1024):
+            pass
+        if padding and len(self._stream.read(padding)) != padding:
+            raise SysrootBuildError("Unexpected end of deb archive")
+
+
+@contextmanager
+def _open_zstd_stream(stream: BinaryIO) -> Iterator[BinaryIO]:
+    # Ubuntu 21.10 以降の deb は data.tar.zst を使う。Python 3.14 以降の標準ライブラリ、
+    # zstandard モジュール、zstd コマンドの順に、利用できるもので伸長する。
+    try:
+        from compression import zstd  # type: ignore[import-not-found]
+    except ImportError:
+        pass
+    else:
+        with zstd.ZstdFile(stream) as decompressed:
+            yield decompressed
+        return
+    try:
+        import zstandard  # type: ignore[import-not-found]
+    except ImportError:
+        pass
+    else:
+        with zstandard.ZstdDecompressor().stream_reader(
+            stream, read_across_frames=True
+        ) as decompressed:
+            yield decompressed
+        return
+
+    # zstd コマンドへの入力は別スレッドから書き込み、伸長結果の読み出しと並行させる。
+    process = subprocess.Popen(
+        [_require_command("zstd"), "--decompress", "--stdout", "--quiet"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    assert process.stdin is not None and process.stdout is not None
+    stdin = process.stdin
+    feed_error: list[Exception] = []
+
+    def feed() -> None:
+        try:
+            while chunk := stream.read(1024 * 1024):
+                stdin.write(chunk)
+        except (OSError, ValueError, SysrootBuildError) as error:
+            # パイプへの書き込みや、途中で切れた deb の読み出しの失敗は、呼び出し元で送出し直す。
+            feed_error.append(error)
+        finally:
+            stdin.close()
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    try:
+        yield cast(BinaryIO, process.stdout)
+        # tar の終端以降も読み切り、zstd コマンドがパイプへの書き込みで止まらないようにする。
+        while process.stdout.read(1024 * 1024):
+            pass
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+        feeder.join()
+    if feed_error:
+        raise feed_error[0]
+    if returncode != 0:
+        raise SysrootBuildError(f"zstd failed to decompress deb data: exit code {returncode}")
+
+
+@contextmanager
+def _open_zstd_writer(file: BinaryIO) -> Iterator[BinaryIO]:
+    # _open_zstd_stream と同じ順に、利用できるもので file へ zstd 圧縮して書き込む。
+    try:
+        from compression import zstd  # type: ignore[import-not-found]
+    except ImportError:
+        pass
+    else:
+        with zstd.ZstdFile(file, "w") as compressed:
+            yield compressed
+        return
+    try:
+        import zstandard  # type: ignore[import-not-found]
+    except ImportError:
+        pass
+    else:
+        with zstandard.ZstdCompressor().stream_writer(file, closefd=False) as compressed:
+            yield compressed
+        return
+
+    process = subprocess.Popen(
+        [_require_command("zstd"), "--quiet", "--stdout"], stdin=subprocess.PIPE, stdout=file
+    )
+    assert process.stdin is not None
+    try:
+        yield cast(BinaryIO, process.stdin)
+    finally:
+        process.stdin.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise SysrootBuildError(f"zstd failed to compress sysroot: exit code {returncode}")
+
+
+class _HashingReader:
+    """読み出したバイト列のハッシュとサイズを計算しながら、元のストリームをそのまま返す。
+
+    sink を指定すると、読み出したバイト列をそのまま sink にも書き込む。
+    """
+
+    def __init__(self, stream: BinaryIO, algorithm: str, sink: BinaryIO | None = None) -> None:
+        self._stream = stream
+        self._sink = sink
+        self.digest = hashlib.new(algorithm)
+        self.size = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self.digest.update(data)
+        self.size += len(data)
+        if self._sink is not None:
+            self._sink.write(data)
+        return data
+
+
+def _normalize_member_path(name: str) -> str:
+    # tar のメンバー名 ("./usr/lib/..." など) を sysroot からの相対パスへ正規化する。
+    # 展開先の外へ書き込む ".." を含むパスは受け付けない。
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    if ".." in parts:
+        raise SysrootBuildError(f"Unsafe path in deb archive: {name}")
+    return "/".join(parts)
+
+
+def _extract_tar_members(
+    archive: tarfile.TarFile, destination: Path, label: str, keep: Callable[[str], bool] | None
+) -> list[_IndexEntry]:
+    # maintainer script も所有者の変更も行わず、ファイル・ディレクトリ・symlink だけを取り出す。
+    # dpkg-deb --extract を一般ユーザーで実行した場合と同様に、setuid などの特殊ビットは落とす。
+    # keep を指定した場合は一致するファイルと symlink だけを書き出し、
+    # ディレクトリはそれらの親になるものだけを後から作る。
+    entries: dict[str, _IndexEntry] = {}
+    symlinks: set[str] = set()
+    pending_directories: dict[str, int] = {}
+
+    def make_directory(path: str, mode: int) -> None:
+        target = destination / path
+        target.mkdir(parents=True, exist_ok=True)
+        # 後続の deb が中へ書き込めるよう、所有者の書き込み権限は常に残す。
+        target.chmod((mode & 0o777) | 0o700)
+        entries[path] = _IndexEntry(path, "dir", 0)
+
+    def check_parents(path: str, name: str) -> None:
+        # 同じ deb 内の symlink を経由すると展開先の外を読み書きできてしまうため拒否する。
+        parent = path
+        while "/" in parent:
+            parent = parent.rsplit("/", 1)[0]
+            if parent in symlinks:
+                raise SysrootBuildError(f"Path in deb archive traverses a symlink: {name}")
+
+    for member in archive:
+        path = _normalize_member_path(member.name)
+        if not path:
+            continue
+        check_parents(path, member.name)
+        if member.isdir():
+            if keep is None:
+                make_directory(path, member.mode)
+            else:
+                pending_directories[path] = member.mode
+            continue
+        if member.issym():
+            symlinks.add(path)
+        if keep is not None:
+            if not keep(path):
+                continue
+            parent = path
+            while "/" in parent:
+                parent = parent.rsplit("/", 1)[0]
+                mode = pending_directories.pop(parent, None)
+                if mode is not None:
+                    make_directory(parent, mode)
+        target = destination / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if target.is_symlink() or target.exists():
+            _remove_path(target)
+        if member.issym():
+            os.symlink(member.linkname, target)
+            entries[path] = _IndexEntry(path, "symlink", 0, member.linkname)
+        elif member.islnk():
+            # リンク元も、symlink を辿らずに展開済みの通常のファイルを指している必要がある。
+            link_path = _normalize_member_path(member.linkname)
+            check_parents(link_path, member.linkname)
+            linked = entries.get(link_path)
+            if linked is None or linked.kind != "file":
+                if keep is not None and link_path not in symlinks:
+                    # リンク元を絞り込みで展開しなかった場合は中身を用意できない。
+                    logger.debug("Skipping hardlink to pruned file: %s", member.name)
+                    continue
+                raise SysrootBuildError(
+                    f"Hardlink in {label} does not point to an extracted file: "
+                    f"{member.name} -> {member.linkname}"
+                )
+            os.link(destination / link_path, target, follow_symlinks=False)
+            entries[path] = _IndexEntry(path, "file", linked.size, sha256=linked.sha256)
+        elif member.isfile():
+            source = archive.extractfile(member)
+            assert source is not None
+            # 書き出すついでにハッシュを計算し、後で sysroot を読み直さずに済ませる。
+            digest = hashlib.sha256()
+            with target.open("wb") as file:
+                while chunk := source.read(1024 * 1024):
+                    digest.update(chunk)
+                    file.write(chunk)
+            target.chmod(member.mode & 0o777)
+            os.utime(target, (member.mtime, member.mtime))
+            entries[path] = _IndexEntry(path, "file", member.size, sha256=digest.hexdigest())
+        else:
+            # デバイスファイルなどは一般ユーザーでは作れず、sysroot にも不要なので飛ばす。
+            logger.debug("Skipping special file in deb archive: %s", member.name)
+    return sorted(entries.values(), key=lambda entry: entry.path)
+
+
+def _extract_data_tar(
+    name: str,
+    reader: BinaryIO,
+    destination: Path,
+    label: str,
+    keep: Callable[[str], bool] | None,
+) -> list[_IndexEntry]:
+    # 一時ファイルを作らず、圧縮されたままのストリームを tarfile で順に読みながら展開する。
+    if name == "data.tar.zst":
+        with ExitStack() as stack:
+            decompressed = stack.enter_context(_open_zstd_stream(reader))
+            archive = stack.enter_context(tarfile.open(fileobj=decompressed, mode="r|"))
+            return _extract_tar_members(archive, destination, label, keep)
+    modes = {
+        "data.tar": "r|",
+        "data.tar.gz": "r|gz",
+        "data.tar.xz": "r|xz",
+        "data.tar.bz2": "r|bz2",
+    }
+    mode = modes.get(name)
+    if mode is None:
+        raise SysrootBuildError(f"Unsupported deb data member: {name}")
+    with tarfile.open(fileobj=reader, mode=mode) as archive:
+        return _extract_tar_members(archive, destination, label, keep)
+
+
+def _extract_deb_stream(
+    stream: BinaryIO,
+    destination: Path,
+    label: str,
+    keep: Callable[[str], bool] | None = None,
+) -> list[_IndexEntry]:
+    """ar 形式の deb を先頭から順に読み、data.tar.* の中身を destination へ展開する。
+
+    seek しないため、ファイルだけでなくネットワークからのストリームも直接渡せる。
+    keep を指定すると、keep が真を返すパスだけを展開する。展開したパスの一覧を返す。
+    """
+    if stream.read(8) != b"!<arch>\n":
+        raise SysrootBuildError(f"Not a deb archive: {label}")
+    while True:
+        header = stream.read(60)
+        if not header:
+            raise SysrootBuildError(f"No data member in deb archive: {label}")
+        if len(header) != 60 or header[58:60] != b"`\n":
+            raise SysrootBuildError(f"Malformed deb archive: {label}")
+        # GNU ar はメンバー名の末尾に "/" を付けるため取り除く。
+        name = header[0:16].decode("ascii").strip().rstrip("/")
+        size = int(header[48:58].decode("ascii").strip())
+        if name.startswith("data.tar"):
+            reader = _BoundedReader(stream, size)
+            entries = _extract_data_tar(name, cast(BinaryIO, reader), destination, label, keep)
+            # tar の終端ブロック以降の読み残しとパディングを読み捨てる。
+            reader.skip_rest()
+            return entries
+        _BoundedReader(stream, size).skip_rest()
+
+
+def _extract_deb(
+    deb_file: Path, destination: Path, keep: Callable[[str], bool] | None = None
+) -> list[_IndexEntry]:
+    destination.mkdir(parents=True, exist_ok=True)
+    with deb_file.open("rb") as stream:
+        return _extract_deb_stream(stream, destination, deb_file.name, keep)
+
+
+def _entry_paths(entries: Iterable[_IndexEntry]) -> list[str]:
+    # manifest に記録するパス一覧。ディレクトリは末尾に "/" を付けてファイルと区別する。
+    return [f"{entry.path}/" if entry.kind == "dir" else entry.path for entry in entries]
+
+
+def _stage_debs(
+    deb_files: list[Path],
+    staging_root: Path,
+    jobs: int,
+    keep: Callable[[str], bool] | None = None,
+) -> Iterator[tuple[str, Path, list[_IndexEntry]]]:
+    # deb ごとに別の staging ディレクトリへ並列に展開し、
+    # (deb, staging ディレクトリ, 展開したパス) を deb_files の順に返す。
+    # 伸長は zlib や lzma が GIL を解放するため、スレッドでも並列に進む。
+    staging_root.mkdir(exist_ok=True)
+
+    def extract(deb_file: Path) -> tuple[str, Path, list[_IndexEntry]]:
+        staging_dir = staging_root / deb_file.name
+        return deb_file.name, staging_dir, _extract_deb(deb_file, staging_dir, keep)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        # map は投入順に結果を返すため、呼び出し側は常にファイル名順で統合できる。
+        yield from executor.map(extract, deb_files)
+
+
+def _merge_staged_debs(
+    staged: Iterable[tuple[str, Path, list[_IndexEntry]]], root: Path
+) -> dict[str, list[_IndexEntry]]:
+    # staging ディレクトリを受け取った順に root へ統合し、deb ごとのパス一覧を返す。
+    # 統合の順序が逐次展開と同じなので、複数の deb が同じパスを含んでいても、
+    # 並列度に関係なく同じ sysroot になる。
+    owners: dict[str, str] = {}
+    conflicts: list[tuple[str, str, str]] = []
+    contents: dict[str, list[_IndexEntry]] = {}
+    for filename, staging_dir, entries in staged:
+        conflicts.extend(_merge_extracted_tree(staging_dir, root, filename, owners))
+        shutil.rmtree(staging_dir)
+        contents[filename] = entries
+
+    if conflicts:
+        logger.warning(
+            "Found %d paths provided by multiple packages; the later package wins", len(conflicts)
+        )
+        for path, previous_owner, owner in conflicts:
+            logger.debug("Path conflict: %s: %s -> %s", path, previous_owner, owner)
+    return contents
+
+
+def _dirty_packages(kept: dict[str, list[str]], changed_paths: set[str]) -> set[str]:
+    """差分更新で再展開が必要な既存 deb を返す。
+
+    削除・追加される deb と同じパスを含む deb は、統合順によって
+    そのパスの中身が変わり得るため再展開する。再展開する deb のパスも
+    同様に影響するので、増えなくなるまで繰り返す。ディレクトリは対象外とする。
+    """
+    owners: dict[str, list[str]] = {}
+    for name, paths in kept.items():
+        for path in paths:
+            if not path.endswith("/"):
+                owners.setdefault(path, []).append(name)
+    dirty: set[str] = set()
+    pending = list(changed_paths)
+    while pending:
+        for name in owners.get(pending.pop(), ()):
+            if name not in dirty:
+                dirty.add(name)
+                pending.extend(path for path in kept[name] if not path.endswith("/"))
+    return dirty
+
+
+def _remove_package_paths(
+    root: Path, removed_paths: Iterable[str], remaining_directories: set[str]
+) -> None:
+    # 削除する deb のファイルを消し、他の deb が含まないディレクトリは空になれば消す。
+    directories = []
+    for path in removed_paths:
+        if path.endswith("/"):
+            directories.append(path)
+            continue
+        target = root / path
+        if target.is_symlink() or target.exists():
+            _remove_path(target)
+    # 深い階層から順に処理し、子ディレクトリを消した結果空になった親も消せるようにする。
+    for directory in sorted(directories, key=lambda path: path.count("/"), reverse=True):
+        if directory in remaining_directories:
+            continue
+        target = root / directory
+        if target.is_dir() and not target.is_symlink() and not any(target.iterdir()):
+            target.rmdir()
 
 
 def _apt_options(work_dir: Path) -> list[str]:
@@ -286,18 +1045,21 @@ def _write_apt_files(config: SysrootConfig, work_dir: Path) -> None:
     # ホストの /etc/apt を読ませず、対象アーキテクチャだけを見る apt.conf を生成する。
     # APT::Architecture を設定ファイル側で固定することで、
     # x86_64 ホスト上でも arm64 などのパッケージを解決できる。
-    apt_config = "\n".join(
-        [
-            'Dir::Etc::main "/dev/null";',
-            'Dir::Etc::parts "/dev/null";',
-            f'APT::Architecture "{config.arch}";',
-            f'APT::Architectures {{ "{config.arch}"; }};',
-            'Acquire::Languages "none";',
-            'APT::Install-Recommends "false";',
-            'APT::Install-Suggests "false";',
-            "",
-        ]
-    )
+    apt_config_lines = [
+        'Dir::Etc::main "/dev/null";',
+        'Dir::Etc::parts "/dev/null";',
+        f'APT::Architecture "{config.arch}";',
+        f'APT::Architectures {{ "{config.arch}"; }};',
+        'Acquire::Languages "none";',
+        'APT::Install-Recommends "false";',
+        'APT::Install-Suggests "false";',
+    ]
+    # deb を直接取得する Python 側の HTTPS 接続は SSL_CERT_FILE の CA 証明書を使うため、
+    # apt にも同じ証明書を使わせ、社内ミラーやローカルのリポジトリでも両者の挙動を揃える。
+    ca_file = os.environ.get("SSL_CERT_FILE")
+    if ca_file:
+        apt_config_lines.append(f'Acquire::https::CaInfo "{ca_file}";')
+    apt_config = "\n".join([*apt_config_lines, ""])
     (work_dir / "apt.conf").write_text(apt_config, encoding="utf-8")
 
     source_lines = []
@@ -311,8 +1073,622 @@ def _write_apt_files(config: SysrootConfig, work_dir: Path) -> None:
     (work_dir / "sources.list").write_text("\n".join(source_lines) + "\n", encoding="utf-8")
 
 
+def _repository_lists_key(config: SysrootConfig, repository: RepositoryConfig) -> str:
+    # APT インデックスはリポジトリとアーキテクチャの組で決まるため、設定をまたいで共有できる。
+    # 署名鍵が違えば検証結果も変わりうるため、鍵の内容もキーに含める。
+    payload = {
+        "url": repository.url,
+        "suite": repository.suite,
+        "components": repository.components,
+        "arch": config.arch,
+        "signed_by_sha256": _file_sha256(repository.signed_by),
+    }
+    encoded = json.dumps(payload, ensure_ascii=True, separators=(",", ":"), sort_keys=True)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+@contextmanager
+def _file_lock(path: Path, *, shared: bool = False) -> Iterator[None]:
+    # fcntl は Windows にないため、run.py から import されても困らないよう使う時に読み込む。
+    import fcntl
+
+    with path.open("w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+
+
+def _update_shared_lists(
+    apt_get: str,
+    config: SysrootConfig,
+    repository: RepositoryConfig,
+    lists_dir: Path,
+    max_age: float,
+) -> None:
+    # 共有のインデックスを apt-get update で更新する。既存のインデックスがあれば
+    # apt-get は InRelease の変化と条件付きリクエストで差分だけを取得する。
+    # 同じリポジトリを同時に更新しないよう、リポジトリごとのロックを取る。
+    lists_dir.mkdir(parents=True, exist_ok=True)
+    with _file_lock(lists_dir.parent / f"{lists_dir.name}.lock"):
+        stamp = lists_dir / ".updated"
+        if stamp.exists() and time.time() - stamp.stat().st_mtime < max_age:
+            logger.info("Using shared APT lists: %s %s", repository.url, repository.suite)
+            return
+        with tempfile.TemporaryDirectory(prefix="sysroot-apt-") as temporary_dir_value:
+            work_dir = Path(temporary_dir_value)
+            _write_apt_files(replace(config, repositories=(repository,)), work_dir)
+            (lists_dir / "partial").mkdir(exist_ok=True)
+            environment = os.environ.copy()
+            environment["APT_CONFIG"] = str(work_dir / "apt.conf")
+            _run_command(
+                [
+                    apt_get,
+                    *_apt_options(work_dir),
+                    "-o",
+                    f"Dir::State::lists={lists_dir}",
+                    "update",
+                ],
+                environment=environment,
+            )
+        # 取得に失敗しても apt-get update は警告だけで終わることがあるため、
+        # 署名付きの Release ファイルが揃っていることを確認してから更新済みとする。
+        if not any(lists_dir.glob("*InRelease")) and not any(lists_dir.glob("*_Release")):
+            raise SysrootBuildError(f"Failed to update APT lists: {repository.url}")
+        stamp.touch()
+
+
+def _link_shared_lists(lists_dir: Path, destination: Path) -> None:
+    # ビルドでは apt-get update を実行せずインデックスを読むだけなので、ハードリンクで足りる。
+    with _file_lock(lists_dir.parent / f"{lists_dir.name}.lock", shared=True):
+        for path in lists_dir.iterdir():
+            if path.is_file() and not path.name.startswith(".") and path.name != "lock":
+                _link_or_copy(path, destination / path.name)
+
+
+def _prepare_apt(
+    config: SysrootConfig,
+    work_dir: Path,
+    cache_dir: Path | None = None,
+    lists_max_age: float = DEFAULT_APT_LISTS_MAX_AGE,
+) -> tuple[str, list[str], dict[str, str]]:
+    # work_dir に隔離した APT の環境を作ってインデックスを用意し、
+    # 以降の apt コマンドに渡す (apt-get のパス, オプション, 環境変数) を返す。
+    # cache_dir を指定すると、インデックスをリポジトリごとに cache_dir へ保存して
+    # 別の設定や次回の生成と共有し、apt-get update の再取得を避ける。
+    apt_get = _require_command("apt-get")
+    _write_apt_files(config, work_dir)
+    environment = os.environ.copy()
+    environment["APT_CONFIG"] = str(work_dir / "apt.conf")
+    apt_options = _apt_options(work_dir)
+    if cache_dir is None:
+        _run_command([apt_get, *apt_options, "update"], environment=environment)
+    else:
+        for repository in config.repositories:
+            lists_dir = cache_dir / "apt-lists" / _repository_lists_key(config, repository)
+            _update_shared_lists(apt_get, config, repository, lists_dir, lists_max_age)
+            _link_shared_lists(lists_dir, work_dir / "state" / "lists")
+    if config.exclude_packages:
+        _mark_packages_installed(apt_options, environment, work_dir, config.exclude_packages)
+    return apt_get, apt_options, environment
+
+
+def _parse_apt_records(output: str) -> list[dict[str, str]]:
+    # apt-cache show の出力を空行区切りのレコードに分け、1 行のフィールドだけを取り出す。
+    # Description などの継続行 (先頭が空白) は使わないので読み捨てる。
+    return [
+        dict(line.split(": ", 1) for line in record.splitlines() if ": " in line and line[0] != " ")
+        for record in output.split("\n\n")
+        if record.strip()
+    ]
+
+
+def _mark_packages_installed(
+    apt_options: list[str], environment: dict[str, str], work_dir: Path, names: tuple[str, ...]
+) -> None:
+    # 除外するパッケージを候補バージョンのまま status ファイルへ「インストール済み」として書き込む。
+    # apt はこれらで依存を満たせると判断し、ダウンロードも依存関係の追跡もしない。
+    # Depends は書かないため、除外したパッケージだけが必要としていた依存もまとめて外れる。
+    output = _run_command_output(
+        [_require_command("apt-cache"), *apt_options, "show", "--no-all-versions", *names],
+        environment=environment,
+    )
+    records = {record["Package"]: record for record in _parse_apt_records(output)}
+    missing = [name for name in names if name not in records]
+    if missing:
+        raise SysrootBuildError(f"Excluded packages were not found: {', '.join(missing)}")
+    stanzas = []
+    for name in names:
+        record = records[name]
+        lines = [f"Package: {name}", "Status: install ok installed"]
+        for field in ("Architecture", "Multi-Arch", "Version", "Provides"):
+            if field in record:
+                lines.append(f"{field}: {record[field]}")
+        stanzas.append("\n".join(lines) + "\n")
+    (work_dir / "state" / "status").write_text("\n".join(stanzas), encoding="utf-8")
+    logger.info("Excluding %d packages: %s", len(names), " ".join(names))
+
+
+def _resolve_packages(
+    apt_get: str, apt_options: list[str], environment: dict[str, str], packages: tuple[str, ...]
+) -> list[_DebPackage]:
+    # --print-uris はダウンロードせずに、依存解決後に必要な deb の URL とハッシュを出力する。
+    output = _run_command_output(
+        [
+            apt_get,
+            *apt_options,
+            "--print-uris",
+            "--yes",
+            "--no-install-recommends",
+            "--no-install-suggests",
+            "install",
+            *packages,
+        ],
+        environment=environment,
+    )
+    resolved = []
+    for line in output.splitlines():
+        match = PRINT_URIS_PATTERN.fullmatch(line.strip())
+        if match is None:
+            continue
+        resolved.append(
+            _DebPackage(
+                url=match["url"],
+                filename=match["filename"],
+                size=int(match["size"]),
+                hash=match["hash"] or "",
+            )
+        )
+    if resolved:
+        # apt-get --print-uris が出力するハッシュは MD5Sum の場合があり、キャッシュや
+        # lockfile のキーに使えないため、SHA256 を Packages インデックスから取り出す。
+        records = _package_records(apt_options, environment, resolved)
+        missing = [
+            package.filename for package in resolved if "SHA256" not in records[package.filename]
+        ]
+        if missing:
+            raise SysrootBuildError(f"SHA256 was not found for: {', '.join(missing)}")
+        resolved = [
+            replace(package, hash=f"SHA256:{records[package.filename]['SHA256']}")
+            for package in resolved
+        ]
+    return sorted(resolved, key=lambda package: package.filename)
+
+
+def _package_records(
+    apt_options: list[str], environment: dict[str, str], packages: list[_DebPackage]
+) -> dict[str, dict[str, str]]:
+    # 依存解決した deb ごとに、Packages インデックスのレコードを deb のファイル名をキーに返す。
+    output = _run_command_output(
+        [
+            _require_command("apt-cache"),
+            *apt_options,
+            "show",
+            *(f"{package.name}={package.version}" for package in packages),
+        ],
+        environment=environment,
+    )
+    records = {}
+    for record in _parse_apt_records(output):
+        filename = record.get("Filename")
+        if filename is None:
+            continue
+        for package in packages:
+            if package.url.endswith(f"/{filename}"):
+                records[package.filename] = record
+    missing = [package.filename for package in packages if package.filename not in records]
+    if missing:
+        raise SysrootBuildError(f"Package record was not found for: {', '.join(missing)}")
+    return records
+
+
+def _hash_file(path: Path, algorithm: str) -> str:
+    digest = hashlib.new(algorithm)
+    with path.open("rb") as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _split_hash(value: str) -> tuple[str, str] | None:
+    # "SHA256:<hex>" を hashlib のアルゴリズム名と 16 進表記に分解する。
+    # キャッシュのキーとして使えない弱いハッシュや不正な形式なら None を返す。
+    name, separator, hexdigest = value.partition(":")
+    algorithm = HASH_ALGORITHMS.get(name)
+    if not separator or algorithm is None or re.fullmatch(r"[0-9a-f]+", hexdigest) is None:
+        return None
+    return algorithm, hexdigest
+
+
+def _deb_cache_path(cache_dir: Path, package: _DebPackage) -> Path | None:
+    # パッケージのファイル名とハッシュの組をキーにする。ファイル名だけでは
+    # 同名で中身の異なる deb（別リポジトリの再ビルドなど）を区別できない。
+    split = _split_hash(package.hash)
+    if split is None:
+        return None
+    algorithm, hexdigest = split
+    return cache_dir / "debs" / algorithm / f"{hexdigest}_{package.filename}"
+
+
+def _link_or_copy(source: Path, destination: Path) -> None:
+    # 同一ファイルシステムならハードリンクで済ませ、できなければコピーする。
+    # source が存在しない場合はコピーも FileNotFoundError になり、呼び出し側へ伝わる。
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def _restore_from_deb_cache(cache_dir: Path, package: _DebPackage, destination: Path) -> bool:
+    split = _split_hash(package.hash)
+    cache_path = _deb_cache_path(cache_dir, package)
+    if split is None or cache_path is None:
+        return False
+    try:
+        _link_or_copy(cache_path, destination)
+    except FileNotFoundError:
+        # 別プロセスが上限サイズを超えた分として削除した直後など。
+        return False
+    # キャッシュは複数のビルドで共有するので、壊れたファイルを使い続けないよう
+    # 格納時と同じくサイズとハッシュを確かめ、一致しなければ削除して取得し直させる。
+    algorithm, hexdigest = split
+    if (
+        destination.stat().st_size != package.size
+        or _hash_file(destination, algorithm) != hexdigest
+    ):
+        logger.warning("Removing corrupted package from the deb cache: %s", cache_path)
+        destination.unlink()
+        cache_path.unlink(missing_ok=True)
+        return False
+    # 最終利用日時を更新し、上限サイズを超えたときに削除されにくくする。
+    os.utime(cache_path)
+    return True
+
+
+def _store_in_deb_cache(cache_dir: Path, package: _DebPackage, source: Path) -> None:
+    split = _split_hash(package.hash)
+    cache_path = _deb_cache_path(cache_dir, package)
+    if split is None or cache_path is None or cache_path.exists():
+        return
+    # apt-get がハッシュを検証済みのはずだが、共有キャッシュを汚さないよう再確認する。
+    algorithm, hexdigest = split
+    if _hash_file(source, algorithm) != hexdigest:
+        raise SysrootBuildError(f"Hash mismatch for downloaded package: {package.filename}")
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # 同時に動く別プロセスから書き込み途中のファイルが見えないよう、
+    # 一時ファイルへ書いてから rename で配置する。
+    temporary_path = cache_path.with_name(
+        f".{cache_path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    )
+    try:
+        _link_or_copy(source, temporary_path)
+        os.replace(temporary_path, cache_path)
+    finally:
+        temporary_path.unlink(missing_ok=True)
+
+
+def _prune_deb_cache(cache_dir: Path, max_bytes: int) -> None:
+    # 合計サイズが上限を超えていれば、最終利用日時 (mtime) の古い deb から削除する。
+    # 削除済みのファイルを別プロセスが同時に消しても問題ないよう、存在しない場合は無視する。
+    entries = []
+    for path in (cache_dir / "debs").glob("*/*.deb"):
+        try:
+            status = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((status.st_mtime, status.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+
+
+class _BuildMetrics:
+    """sysroot の生成の段階ごとの所要時間とダウンロード量を集計する。
+
+    段階は入れ子にでき、内側の段階の時間は外側の段階から差し引く。
+    どの段階も build_sysroot を呼んだスレッドから計測する。
+    """
+
+    def __init__(self) -> None:
+        self.phases: dict[str, float] = {}
+        self.downloaded_packages = 0
+        self.downloaded_bytes = 0
+        self.cached_packages = 0
+        self._stack: list[str] = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.monotonic()
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = time.monotonic() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+            if self._stack:
+                parent = self._stack[-1]
+                self.phases[parent] = self.phases.get(parent, 0.0) - elapsed
+
+    def add_packages(self, packages: Iterable[_DebPackage], *, cached: bool) -> None:
+        for package in packages:
+            if cached:
+                self.cached_packages += 1
+            else:
+                self.downloaded_packages += 1
+                self.downloaded_bytes += package.size
+
+    def to_json(
+        self, total_seconds: float, files: dict[str, list[object]], symlinks: dict[str, str]
+    ) -> dict[str, object]:
+        # download の時間が記録されない場合 (lockfile でダウンロードと展開を重ねた場合) は、
+        # 展開までを含めた時間からスループットを求める。
+        download_seconds = self.phases.get("download", self.phases.get("extract", 0.0))
+        return {
+            "total_seconds": round(total_seconds, 3),
+            "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            "download": {
+                "packages": self.downloaded_packages,
+                "cached_packages": self.cached_packages,
+                "bytes": self.downloaded_bytes,
+                "bytes_per_second": (
+                    round(self.downloaded_bytes / download_seconds) if download_seconds > 0 else 0
+                ),
+            },
+            "sysroot": {
+                "files": len(files),
+                "symlinks": len(symlinks),
+                "bytes": sum(cast(int, item[0]) for item in files.values()),
+            },
+        }
+
+
+def _download_packages(
+    apt_get: str,
+    apt_options: list[str],
+    environment: dict[str, str],
+    packages: list[_DebPackage],
+    archive_dir: Path,
+    cache_dir: Path | None,
+    cache_max_bytes: int,
+    metrics: _BuildMetrics | None = None,
+) -> list[Path]:
+    """依存解決済みの deb を archive_dir へ揃え、パッケージと同じ順のパス一覧を返す。
+
+    キャッシュにある deb はそのまま使い、残りだけを apt-get download で取得する。
+    バージョンまで指定するため依存解決はやり直さず、Packages インデックスの
+    ハッシュによる検証は apt-get が行う。
+    """
+    missing = [
+        package
+        for package in packages
+        if not (archive_dir / package.filename).is_file()
+        and not (
+            cache_dir is not None
+            and _restore_from_deb_cache(cache_dir, package, archive_dir / package.filename)
+        )
+    ]
+    logger.info(
+        "Downloading %d of %d packages (%d from cache)",
+        len(missing),
+        len(packages),
+        len(packages) - len(missing),
+    )
+    if metrics is not None:
+        missing_filenames = {package.filename for package in missing}
+        metrics.add_packages(missing, cached=False)
+        metrics.add_packages(
+            (package for package in packages if package.filename not in missing_filenames),
+            cached=True,
+        )
+    if missing:
+        _run_command(
+            [
+                apt_get,
+                *apt_options,
+                "download",
+                *(f"{package.name}={package.version}" for package in missing),
+            ],
+            environment=environment,
+            cwd=archive_dir,
+        )
+
+    deb_files = [archive_dir / package.filename for package in packages]
+    not_downloaded = [deb_file.name for deb_file in deb_files if not deb_file.is_file()]
+    if not_downloaded:
+        raise SysrootBuildError(f"Packages were not downloaded: {', '.join(not_downloaded)}")
+    if cache_dir is not None:
+        for package in missing:
+            _store_in_deb_cache(cache_dir, package, archive_dir / package.filename)
+        _prune_deb_cache(cache_dir, cache_max_bytes)
+    return deb_files
+
+
+class _HttpConnectionPool:
+    """スレッドごと・ホストごとに HTTP(S) の接続を保持し、keep-alive で使い回す。"""
+
+    def __init__(self, timeout: float = 60) -> None:
+        self._timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: list[http.client.HTTPConnection] = []
+
+    def _connection(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        connections = cast(
+            dict[tuple[str, str], http.client.HTTPConnection],
+            self._local.__dict__.setdefault("connections", {}),
+        )
+        connection = connections.get((scheme, netloc))
+        if connection is None:
+            if scheme == "https":
+                connection = http.client.HTTPSConnection(netloc, timeout=self._timeout)
+            else:
+                connection = http.client.HTTPConnection(netloc, timeout=self._timeout)
+            connections[(scheme, netloc)] = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def get(self, url: str) -> http.client.HTTPResponse:
+        """url を GET し、本文を読み出せる状態のレスポンスを返す。リダイレクトはたどる。
+
+        レスポンスは次の要求の前に最後まで読み出すこと。
+        """
+        for _ in range(5):
+            parsed = urlparse(url)
+            if parsed.scheme not in ("http", "https"):
+                raise SysrootBuildError(f"Unsupported URL: {url}")
+            path = parsed.path or "/"
+            if parsed.query:
+                path = f"{path}?{parsed.query}"
+            connection = self._connection(parsed.scheme, parsed.netloc)
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                # サーバーが keep-alive の接続を閉じていた場合は、接続し直して 1 度だけ再試行する。
+                connection.close()
+                connection.request("GET", path)
+                response = connection.getresponse()
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader("Location")
+                response.read()
+                if location is None:
+                    raise SysrootBuildError(f"Redirect without location: {url}")
+                url = urljoin(url, location)
+                continue
+            if response.status != 200:
+                response.read()
+                raise SysrootBuildError(f"Failed to download {url}: HTTP {response.status}")
+            return response
+        raise SysrootBuildError(f"Too many redirects: {url}")
+
+    def close(self) -> None:
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+
+def _stream_package(
+    pool: _HttpConnectionPool,
+    package: _DebPackage,
+    destination: Path,
+    keep: Callable[[str], bool] | None,
+    cache_dir: Path | None,
+) -> list[_IndexEntry]:
+    # ダウンロードしながら展開し、最後にサイズとハッシュを検証する。
+    # .deb はキャッシュを使う場合だけ、展開と並行してキャッシュへ書き出す。
+    split = _split_hash(package.hash)
+    if split is None:
+        raise SysrootBuildError(f"Unsupported hash for {package.filename}: {package.hash}")
+    algorithm, expected = split
+    destination.mkdir(parents=True, exist_ok=True)
+    cache_path = _deb_cache_path(cache_dir, package) if cache_dir is not None else None
+    temporary_path = None
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = cache_path.with_name(
+            f".{cache_path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+    try:
+        with ExitStack() as stack:
+            sink = stack.enter_context(temporary_path.open("wb")) if temporary_path else None
+            response = stack.enter_context(pool.get(package.url))
+            reader = _HashingReader(cast(BinaryIO, response), algorithm, sink)
+            entries = _extract_deb_stream(
+                cast(BinaryIO, reader), destination, package.filename, keep
+            )
+            # deb の末尾まで読み切ってからハッシュを確定する。
+            while reader.read(1024 * 1024):
+                pass
+        if reader.size != package.size or reader.digest.hexdigest() != expected:
+            raise SysrootBuildError(f"Downloaded package does not match: {package.url}")
+        if cache_path is not None and temporary_path is not None:
+            os.replace(temporary_path, cache_path)
+    finally:
+        if temporary_path is not None:
+            temporary_path.unlink(missing_ok=True)
+    return entries
+
+
+def _stream_stage_debs(
+    pool: _HttpConnectionPool,
+    packages: list[_DebPackage],
+    staging_root: Path,
+    jobs: int,
+    keep: Callable[[str], bool] | None,
+    cache_dir: Path | None,
+    cache_max_bytes: int,
+    metrics: _BuildMetrics | None = None,
+) -> Iterator[tuple[str, Path, list[_IndexEntry]]]:
+    """deb を取得しながら staging ディレクトリへ展開し、_stage_debs と同じ形式で返す。
+
+    キャッシュにある deb はキャッシュから直接展開し、残りは複数の接続で並列にダウンロードする。
+    ダウンロードと展開が重なり、ダウンロードを待たずに統合を始められる。
+    返すのはハッシュの検証まで終わったものだけなので、途中で失敗しても検証前の deb が
+    sysroot に統合されることはない。
+    """
+    staging_root.mkdir(exist_ok=True)
+
+    def extract(package: _DebPackage) -> tuple[str, Path, list[_IndexEntry], bool]:
+        staging_dir = staging_root / package.filename
+        cache_path = _deb_cache_path(cache_dir, package) if cache_dir is not None else None
+        split = _split_hash(package.hash)
+        if cache_path is not None and split is not None:
+            try:
+                stream = cache_path.open("rb")
+            except FileNotFoundError:
+                pass
+            else:
+                # キャッシュは複数のビルドで共有するので、展開しながらサイズとハッシュを確かめ、
+                # 壊れていればキャッシュから削除してダウンロードし直す。
+                algorithm, expected = split
+                staging_dir.mkdir()
+                try:
+                    with stream:
+                        reader = _HashingReader(stream, algorithm)
+                        entries = _extract_deb_stream(
+                            cast(BinaryIO, reader), staging_dir, package.filename, keep
+                        )
+                        while reader.read(1024 * 1024):
+                            pass
+                    valid = reader.size == package.size and reader.digest.hexdigest() == expected
+                except SysrootBuildError:
+                    valid = False
+                if valid:
+                    # 最終利用日時を更新し、上限サイズを超えたときに削除されにくくする。
+                    os.utime(cache_path)
+                    return package.filename, staging_dir, entries, True
+                logger.warning("Removing corrupted package from the deb cache: %s", cache_path)
+                cache_path.unlink(missing_ok=True)
+                shutil.rmtree(staging_dir)
+        entries = _stream_package(pool, package, staging_dir, keep, cache_dir)
+        return package.filename, staging_dir, entries, False
+
+    cached = 0
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        # map は投入順に結果を返すため、呼び出し側は常にファイル名順で統合できる。
+        results = executor.map(extract, packages)
+        for package, (filename, staging_dir, entries, from_cache) in zip(packages, results):
+            cached += from_cache
+            if metrics is not None:
+                metrics.add_packages([package], cached=from_cache)
+            yield filename, staging_dir, entries
+    logger.info("Extracted %d packages (%d from cache)", len(packages), cached)
+    if cache_dir is not None:
+        _prune_deb_cache(cache_dir, cache_max_bytes)
+
+
 def _ensure_usrmerge_symlinks(root: Path) -> None:
-    # dpkg-deb --extract は maintainer script を実行しないため、
+    # deb の展開では maintainer script を実行しないため、
     # 通常は usrmerge パッケージが作成する /lib -> usr/lib などのリンクが存在しない。
     # このリンクがないと、パッケージが /lib/... を参照するパスで配置したファイルと
     # /usr/lib/... を参照するリンカがすれ違って解決に失敗するため、ここで補う。
@@ -330,25 +1706,57 @@ def _ensure_usrmerge_symlinks(root: Path) -> None:
             legacy_path.symlink_to(merged)
 
 
-def _fix_absolute_symlinks(root: Path) -> None:
+def _scan_symlinks(root: Path) -> Iterator[str]:
+    # os.scandir が返す種別情報だけで symlink を探し、エントリごとの stat を避ける。
+    # ディレクトリへの symlink はたどらない。
+    pending = [""]
+    while pending:
+        relative_dir = pending.pop()
+        with os.scandir(os.path.join(root, relative_dir)) as entries:
+            for entry in entries:
+                relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                if entry.is_symlink():
+                    yield relative_path
+                elif entry.is_dir(follow_symlinks=False):
+                    pending.append(relative_path)
+
+
+def _fix_absolute_symlinks(root: Path, symlinks: Iterable[str] | None = None) -> None:
     # パッケージ内の絶対パスリンク (例: libfoo.so -> /usr/lib/.../libfoo.so.1) は
     # sysroot の外、つまりホスト側のファイルを指してしまう。
     # クロスコンパイル時にリンカが正しいライブラリを解決できるよう、
     # sysroot 内で完結する相対リンクへ張り替える。
-    for path in root.rglob("*"):
-        if not path.is_symlink():
+    # symlinks には展開時に記録した symlink のパスを渡せる。省略時は sysroot を走査する。
+    # symlink の数だけ繰り返すため、Path を作らず文字列のまま扱う。
+    real_root = os.path.realpath(root)
+    real_parents: dict[str, str | None] = {}
+    for relative_path in _scan_symlinks(root) if symlinks is None else symlinks:
+        # 記録したパスは usrmerge のリンク (lib -> usr/lib など) を含むことがあるため、
+        # 親ディレクトリの実体を基準に相対リンクを作る。
+        relative_parent, name = os.path.split(relative_path)
+        if relative_parent not in real_parents:
+            parent = os.path.realpath(os.path.join(real_root, relative_parent))
+            inside = parent == real_root or parent.startswith(real_root + os.sep)
+            real_parents[relative_parent] = parent if inside else None
+        parent = real_parents[relative_parent]
+        if parent is None:
+            continue
+        path = os.path.join(parent, name)
+        try:
+            target = os.readlink(path)
+        except OSError:
+            # 後から展開された deb が同じパスを通常ファイルで上書きした場合など。
             continue
-        target = Path(os.readlink(path))
-        if not target.is_absolute():
+        if not target.startswith("/"):
             continue
         # /etc/alternatives 経由のリンクなど、展開だけでは実体が存在しない
         # リンク先は張り替えの根拠がないためそのまま残す。
-        target_in_sysroot = root / target.relative_to("/")
-        if not target_in_sysroot.exists():
+        target_in_sysroot = real_root + os.path.normpath(target)
+        if not os.path.exists(target_in_sysroot):
             continue
-        relative_target = os.path.relpath(target_in_sysroot, start=path.parent)
-        path.unlink()
-        path.symlink_to(relative_target)
+        relative_target = os.path.relpath(target_in_sysroot, start=parent)
+        os.unlink(path)
+        os.symlink(relative_target, path)
 
 
 def _link_pkgconfig_files(root: Path, triplet: str) -> None:
@@ -359,6 +1767,15 @@ def _link_pkgconfig_files(root: Path, triplet: str) -> None:
         return
     destination_dir = root / "usr" / "share" / "pkgconfig"
     destination_dir.mkdir(parents=True, exist_ok=True)
+    # 差分更新で元の定義を含む deb が削除された場合に備え、
+    # この関数が張ったリンクのうちリンク先が無くなったものを取り除く。
+    for destination in destination_dir.iterdir():
+        if (
+            destination.is_symlink()
+            and os.readlink(destination) == f"../../lib/{triplet}/pkgconfig/{destination.name}"
+            and not destination.exists()
+        ):
+            destination.unlink()
     for source in sorted(source_dir.iterdir()):
         destination = destination_dir / source.name
         # パッケージが usr/share/pkgconfig へ直接配置した定義を上書きしない。
@@ -368,11 +1785,11 @@ def _link_pkgconfig_files(root: Path, triplet: str) -> None:
         destination.symlink_to(f"../../lib/{triplet}/pkgconfig/{source.name}")
 
 
-def _postprocess_sysroot(root: Path, triplet: str) -> None:
+def _postprocess_sysroot(root: Path, triplet: str, symlinks: Iterable[str] | None = None) -> None:
     # maintainer script を実行しない展開方式の穴を埋める後処理をまとめて行う。
     # 後処理の内容を変えたら MANIFEST_VERSION をインクリメントすること。
     _ensure_usrmerge_symlinks(root)
-    _fix_absolute_symlinks(root)
+    _fix_absolute_symlinks(root, symlinks)
     _link_pkgconfig_files(root, triplet)
 
 
@@ -389,6 +1806,171 @@ def _read_manifest(output_dir: Path) -> dict[str, object] | None:
     return cast(dict[str, object], raw_value)
 
 
+def _manifest_packages(manifest: dict[str, object]) -> dict[str, tuple[str, list[str]]] | None:
+    # 差分更新に使う deb ごとの (ハッシュ, パス一覧) を manifest から取り出す。
+    # 古い形式などで取り出せない場合は None を返し、呼び出し側で全体を生成し直す。
+    value = manifest.get("packages")
+    if not isinstance(value, list):
+        return None
+    packages = {}
+    for item in value:
+        if not isinstance(item, dict):
+            return None
+        filename = item.get("filename")
+        hash_value = item.get("hash")
+        paths = item.get("paths")
+        if (
+            not isinstance(filename, str)
+            or not isinstance(hash_value, str)
+            or not isinstance(paths, list)
+            or not all(isinstance(path, str) for path in paths)
+        ):
+            return None
+        packages[filename] = (hash_value, cast(list[str], paths))
+    return packages
+
+
+def _entry_hashes(extracted: Iterable[list[_IndexEntry]]) -> dict[str, str]:
+    # 展開時に計算したハッシュをパスごとにまとめる。統合と同じ順に渡せば、後の deb が勝つ。
+    return {
+        entry.path: entry.sha256
+        for entries in extracted
+        for entry in entries
+        if entry.sha256 is not None
+    }
+
+
+def _index_sysroot_files(
+    root: Path,
+    hashes: dict[str, str],
+    previous_files: dict[str, tuple[int, int, str]],
+    jobs: int,
+) -> tuple[dict[str, list[object]], dict[str, str]]:
+    # manifest に記録するファイル一覧 ({パス: [サイズ, 更新日時, SHA256]}) と
+    # symlink 一覧 ({パス: リンク先}) を作る。
+    # ハッシュは展開時に計算したものか、メタデータが変わっていない前回の値を使い、
+    # どちらもないファイルだけを読み直す。
+    files: dict[str, list[object]] = {}
+    symlinks: dict[str, str] = {}
+    missing: list[str] = []
+    for relative_path, file_stat in _walk_sysroot(root):
+        if stat.S_ISLNK(file_stat.st_mode):
+            symlinks[relative_path] = os.readlink(root / relative_path)
+            continue
+        if not stat.S_ISREG(file_stat.st_mode) or relative_path == MANIFEST_NAME:
+            continue
+        metadata = (file_stat.st_size, file_stat.st_mtime_ns)
+        sha256 = hashes.get(relative_path)
+        previous = previous_files.get(relative_path)
+        if sha256 is None and previous is not None and previous[:2] == metadata:
+            sha256 = previous[2]
+        if sha256 is None:
+            missing.append(relative_path)
+        files[relative_path] = [*metadata, sha256]
+    if missing:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            for relative_path, sha256 in zip(
+                missing, executor.map(lambda path: _file_sha256(root / path), missing)
+            ):
+                files[relative_path][2] = sha256
+    return files, symlinks
+
+
+def _manifest_files(
+    manifest: dict[str, object],
+) -> tuple[dict[str, tuple[int, int, str]], dict[str, str]] | None:
+    # manifest からファイル一覧と symlink 一覧を取り出す。
+    # ファイル一覧を持たない古い manifest や形式が不正な場合は None を返す。
+    files_value = manifest.get("files")
+    symlinks_value = manifest.get("symlinks")
+    if not isinstance(files_value, dict) or not isinstance(symlinks_value, dict):
+        return None
+    files = {}
+    for path, item in files_value.items():
+        if (
+            not isinstance(item, list)
+            or len(item) != 3
+            or not isinstance(item[0], int)
+            or not isinstance(item[1], int)
+            or not isinstance(item[2], str)
+        ):
+            return None
+        files[path] = (item[0], item[1], item[2])
+    if not all(isinstance(link, str) for link in symlinks_value.values()):
+        return None
+    return files, cast(dict[str, str], symlinks_value)
+
+
+def _verify_sysroot_files(
+    root: Path,
+    files: dict[str, tuple[int, int, str]],
+    symlinks: dict[str, str],
+    jobs: int,
+) -> list[str]:
+    # まず stat だけで確認し、サイズが同じで更新日時だけが変わったファイルに限って
+    # ハッシュを並列に計算する。見つかった問題を "パス: 内容" の形式で返す。
+    problems = []
+    suspects = []
+    for path, (size, mtime_ns, _) in files.items():
+        try:
+            file_stat = os.lstat(root / path)
+        except FileNotFoundError:
+            problems.append(f"{path}: missing")
+            continue
+        if not stat.S_ISREG(file_stat.st_mode):
+            problems.append(f"{path}: not a regular file")
+        elif file_stat.st_size != size:
+            problems.append(f"{path}: size changed")
+        elif file_stat.st_mtime_ns != mtime_ns:
+            suspects.append(path)
+    for path, link in symlinks.items():
+        try:
+            actual = os.readlink(root / path)
+        except FileNotFoundError:
+            problems.append(f"{path}: missing")
+        except OSError:
+            problems.append(f"{path}: not a symlink")
+        else:
+            if actual != link:
+                problems.append(f"{path}: symlink target changed")
+    if suspects:
+        logger.info("Hashing %d files with changed timestamps", len(suspects))
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            actual_hashes = executor.map(lambda path: _file_sha256(root / path), suspects)
+            for path, sha256 in zip(suspects, actual_hashes):
+                if sha256 != files[path][2]:
+                    problems.append(f"{path}: content changed")
+    return sorted(problems)
+
+
+def verify_sysroot(sysroot_dir: Path, *, jobs: int | None = None) -> list[str]:
+    """manifest のファイル一覧と照合して sysroot が生成時から変わっていないか確認する。
+
+    見つかった問題を "パス: 内容" の形式で返し、問題がなければ空のリストを返す。
+    ハッシュを計算するのはサイズが同じで更新日時だけが変わったファイルに限るため、
+    手作業での削除や変更も数秒で検出できる。manifest にファイル一覧がない場合はエラーにする。
+    """
+    manifest = _read_manifest(sysroot_dir)
+    if manifest is None:
+        raise SysrootBuildError(f"Sysroot manifest was not found: {sysroot_dir}")
+    index = _manifest_files(manifest)
+    if index is None:
+        raise SysrootBuildError(
+            f"Sysroot manifest has no file index; rebuild with --force: {sysroot_dir}"
+        )
+    files, symlinks = index
+    return _verify_sysroot_files(
+        sysroot_dir, files, symlinks, _default_jobs() if jobs is None else jobs
+    )
+
+
+def _write_manifest(root: Path, value: dict[str, object]) -> None:
+    # 書き込み途中の manifest が読まれないよう、一時ファイルから rename する。
+    temporary_path = root / f"{MANIFEST_NAME}.tmp"
+    temporary_path.write_text(json.dumps(value, indent=2, sort_keys=True) + "\n", encoding="utf-8")
+    os.replace(temporary_path, root / MANIFEST_NAME)
+
+
 def _install_completed_sysroot(new_root: Path, output_dir: Path) -> None:
     # 完成した sysroot を出力先へ rename で切り替える。
     # 展開途中の状態が output_dir に見える瞬間を作らないため、
@@ -405,20 +1987,362 @@ def _install_completed_sysroot(new_root: Path, output_dir: Path) -> None:
             backup_dir.rename(output_dir)
         raise
     if had_previous:
-        if backup_dir.is_dir() and not backup_dir.is_symlink():
-            shutil.rmtree(backup_dir)
+        # 大きな sysroot の削除で呼び出し元を待たせないよう、退避したものは
+        # 削除待ちの領域へ移し、バックグラウンドで削除する。
+        trash_dir = output_dir.parent / TRASH_DIR_NAME
+        move_to_trash(backup_dir, trash_dir)
+        empty_trash(trash_dir, background=True)
+
+
+def move_to_trash(path: Path, trash_dir: Path | None = None) -> Path | None:
+    """path を削除待ちの領域 trash_dir へ移し、移動先を返す。
+
+    trash_dir を省略すると path と同じ親ディレクトリの .trash を使う。
+    trash_dir は path と同じファイルシステムに置くこと。rename で移すため、
+    ツリーの大きさに関係なくすぐに終わる。実際の削除は empty_trash で行う。
+    rename できない場合はその場で削除する。path が存在しなければ None を返す。
+    """
+    if not path.exists() and not path.is_symlink():
+        return None
+    if trash_dir is None:
+        trash_dir = path.parent / TRASH_DIR_NAME
+    trash_dir.mkdir(parents=True, exist_ok=True)
+    # 同じ名前のツリーを何度移しても衝突しないよう、一意な名前を付ける。
+    destination = trash_dir / f"{path.name}-{os.getpid()}-{time.time_ns()}"
+    try:
+        path.rename(destination)
+    except OSError as error:
+        logger.debug("Failed to move %s to trash; removing it now: %s", path, error)
+        _remove_path(path)
+        return None
+    return destination
+
+
+def empty_trash(trash_dir: Path, *, background: bool = False) -> None:
+    """move_to_trash で移したものをすべて削除する。
+
+    background が真なら切り離した子プロセスで削除し、完了を待たずに戻る。
+    子プロセスは呼び出し元が終了しても削除を続け、中断された分は次に呼び出した時に削除される。
+    """
+    if not trash_dir.is_dir() or not any(trash_dir.iterdir()):
+        return
+    if background:
+        # 子プロセスからこのモジュールを import できるよう、モジュールの場所で起動する。
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                (
+                    "import sys; from pathlib import Path; from sysroot_builder import empty_trash; "
+                    "empty_trash(Path(sys.argv[1]))"
+                ),
+                str(trash_dir.resolve()),
+            ],
+            cwd=Path(__file__).resolve().parent,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        logger.debug("Emptying trash in the background: %s", trash_dir)
+        return
+    for entry in trash_dir.iterdir():
+        # 別のプロセスが同時に削除している場合もあるため、削除の失敗は無視する。
+        if entry.is_dir() and not entry.is_symlink():
+            shutil.rmtree(entry, ignore_errors=True)
         else:
-            # 既存の出力が symlink や通常ファイルだった場合は unlink で消す。
-            backup_dir.unlink()
+            entry.unlink(missing_ok=True)
+
 
+def sysroot_artifact_name(config: SysrootConfig) -> str:
+    """設定から sysroot アーティファクトのファイル名を決める。
 
-def build_sysroot(config: SysrootConfig, output_dir: Path, *, force: bool = False) -> bool:
+    fingerprint と MANIFEST_VERSION の両方を含めるため、設定か生成形式が変われば別名になる。
+    """
+    fingerprint = sysroot_config_fingerprint(config)
+    return f"{config.name}-{fingerprint}-v{MANIFEST_VERSION}.tar.zst"
+
+
+def _walk_sysroot(root: Path, relative_dir: str = "") -> Iterator[tuple[str, os.stat_result]]:
+    # アーティファクトの内容を決定的にするため、名前順にたどる。ディレクトリは中身より先に返す。
+    with os.scandir(os.path.join(root, relative_dir)) as iterator:
+        entries = sorted(iterator, key=lambda entry: entry.name)
+    for entry in entries:
+        relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+        yield relative_path, entry.stat(follow_symlinks=False)
+        if entry.is_dir(follow_symlinks=False):
+            yield from _walk_sysroot(root, relative_path)
+
+
+def _pack_sysroot(root: Path, file: BinaryIO) -> None:
+    # 同じ sysroot からは同じバイト列ができるよう、所有者を固定し、
+    # 生成時刻に左右されるディレクトリ・symlink・manifest の更新日時は 0 にし、
+    # manifest からは計測値を取り除く。
+    # 通常ファイルの更新日時は deb に記録された値なので、そのまま残す。
+    with ExitStack() as stack:
+        compressed = stack.enter_context(_open_zstd_writer(file))
+        archive = stack.enter_context(
+            tarfile.open(fileobj=compressed, mode="w|", format=tarfile.GNU_FORMAT)
+        )
+        for relative_path, file_stat in _walk_sysroot(root):
+            info = tarfile.TarInfo(relative_path)
+            info.mode = file_stat.st_mode & 0o7777
+            info.mtime = 0
+            path = root / relative_path
+            if os.path.islink(path):
+                info.type = tarfile.SYMTYPE
+                info.linkname = os.readlink(path)
+                archive.addfile(info)
+            elif os.path.isdir(path):
+                info.type = tarfile.DIRTYPE
+                archive.addfile(info)
+            elif relative_path == MANIFEST_NAME:
+                # 計測値は生成ごとに変わるため、アーティファクトには含めない。
+                manifest = json.loads(path.read_text(encoding="utf-8"))
+                manifest.pop("metrics", None)
+                data = (json.dumps(manifest, indent=2, sort_keys=True) + "\n").encode("utf-8")
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+            else:
+                info.mtime = int(file_stat.st_mtime)
+                info.size = file_stat.st_size
+                with path.open("rb") as source:
+                    archive.addfile(info, source)
+
+
+def export_sysroot_artifact(config: SysrootConfig, sysroot_dir: Path, artifact_dir: Path) -> Path:
+    """生成済みの sysroot を 1 つの .tar.zst にまとめ、artifact_dir へ保存する。
+
+    設定と一致する manifest を持つ sysroot だけを対象にする。
+    同じ名前で sha256sum 形式のハッシュファイル (.sha256) も書き出す。
+    """
+    manifest = _read_manifest(sysroot_dir)
+    if (
+        manifest is None
+        or manifest.get("format_version") != MANIFEST_VERSION
+        or manifest.get("fingerprint") != sysroot_config_fingerprint(config)
+    ):
+        raise SysrootBuildError(f"Sysroot does not match the current config: {sysroot_dir}")
+    artifact_dir.mkdir(parents=True, exist_ok=True)
+    name = sysroot_artifact_name(config)
+    artifact_path = artifact_dir / name
+    # 書き込み途中のファイルを別のプロセスが取得しないよう、一時ファイルから rename する。
+    with tempfile.NamedTemporaryFile(
+        dir=artifact_dir, prefix=f".{name}-", delete=False
+    ) as temporary_file:
+        temporary_path = Path(temporary_file.name)
+    try:
+        with temporary_path.open("wb") as file:
+            _pack_sysroot(sysroot_dir, cast(BinaryIO, file))
+        temporary_path.chmod(0o644)
+        hexdigest = _hash_file(temporary_path, "sha256")
+        os.replace(temporary_path, artifact_path)
+    except BaseException:
+        temporary_path.unlink(missing_ok=True)
+        raise
+    artifact_path.with_name(f"{name}.sha256").write_text(f"{hexdigest}  {name}\n", encoding="utf-8")
+    logger.info("Exported sysroot artifact: %s", artifact_path)
+    return artifact_path
+
+
+@contextmanager
+def _open_artifact(source: str, name: str) -> Iterator[BinaryIO | None]:
+    # source はアーティファクトを置いたディレクトリか、HTTP(S) サーバーのベース URL。
+    # 見つからない場合は None を返す。
+    if urlparse(source).scheme in ("http", "https"):
+        url = f"{source.rstrip('/')}/{name}"
+        try:
+            response = urllib.request.urlopen(url, timeout=60)
+        except urllib.error.HTTPError as error:
+            if error.code != 404:
+                raise
+            yield None
+            return
+        with response:
+            yield cast(BinaryIO, response)
+        return
+    path = Path(source) / name
+    if not path.is_file():
+        yield None
+        return
+    with path.open("rb") as file:
+        yield file
+
+
+def _restore_sysroot_artifact(
+    config: SysrootConfig, source: str, new_root: Path, fingerprint: str
+) -> bool:
+    # アーティファクトを new_root へ展開する。見つからない場合は False を返す。
+    # 展開しながらハッシュを計算し、.sha256 と一致しなければ展開結果ごと破棄させる。
+    name = sysroot_artifact_name(config)
+    with _open_artifact(source, f"{name}.sha256") as checksum_file:
+        if checksum_file is None:
+            return False
+        expected = checksum_file.read().decode("ascii").split()[0]
+    with _open_artifact(source, name) as stream:
+        if stream is None:
+            return False
+        logger.info("Restoring sysroot artifact: %s/%s", source.rstrip("/"), name)
+        reader = _HashingReader(stream, "sha256")
+        with ExitStack() as stack:
+            decompressed = stack.enter_context(_open_zstd_stream(cast(BinaryIO, reader)))
+            archive = stack.enter_context(tarfile.open(fileobj=decompressed, mode="r|"))
+            _extract_tar_members(archive, new_root, name, None)
+        # tar の終端以降に残ったバイトもハッシュに含める。
+        while reader.read(1024 * 1024):
+            pass
+    if reader.digest.hexdigest() != expected:
+        raise SysrootBuildError(f"Sysroot artifact checksum mismatch: {name}")
+    manifest = _read_manifest(new_root)
+    if manifest is None or manifest.get("fingerprint") != fingerprint:
+        raise SysrootBuildError(f"Sysroot artifact does not match the current config: {name}")
+    return True
+
+
+def _install_sysroot_artifact(
+    config: SysrootConfig, source: str, output_dir: Path, fingerprint: str
+) -> bool:
+    # アーティファクトから sysroot を復元して output_dir と入れ替える。
+    # 取得や検証に失敗した場合は警告だけを出し、呼び出し側で apt による生成へ切り替えさせる。
+    with tempfile.TemporaryDirectory(
+        prefix=f".{output_dir.name}-", dir=output_dir.parent
+    ) as temporary_dir_value:
+        temporary_dir = Path(temporary_dir_value)
+        temporary_dir.chmod(0o755)
+        new_root = temporary_dir / "rootfs"
+        new_root.mkdir()
+        try:
+            restored = _restore_sysroot_artifact(config, source, new_root, fingerprint)
+        except (OSError, tarfile.TarError, SysrootBuildError) as error:
+            logger.warning("Failed to restore sysroot artifact; building with apt: %s", error)
+            return False
+        if not restored:
+            logger.info("Sysroot artifact was not found: %s", source)
+            return False
+        _install_completed_sysroot(new_root, output_dir)
+    logger.info("Restored sysroot: %s", output_dir)
+    return True
+
+
+def _export_sysroot_artifact_if_missing(
+    config: SysrootConfig, sysroot_dir: Path, artifact_dir: Path
+) -> None:
+    if not (artifact_dir / sysroot_artifact_name(config)).is_file():
+        export_sysroot_artifact(config, sysroot_dir, artifact_dir)
+
+
+def _update_sysroot(
+    previous_root: Path,
+    new_root: Path,
+    previous: dict[str, tuple[str, list[str]]],
+    packages: list[_DebPackage],
+    stage: Callable[[list[_DebPackage]], Iterator[tuple[str, Path, list[_IndexEntry]]]],
+) -> tuple[dict[str, list[str]], dict[str, str]]:
+    """既存の sysroot を元に、deb の差分だけを反映した sysroot を new_root に作る。
+
+    deb ごとのパス一覧と、今回展開したファイルのハッシュを返す。
+    stage は deb を staging ディレクトリへ展開し、_stage_debs と同じ形式で返す関数。
+    既存の sysroot はハードリンクで new_root へ複製してから変更するため、
+    出力先は入れ替えの瞬間まで元の状態のまま残る。
+    """
+    current = {package.filename: package for package in packages}
+    kept = {
+        name
+        for name, (hash_value, _) in previous.items()
+        if name in current and current[name].hash == hash_value
+    }
+    removed = set(previous) - kept
+    added = [package for package in packages if package.filename not in kept]
+    logger.info(
+        "Updating sysroot incrementally: %d kept, %d removed, %d added",
+        len(kept),
+        len(removed),
+        len(added),
+    )
+
+    # 展開先のファイルは統合時に rename で置き換わるだけなので、
+    # ハードリンクで複製しても既存の sysroot の中身は書き換わらない。
+    shutil.copytree(
+        previous_root, new_root, symlinks=True, copy_function=os.link, dirs_exist_ok=True
+    )
+    (new_root / MANIFEST_NAME).unlink(missing_ok=True)
+
+    staged = list(stage(added))
+    changed_paths = {path for name in removed for path in previous[name][1]}
+    changed_paths.update(
+        entry.path for _, _, entries in staged for entry in entries if entry.kind != "dir"
+    )
+    dirty = _dirty_packages(
+        {name: previous[name][1] for name in kept},
+        {path for path in changed_paths if not path.endswith("/")},
+    )
+    if dirty:
+        logger.info("Re-extracting %d packages sharing paths with changes", len(dirty))
+        dirty_packages = [package for package in packages if package.filename in dirty]
+        staged.extend(stage(dirty_packages))
+
+    remaining_directories = {
+        path for name in kept - dirty for path in previous[name][1] if path.endswith("/")
+    }
+    remaining_directories.update(
+        f"{entry.path}/" for _, _, entries in staged for entry in entries if entry.kind == "dir"
+    )
+    _remove_package_paths(
+        new_root,
+        (path for name in sorted(removed | dirty) for path in previous[name][1]),
+        remaining_directories,
+    )
+    # 全体を生成する場合と同じ結果になるよう、再展開分もファイル名順に統合する。
+    staged.sort(key=lambda item: item[0])
+    contents = {name: previous[name][1] for name in kept - dirty}
+    merged = _merge_staged_debs(staged, new_root)
+    contents.update((name, _entry_paths(entries)) for name, entries in merged.items())
+    return contents, _entry_hashes(merged.values())
+
+
+def build_sysroot(
+    config: SysrootConfig,
+    output_dir: Path,
+    *,
+    force: bool = False,
+    incremental: bool = False,
+    jobs: int | None = None,
+    cache_dir: Path | None = None,
+    cache_max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+    artifact_source: str | None = None,
+    artifact_dir: Path | None = None,
+    metrics_path: Path | None = None,
+) -> bool:
     """設定に従って sysroot を output_dir へ生成する。
 
     一致する manifest を持つ sysroot が既にあれば再生成せず False を返す。
     実際に生成した場合は True を返す。設定と一致しない既存の出力は、
     force が指定されない限り黙って削除も再利用もせずエラーにする。
+    jobs は deb を並列に展開するワーカー数で、省略時は CPU 数を使う。
+
+    incremental を指定すると、設定と一致しない既存の sysroot を作り直す代わりに、
+    manifest に記録した deb の一覧との差分だけを展開・削除して更新する。
+
+    cache_dir を指定すると、ダウンロードした deb をファイル名とハッシュをキーに保存し、
+    別の設定や再生成でも再ダウンロードせずに使い回す。キャッシュは複数の設定や
+    同時に動くプロセスから共有してよく、cache_max_bytes を超えた分は古いものから削除する。
+    APT のインデックスもリポジトリごとに cache_dir へ保存し、同じリポジトリを参照する
+    設定の間で共有する。
+
+    artifact_source にはアーティファクトを置いたディレクトリか HTTP(S) サーバーの URL を指定する。
+    設定と一致するアーティファクトがあれば、apt を使わずにそれを展開する。
+    artifact_dir を指定すると、完成した sysroot をアーティファクトとして書き出す。
+
+    生成した場合は段階ごとの所要時間、ダウンロード量、ファイル数を manifest の metrics に記録し、
+    metrics_path を指定するとその内容を JSON ファイルにも書き出す。
+
+    置き換えた既存の出力は output_dir と同じ親ディレクトリの .trash へ移し、
+    完了を待たずにバックグラウンドで削除する。
     """
+    start = time.monotonic()
+    metrics = _BuildMetrics()
+    # 前回の実行で削除しきれなかった古い sysroot があれば、バックグラウンドで削除する。
+    empty_trash(output_dir.parent / TRASH_DIR_NAME, background=True)
     fingerprint = sysroot_config_fingerprint(config)
     manifest = _read_manifest(output_dir)
     if (
@@ -427,77 +2351,351 @@ def build_sysroot(config: SysrootConfig, output_dir: Path, *, force: bool = Fals
         and manifest.get("format_version") == MANIFEST_VERSION
         and manifest.get("fingerprint") == fingerprint
     ):
-        logging.info("Reusing sysroot: %s", output_dir)
+        # 生成後に手作業で削除・変更されたファイルがあれば、再利用せずにエラーにする。
+        # ファイル一覧のない manifest は照合できないため、再利用しない。
+        index = _manifest_files(manifest)
+        if index is None:
+            raise SysrootBuildError(
+                f"Sysroot manifest has no file index; rebuild with --force: {output_dir}"
+            )
+        problems = _verify_sysroot_files(output_dir, *index, _default_jobs())
+        if problems:
+            for problem in problems[:20]:
+                logger.warning("Modified sysroot file: %s", problem)
+            if len(problems) > 20:
+                logger.warning("... and %d more", len(problems) - 20)
+            raise SysrootBuildError(
+                f"Sysroot has been modified since it was built: {output_dir}; use --force"
+            )
+        logger.info("Reusing sysroot: %s", output_dir)
+        if artifact_dir is not None:
+            _export_sysroot_artifact_if_missing(config, output_dir, artifact_dir)
         return False
-    if not force and (output_dir.exists() or output_dir.is_symlink()):
+    # 差分更新の元にできるのは、同じ生成形式で作られた実体のディレクトリだけ。
+    # manifest を持つ sysroot はこのモジュールが生成したものなので、
+    # 差分更新できない場合は全体を生成し直して置き換える。
+    # 展開済みの deb をそのまま残すため、prune の設定が同じ場合に限る。
+    # 手作業で変更されたファイルを引き継がないよう、ファイル一覧との照合にも通る必要がある。
+    previous = None
+    previous_files: dict[str, tuple[int, int, str]] = {}
+    if (
+        incremental
+        and not force
+        and manifest is not None
+        and manifest.get("format_version") == MANIFEST_VERSION
+        and manifest.get("prune") == _prune_payload(config)
+        and output_dir.is_dir()
+        and not output_dir.is_symlink()
+    ):
+        previous = _manifest_packages(manifest)
+        index = _manifest_files(manifest)
+        if index is not None:
+            if _verify_sysroot_files(output_dir, *index, _default_jobs()):
+                logger.info("Existing sysroot has been modified: %s", output_dir)
+                previous = None
+            else:
+                previous_files = index[0]
+    if incremental and manifest is not None and previous is None:
+        logger.info("Cannot update sysroot incrementally; rebuilding: %s", output_dir)
+    replaceable = force or (incremental and manifest is not None)
+    if not replaceable and (output_dir.exists() or output_dir.is_symlink()):
         raise SysrootBuildError(
             f"Existing sysroot does not match the current config: {output_dir}; use --force"
         )
 
-    apt_get = _require_command("apt-get")
-    dpkg_deb = _require_command("dpkg-deb")
     output_dir.parent.mkdir(parents=True, exist_ok=True)
+    if artifact_source is not None and _install_sysroot_artifact(
+        config, artifact_source, output_dir, fingerprint
+    ):
+        if artifact_dir is not None:
+            _export_sysroot_artifact_if_missing(config, output_dir, artifact_dir)
+        return True
+
+    jobs = _default_jobs() if jobs is None else jobs
+    keep = _prune_matcher(config.prune)
 
     # 作業ディレクトリは output_dir と同じ親に作り、
     # 完成後の rename による入れ替えが同一ファイルシステム内で完結するようにする。
-    with tempfile.TemporaryDirectory(
-        prefix=f".{output_dir.name}-", dir=output_dir.parent
-    ) as temporary_dir_value:
+    with (
+        tempfile.TemporaryDirectory(
+            prefix=f".{output_dir.name}-", dir=output_dir.parent
+        ) as temporary_dir_value,
+        _HttpConnectionPool() as pool,
+    ):
         temporary_dir = Path(temporary_dir_value)
         # TemporaryDirectory は 0700 で作られるため、
         # sysroot をそのまま参照しても支障がないよう権限を緩める。
         temporary_dir.chmod(0o755)
         work_dir = temporary_dir / "apt"
         new_root = temporary_dir / "rootfs"
+        staging_root = temporary_dir / "staging"
         work_dir.mkdir()
         new_root.mkdir()
-        _write_apt_files(config, work_dir)
 
-        environment = os.environ.copy()
-        environment["APT_CONFIG"] = str(work_dir / "apt.conf")
-        apt_options = _apt_options(work_dir)
-        _run_command([apt_get, *apt_options, "update"], environment=environment)
-        # --download-only により、依存解決とダウンロードだけを apt-get に任せる。
-        # インストール（＝maintainer script の実行）はしないので root 権限が要らない。
-        _run_command(
-            [
-                apt_get,
-                *apt_options,
-                "--download-only",
-                "--yes",
-                "--no-install-recommends",
-                "--no-install-suggests",
-                "install",
-                *config.packages,
-            ],
-            environment=environment,
-        )
+        if config.lock is not None:
+            # lockfile がある場合は apt-get update も依存解決も行わず、固定した deb を直接取得する。
+            packages = sorted(
+                (
+                    _DebPackage(
+                        url=package.url,
+                        filename=package.filename,
+                        size=package.size,
+                        hash=f"SHA256:{package.sha256}",
+                    )
+                    for package in config.lock
+                ),
+                key=lambda package: package.filename,
+            )
+
+            # ダウンロードしながら展開し、ダウンロードと展開を重ねる。
+            def stage(
+                targets: list[_DebPackage],
+            ) -> Iterator[tuple[str, Path, list[_IndexEntry]]]:
+                return _stream_stage_debs(
+                    pool, targets, staging_root, jobs, keep, cache_dir, cache_max_bytes, metrics
+                )
 
-        # ダウンロード済みの deb をすべて sysroot へ展開する。
-        # dpkg-deb --extract はファイルを取り出すだけで maintainer script を実行しない。
-        archive_dir = work_dir / "state" / "cache" / "archives"
-        deb_files = sorted(archive_dir.glob("*.deb"))
-        if not deb_files:
-            raise SysrootBuildError(f"No deb packages were downloaded for: {config.name}")
-        logging.info("Extracting %d packages", len(deb_files))
-        for deb_file in deb_files:
-            _run_command([dpkg_deb, "--extract", str(deb_file), str(new_root)], log_command=False)
-
-        _postprocess_sysroot(new_root, config.triplet)
+        else:
+            with metrics.phase("update"):
+                apt_get, apt_options, environment = _prepare_apt(config, work_dir, cache_dir)
+            # 依存解決だけを apt-get に任せ、必要な deb の URL とハッシュを得る。
+            # インストール（＝maintainer script の実行）はしないので root 権限が要らない。
+            with metrics.phase("resolve"):
+                packages = _resolve_packages(apt_get, apt_options, environment, config.packages)
+            if not packages:
+                raise SysrootBuildError(f"No deb packages were resolved for: {config.name}")
+            archive_dir = work_dir / "state" / "cache" / "archives"
+
+            def stage(
+                targets: list[_DebPackage],
+            ) -> Iterator[tuple[str, Path, list[_IndexEntry]]]:
+                with metrics.phase("download"):
+                    deb_files = _download_packages(
+                        apt_get,
+                        apt_options,
+                        environment,
+                        targets,
+                        archive_dir,
+                        cache_dir,
+                        cache_max_bytes,
+                        metrics,
+                    )
+                return _stage_debs(deb_files, staging_root, jobs, keep)
+
+        # deb を sysroot へ展開する。
+        # data.tar.* の中身を取り出すだけで、maintainer script は実行しない。
+        with metrics.phase("extract"):
+            if previous is not None:
+                contents, hashes = _update_sysroot(output_dir, new_root, previous, packages, stage)
+                # 残した deb の絶対パスリンクも、今回追加された deb によって
+                # 張り替えられるようになる場合があるため、sysroot 全体を走査する。
+                symlinks = None
+            else:
+                logger.info("Extracting %d packages with %d workers", len(packages), jobs)
+                # 展開が完了したものから順に統合し、展開と統合を並行させる。
+                extracted = _merge_staged_debs(stage(packages), new_root)
+                contents = {name: _entry_paths(entries) for name, entries in extracted.items()}
+                hashes = _entry_hashes(extracted.values())
+                # 展開時に記録した symlink だけを後処理の対象にし、sysroot 全体の走査を避ける。
+                symlinks = [
+                    entry.path
+                    for entries in extracted.values()
+                    for entry in entries
+                    if entry.kind == "symlink"
+                ]
+
+        with metrics.phase("postprocess"):
+            _postprocess_sysroot(new_root, config.triplet, symlinks)
+        with metrics.phase("index"):
+            files, symlink_targets = _index_sysroot_files(new_root, hashes, previous_files, jobs)
         # 生成が最後まで完了した sysroot にだけ manifest を書き込む。
         # 途中で失敗した出力には manifest がないため、誤って再利用されることはない。
-        manifest_value = {
+        # packages には deb ごとのパス一覧を記録し、次回の差分更新に使う。
+        # files と symlinks は再利用時や verify_sysroot での照合に使う。
+        manifest_value: dict[str, object] = {
             "format_version": MANIFEST_VERSION,
             "fingerprint": fingerprint,
             "name": config.name,
             "arch": config.arch,
             "triplet": config.triplet,
-            "deb_files": [deb_file.name for deb_file in deb_files],
+            "prune": _prune_payload(config),
+            "deb_files": [package.filename for package in packages],
+            "packages": [
+                {
+                    "filename": package.filename,
+                    "hash": package.hash,
+                    "paths": contents[package.filename],
+                }
+                for package in packages
+            ],
+            "files": files,
+            "symlinks": symlink_targets,
+            "metrics": metrics.to_json(time.monotonic() - start, files, symlink_targets),
         }
-        (new_root / MANIFEST_NAME).write_text(
-            json.dumps(manifest_value, indent=2, sort_keys=True) + "\n", encoding="utf-8"
+        _write_manifest(new_root, manifest_value)
+        with metrics.phase("install"):
+            _install_completed_sysroot(new_root, output_dir)
+
+    # 入れ替えまでを含めた計測値で manifest を書き直す。
+    total_seconds = time.monotonic() - start
+    manifest_value["metrics"] = metrics.to_json(total_seconds, files, symlink_targets)
+    _write_manifest(output_dir, manifest_value)
+    if metrics_path is not None:
+        metrics_path.parent.mkdir(parents=True, exist_ok=True)
+        metrics_path.write_text(
+            json.dumps(
+                {
+                    "name": config.name,
+                    "fingerprint": fingerprint,
+                    "finished_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                    "metrics": manifest_value["metrics"],
+                },
+                indent=2,
+                sort_keys=True,
+            )
+            + "\n",
+            encoding="utf-8",
         )
-        _install_completed_sysroot(new_root, output_dir)
-
-    logging.info("Built sysroot: %s", output_dir)
+    logger.info("Built sysroot in %.1f seconds: %s", total_seconds, output_dir)
+    if artifact_dir is not None:
+        export_sysroot_artifact(config, output_dir, artifact_dir)
     return True
+
+
+def lock_sysroot(
+    config: SysrootConfig, lock_path: Path, *, cache_dir: Path | None = None
+) -> list[LockedPackage]:
+    """設定の依存を apt で解決し、必要な deb を固定した lockfile を lock_path へ書き出す。
+
+    以降の build_sysroot は load_sysroot_lock で読み込んだ設定を渡すことで、
+    apt-get update と依存解決を省略し、日付が変わっても同じ deb から sysroot を作る。
+    cache_dir を指定すると、build_sysroot と APT のインデックスを共有する。
+    """
+    with tempfile.TemporaryDirectory(prefix="sysroot-lock-") as temporary_dir_value:
+        work_dir = Path(temporary_dir_value)
+        apt_get, apt_options, environment = _prepare_apt(config, work_dir, cache_dir)
+        packages = _resolve_packages(apt_get, apt_options, environment, config.packages)
+        if not packages:
+            raise SysrootBuildError(f"No deb packages were resolved for: {config.name}")
+
+    locked = [
+        LockedPackage(
+            url=package.url,
+            filename=package.filename,
+            version=package.version,
+            size=package.size,
+            sha256=package.hash.removeprefix("SHA256:"),
+        )
+        for package in packages
+    ]
+    lock_value = {
+        "format_version": LOCK_VERSION,
+        "name": config.name,
+        "fingerprint": sysroot_config_fingerprint(replace(config, lock=None)),
+        "packages": [
+            {
+                "url": package.url,
+                "filename": package.filename,
+                "version": package.version,
+                "size": package.size,
+                "sha256": package.sha256,
+            }
+            for package in locked
+        ],
+    }
+    temporary_path = lock_path.with_name(f".{lock_path.name}.tmp")
+    temporary_path.write_text(
+        json.dumps(lock_value, indent=2, sort_keys=True) + "\n", encoding="utf-8"
+    )
+    os.replace(temporary_path, lock_path)
+    logger.info("Locked %d packages: %s", len(locked), lock_path)
+    return locked
+
+
+def _dependency_groups(value: str) -> list[list[str]]:
+    # "libc6 (>= 2.34), libfoo1 | libbar1, python3:any" のような Depends の値を
+    # 選択肢ごとのパッケージ名のリストに分ける。バージョン制約やアーキテクチャ修飾は捨てる。
+    groups = []
+    for group in value.split(","):
+        names = []
+        for alternative in group.split("|"):
+            name = re.split(r"[\s(\[<]", alternative.strip(), maxsplit=1)[0].split(":")[0]
+            if name:
+                names.append(name)
+        if names:
+            groups.append(names)
+    return groups
+
+
+def explain_sysroot(
+    config: SysrootConfig, *, cache_dir: Path | None = None
+) -> list[PackageExplanation]:
+    """依存解決の結果に含まれる deb ごとに、サイズとそれを引き込んだ packages の要素を返す。
+
+    exclude_packages で取り除いたパッケージも excluded=True として含める。
+    結果は deb のサイズが大きい順に並ぶ。lockfile は使わず、常に apt で依存を解決する。
+    """
+    with tempfile.TemporaryDirectory(prefix="sysroot-explain-") as temporary_dir_value:
+        work_dir = Path(temporary_dir_value)
+        apt_get, apt_options, environment = _prepare_apt(config, work_dir, cache_dir)
+        packages = _resolve_packages(apt_get, apt_options, environment, config.packages)
+        records = list(_package_records(apt_options, environment, packages).values())
+        excluded_records = []
+        if config.exclude_packages:
+            output = _run_command_output(
+                [
+                    _require_command("apt-cache"),
+                    *apt_options,
+                    "show",
+                    "--no-all-versions",
+                    *config.exclude_packages,
+                ],
+                environment=environment,
+            )
+            excluded_records = _parse_apt_records(output)
+
+    # 仮想パッケージは Provides で実体のパッケージへ読み替える。
+    providers: dict[str, str] = {}
+    for record in [*records, *excluded_records]:
+        providers[record["Package"]] = record["Package"]
+    for record in [*records, *excluded_records]:
+        for provided, *_ in _dependency_groups(record.get("Provides", "")):
+            providers.setdefault(provided, record["Package"])
+    # 除外したパッケージの依存はたどらない。各依存は apt と同様に最初に満たせる選択肢を使う。
+    dependencies: dict[str, set[str]] = {record["Package"]: set() for record in excluded_records}
+    for record in records:
+        targets = set()
+        for field in ("Pre-Depends", "Depends"):
+            for group in _dependency_groups(record.get(field, "")):
+                provider = next((providers[name] for name in group if name in providers), None)
+                if provider is not None and provider != record["Package"]:
+                    targets.add(provider)
+        dependencies[record["Package"]] = targets
+
+    roots: dict[str, list[str]] = {name: [] for name in dependencies}
+    for root in config.packages:
+        start = providers.get(root)
+        if start is None:
+            continue
+        visited = {start}
+        pending = [start]
+        while pending:
+            name = pending.pop()
+            roots[name].append(root)
+            for dependency in dependencies[name] - visited:
+                visited.add(dependency)
+                pending.append(dependency)
+
+    excluded_names = {record["Package"] for record in excluded_records}
+    explanations = [
+        PackageExplanation(
+            name=record["Package"],
+            version=record.get("Version", ""),
+            size=int(record.get("Size", "0")),
+            installed_size=int(record.get("Installed-Size", "0")) * 1024,
+            roots=tuple(roots[record["Package"]]),
+            excluded=record["Package"] in excluded_names,
+        )
+        for record in [*records, *excluded_records]
+    ]
+    return sorted(explanations, key=lambda explanation: (-explanation.size, explanation.name))
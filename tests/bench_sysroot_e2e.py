@@ -0,0 +1,342 @@
+"""ローカルの APT リポジトリを相手に build_sysroot を最後まで実行し、段階ごとの所要時間を計測する。
+
+pytest の収集対象ではないため、次のように直接実行する。
+
+    python tests/bench_sysroot_e2e.py [--packages 300] [--files 20]
+
+署名付きの APT リポジトリを一時ディレクトリに合成し、自己署名証明書の HTTPS サーバーで配信する。
+ネットワークには接続せず、apt-get・gpg・openssl だけを使う。
+キャッシュなし、キャッシュへの初回保存、キャッシュあり、lockfile、再利用の順に生成し、
+manifest に記録された段階ごとの所要時間を表示する。
+"""
+
+from __future__ import annotations
+
+import argparse
+import functools
+import gzip
+import hashlib
+import http.server
+import io
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sysroot_builder import (
+    MANIFEST_NAME,
+    build_sysroot,
+    load_sysroot_config,
+    load_sysroot_lock,
+    lock_sysroot,
+    sysroot_lock_path,
+)
+
+REQUIRED_COMMANDS = ("apt-get", "gpg", "openssl")
+SUITE = "bench"
+TRIPLET = "aarch64-linux-gnu"
+META_PACKAGE = "bench-meta"
+PHASES = ("update", "resolve", "download", "extract", "postprocess", "index", "install")
+
+
+def missing_commands() -> list[str]:
+    return [name for name in REQUIRED_COMMANDS if shutil.which(name) is None]
+
+
+def tar_bytes(members: list[tuple[tarfile.TarInfo, bytes | None]]) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz", format=tarfile.GNU_FORMAT) as archive:
+        for info, data in members:
+            info.mtime = 1700000000
+            archive.addfile(info, io.BytesIO(data) if data is not None else None)
+    return buffer.getvalue()
+
+
+def ar_bytes(members: list[tuple[str, bytes]]) -> bytes:
+    result = [b"!<arch>\n"]
+    for name, data in members:
+        header = f"{name:<16}{0:<12}{0:<6}{0:<6}{100644:<8}{len(data):<10}`\n"
+        result.append(header.encode("ascii"))
+        result.append(data)
+        if len(data) % 2:
+            result.append(b"\n")
+    return b"".join(result)
+
+
+def build_deb(
+    name: str, depends: list[str], files_per_package: int, file_size: int
+) -> tuple[bytes, str]:
+    # ライブラリ、ヘッダー、pkg-config の定義と、後処理の対象になる絶対パスの
+    # symlink を含む deb と、その control ファイルの内容を返す。
+    lib_dir = f"usr/lib/{TRIPLET}"
+    members: list[tuple[tarfile.TarInfo, bytes | None]] = []
+    # files_per_package が 0 のメタパッケージは、依存関係だけを持つ空の deb にする。
+    if files_per_package > 0:
+        directories = ("usr", "usr/lib", lib_dir, f"{lib_dir}/pkgconfig", "usr/include")
+        for directory in (*directories, f"usr/include/{name}"):
+            info = tarfile.TarInfo(f"./{directory}/")
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            members.append((info, None))
+        # 圧縮の効かない決定的な中身にし、ダウンロード量が file_size に比例するようにする。
+        contents = {
+            f"{lib_dir}/{name}.so.1": hashlib.shake_256(name.encode("utf-8")).digest(file_size),
+            f"{lib_dir}/pkgconfig/{name}.pc": f"Name: {name}\nLibs: -l{name}\n".encode(),
+        }
+        for index in range(files_per_package - 2):
+            contents[f"usr/include/{name}/header{index}.h"] = f"int {name}_{index};\n".encode()
+        for path, data in contents.items():
+            info = tarfile.TarInfo(f"./{path}")
+            info.size = len(data)
+            info.mode = 0o644
+            members.append((info, data))
+        info = tarfile.TarInfo(f"./{lib_dir}/{name}.so")
+        info.type = tarfile.SYMTYPE
+        info.linkname = f"/{lib_dir}/{name}.so.1"
+        members.append((info, None))
+
+    control = [
+        f"Package: {name}",
+        "Version: 1.0-1",
+        "Architecture: arm64",
+        "Maintainer: bench <bench@example.invalid>",
+    ]
+    if depends:
+        control.append(f"Depends: {', '.join(depends)}")
+    control.append(f"Description: {name}")
+    control_text = "\n".join(control)
+    control_data = (control_text + "\n").encode("utf-8")
+    control_info = tarfile.TarInfo("./control")
+    control_info.size = len(control_data)
+    control_info.mode = 0o644
+    deb = ar_bytes(
+        [
+            ("debian-binary", b"2.0\n"),
+            ("control.tar.gz", tar_bytes([(control_info, control_data)])),
+            ("data.tar.gz", tar_bytes(members)),
+        ]
+    )
+    return deb, control_text
+
+
+def create_repository(root: Path, packages: int, files_per_package: int, file_size: int) -> Path:
+    """root に署名付きの APT リポジトリを作り、署名検証用の鍵のパスを返す。
+
+    META_PACKAGE が全パッケージに依存し、各パッケージはさらに 2 つ前までのパッケージに依存する。
+    """
+    gnupg_home = root / "gnupg"
+    gnupg_home.mkdir(mode=0o700, parents=True)
+    environment = dict(os.environ, GNUPGHOME=str(gnupg_home))
+    subprocess.run(
+        ["gpg", "--batch", "--passphrase", "", "--quick-gen-key", "bench@example.invalid"]
+        + ["ed25519", "sign", "never"],
+        env=environment,
+        check=True,
+        capture_output=True,
+    )
+    key_path = root / "key.gpg"
+    subprocess.run(
+        ["gpg", "--batch", "--yes", "--output", str(key_path), "--export", "bench@example.invalid"],
+        env=environment,
+        check=True,
+    )
+
+    public_dir = root / "public"
+    pool_dir = public_dir / "pool" / "main"
+    pool_dir.mkdir(parents=True)
+    names = [f"libbench{index:04d}" for index in range(packages)]
+    debs = {
+        name: build_deb(name, names[max(0, index - 2) : index], files_per_package, file_size)
+        for index, name in enumerate(names)
+    }
+    debs[META_PACKAGE] = build_deb(META_PACKAGE, names, 0, 0)
+    records = []
+    for name, (data, control) in debs.items():
+        filename = f"{name}_1.0-1_arm64.deb"
+        (pool_dir / filename).write_bytes(data)
+        records.append(
+            "\n".join(
+                [
+                    control,
+                    f"Installed-Size: {(len(data) + 1023) // 1024}",
+                    f"Filename: pool/main/{filename}",
+                    f"Size: {len(data)}",
+                    f"SHA256: {hashlib.sha256(data).hexdigest()}",
+                ]
+            )
+        )
+
+    dist_dir = public_dir / "dists" / SUITE
+    index_dir = dist_dir / "main" / "binary-arm64"
+    index_dir.mkdir(parents=True)
+    packages_data = ("\n\n".join(records) + "\n").encode("utf-8")
+    (index_dir / "Packages").write_bytes(packages_data)
+    (index_dir / "Packages.gz").write_bytes(gzip.compress(packages_data, mtime=0))
+    release = [
+        f"Suite: {SUITE}",
+        f"Codename: {SUITE}",
+        "Date: Sat, 17 Oct 2026 00:00:00 UTC",
+        "Architectures: arm64",
+        "Components: main",
+        "SHA256:",
+    ]
+    for name in ("Packages", "Packages.gz"):
+        data = (index_dir / name).read_bytes()
+        release.append(f" {hashlib.sha256(data).hexdigest()} {len(data)} main/binary-arm64/{name}")
+    (dist_dir / "Release").write_text("\n".join(release) + "\n", encoding="utf-8")
+    subprocess.run(
+        ["gpg", "--batch", "--yes", "--clearsign", "--output", str(dist_dir / "InRelease")]
+        + [str(dist_dir / "Release")],
+        env=environment,
+        check=True,
+        capture_output=True,
+    )
+    return key_path
+
+
+def create_certificate(directory: Path) -> tuple[Path, Path]:
+    # 127.0.0.1 向けの自己署名証明書を作る。
+    # SSL_CERT_FILE に指定して apt と Python の両方に信頼させる。
+    certificate = directory / "cert.pem"
+    key = directory / "key.pem"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1"]
+        + ["-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1"]
+        + ["-keyout", str(key), "-out", str(certificate)],
+        check=True,
+        capture_output=True,
+    )
+    return certificate, key
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+@contextmanager
+def serve_https(directory: Path, certificate: Path, key: Path) -> Iterator[str]:
+    handler = functools.partial(QuietHandler, directory=str(directory))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certificate, key)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"https://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def write_config(path: Path, url: str, key_path: Path) -> None:
+    config = {
+        "name": "bench",
+        "arch": "arm64",
+        "triplet": TRIPLET,
+        "packages": [META_PACKAGE],
+        "repositories": [
+            {"url": url, "suite": SUITE, "components": ["main"], "signed_by": str(key_path)}
+        ],
+    }
+    path.write_text(json.dumps(config), encoding="utf-8")
+
+
+@contextmanager
+def local_repository(
+    root: Path, packages: int, files_per_package: int, file_size: int
+) -> Iterator[Path]:
+    """合成したリポジトリを HTTPS で配信し、それを参照する設定ファイルのパスを返す。
+
+    配信中は SSL_CERT_FILE を自己署名証明書に向ける。
+    """
+    key_path = create_repository(root, packages, files_per_package, file_size)
+    certificate, key = create_certificate(root)
+    previous = os.environ.get("SSL_CERT_FILE")
+    os.environ["SSL_CERT_FILE"] = str(certificate)
+    try:
+        with serve_https(root / "public", certificate, key) as url:
+            config_path = root / "bench.json"
+            write_config(config_path, url, key_path)
+            yield config_path
+    finally:
+        if previous is None:
+            os.environ.pop("SSL_CERT_FILE", None)
+        else:
+            os.environ["SSL_CERT_FILE"] = previous
+
+
+def read_metrics(sysroot_dir: Path) -> dict[str, object]:
+    manifest = json.loads((sysroot_dir / MANIFEST_NAME).read_text(encoding="utf-8"))
+    return manifest.get("metrics", {})
+
+
+def print_row(label: str, seconds: float, metrics: dict[str, object]) -> None:
+    phases = metrics.get("phases", {})
+    assert isinstance(phases, dict)
+    download = metrics.get("download", {})
+    assert isinstance(download, dict)
+    columns = " ".join(
+        f"{phases[name]:>11.3f}" if name in phases else f"{'-':>11}" for name in PHASES
+    )
+    megabytes = download.get("bytes", 0) / 1e6
+    throughput = download.get("bytes_per_second", 0) / 1e6
+    print(f"{label:<12} {seconds:>8.3f} {columns} {megabytes:>8.1f} {throughput:>8.1f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--packages", type=int, default=300)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--file-size", type=int, default=64 * 1024)
+    parser.add_argument("--jobs", type=int)
+    args = parser.parse_args()
+    missing = missing_commands()
+    if missing:
+        sys.exit(f"Required commands are not installed: {', '.join(missing)}")
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        root = Path(temporary_dir)
+        start = time.perf_counter()
+        with local_repository(root, args.packages, args.files, args.file_size) as config_path:
+            print(f"repository: {args.packages} packages, {time.perf_counter() - start:.1f}s")
+            config = load_sysroot_config(config_path)
+            cache_dir = root / "cache"
+            output_dir = root / "rootfs"
+            lock_path = sysroot_lock_path(config_path)
+            scenarios = [
+                ("no-cache", config, {"cache_dir": None}),
+                ("cold-cache", config, {"cache_dir": cache_dir}),
+                ("warm-cache", config, {"cache_dir": cache_dir}),
+                ("lock", None, {"cache_dir": None}),
+                ("lock-cache", None, {"cache_dir": cache_dir}),
+            ]
+            header = " ".join(f"{name:>11}" for name in PHASES)
+            print(f"{'scenario':<12} {'total':>8} {header} {'MB':>8} {'MB/s':>8}")
+            for label, scenario_config, options in scenarios:
+                if scenario_config is None:
+                    if not lock_path.exists():
+                        lock_sysroot(config, lock_path, cache_dir=cache_dir)
+                    scenario_config = load_sysroot_lock(lock_path, config)
+                start = time.perf_counter()
+                build_sysroot(scenario_config, output_dir, force=True, jobs=args.jobs, **options)
+                print_row(label, time.perf_counter() - start, read_metrics(output_dir))
+            start = time.perf_counter()
+            build_sysroot(scenario_config, output_dir, jobs=args.jobs)
+            print(f"{'reuse':<12} {time.perf_counter() - start:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
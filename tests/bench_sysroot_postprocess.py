@@ -0,0 +1,78 @@
+"""sysroot の後処理 (_fix_absolute_symlinks) の所要時間を計測する。
+
+pytest の収集対象ではないため、次のように直接実行する。
+
+    python tests/bench_sysroot_postprocess.py [--entries 200000]
+
+合成した sysroot に対し、従来の rglob による走査、os.scandir による走査、
+展開時に記録した symlink の一覧を渡す場合の 3 通りを比較する。
+symlink はリンク先が存在しない絶対パスにして、何度実行してもツリーが変化しないようにする。
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sysroot_builder import _fix_absolute_symlinks
+
+FILES_PER_DIRECTORY = 50
+SYMLINK_RATIO = 20
+
+
+def create_tree(root: Path, entries: int) -> list[str]:
+    symlinks = []
+    for index in range(entries):
+        directory = f"usr/lib/d{index // FILES_PER_DIRECTORY // 40}/d{index // FILES_PER_DIRECTORY}"
+        if index % FILES_PER_DIRECTORY == 0:
+            (root / directory).mkdir(parents=True, exist_ok=True)
+        path = f"{directory}/f{index}"
+        if index % SYMLINK_RATIO == 0:
+            os.symlink(f"/usr/lib/missing/f{index}", root / path)
+            symlinks.append(path)
+        else:
+            (root / path).touch()
+    return symlinks
+
+
+def fix_absolute_symlinks_rglob(root: Path) -> None:
+    # 変更前の実装と同じく、全エントリに is_symlink を呼ぶ。
+    for path in root.rglob("*"):
+        if not path.is_symlink():
+            continue
+        target = Path(os.readlink(path))
+        if not target.is_absolute():
+            continue
+        target_in_sysroot = root / target.relative_to("/")
+        if not target_in_sysroot.exists():
+            continue
+
+
+def measure(label: str, function) -> None:
+    start = time.perf_counter()
+    function()
+    print(f"{label:>8}: {time.perf_counter() - start:.3f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=200000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        root = Path(temporary_dir)
+        symlinks = create_tree(root, args.entries)
+        print(f"entries: {args.entries}, symlinks: {len(symlinks)}")
+        measure("rglob", lambda: fix_absolute_symlinks_rglob(root))
+        measure("scandir", lambda: _fix_absolute_symlinks(root))
+        measure("index", lambda: _fix_absolute_symlinks(root, symlinks))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,630 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import pytest
+
+import run
+
+# パスと {ファイル名: 内容} を受け取り、その内容を最初のコミットにした git リポジトリを作って
+# コミットのハッシュを返す関数
+MakeGitRepo = Callable[[Path, dict[str, str]], str]
+
+
+@pytest.fixture
+def git_repo(monkeypatch: pytest.MonkeyPatch) -> MakeGitRepo:
+    for name in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv(f"GIT_{name}_NAME", "test")
+        monkeypatch.setenv(f"GIT_{name}_EMAIL", "test@example.com")
+
+    def make(path: Path, files: dict[str, str]) -> str:
+        path.mkdir(parents=True, exist_ok=True)
+        for name, content in files.items():
+            (path / name).write_text(content, encoding="utf-8")
+        run.cmd(["git", "init", "-q", str(path)])
+        run.cmd(["git", "-C", str(path), "add", "."])
+        run.cmd(["git", "-C", str(path), "commit", "-qm", "base"])
+        return run.cmdcap(["git", "-C", str(path), "rev-parse", "HEAD"])
+
+    return make
+
+
+def _git_log(dir: Path) -> list[str]:
+    return run.cmdcap(["git", "-C", str(dir), "log", "--format=%s"]).split("\n")
+
+
+@dataclass
+class RangeServer:
+    url: str
+    content: bytes
+    # 受け取ったリクエストの Range ヘッダー (指定がなければ None)
+    ranges: list[str | None] = field(default_factory=list)
+
+
+@pytest.fixture
+def range_server() -> Iterator[RangeServer]:
+    # Range リクエストに対応し、受け取った Range を記録する HTTP サーバー。
+    state = RangeServer(url="", content=hashlib.shake_256(b"webrtc-build").digest(256 * 1024))
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            state.ranges.append(self.headers.get("Range"))
+            content = state.content
+            value = self.headers.get("Range")
+            if value is None:
+                self.send_response(200)
+                body = content
+            else:
+                start_value, end_value = value.removeprefix("bytes=").split("-")
+                start = int(start_value)
+                end = int(end_value) if end_value else len(content) - 1
+                if start >= len(content):
+                    self.send_response(416)
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+                body = content[start : end + 1]
+            self.send_header("ETag", '"v1"')
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: object) -> None:
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    state.url = f"http://127.0.0.1:{server.server_port}/tool.exe"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield state
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_download_reuses_cache_without_network(tmp_path: Path, range_server: RangeServer) -> None:
+    # 一度取得した URL はキャッシュから取り出し、途中で途切れた出力は置き換える。
+    cache_dir = str(tmp_path / "cache")
+    output_path = run.download(range_server.url, str(tmp_path), cache_dir=cache_dir)
+    Path(output_path).write_bytes(range_server.content[:100])
+    again = run.download(range_server.url, str(tmp_path), "copy.exe", cache_dir=cache_dir)
+    run.download(range_server.url, str(tmp_path), cache_dir=cache_dir)
+
+    assert output_path == str(tmp_path / "tool.exe")
+    assert range_server.ranges == [None]
+    assert Path(again).read_bytes() == range_server.content
+    assert Path(output_path).read_bytes() == range_server.content
+    assert not any((tmp_path / "cache" / "partial").iterdir())
+
+
+def test_download_rejects_sha256_mismatch(tmp_path: Path, range_server: RangeServer) -> None:
+    with pytest.raises(run.DownloadError, match="SHA256 mismatch"):
+        run.download(range_server.url, str(tmp_path), sha256="0" * 64, cache_dir=str(tmp_path))
+
+    assert not (tmp_path / "tool.exe").exists()
+    assert not any((tmp_path / "objects").iterdir())
+    assert not any((tmp_path / "partial").iterdir())
+
+
+def test_download_resumes_partial_file(tmp_path: Path, range_server: RangeServer) -> None:
+    cache_dir = tmp_path / "cache"
+    partial_path = cache_dir / "partial" / hashlib.sha256(range_server.url.encode()).hexdigest()
+    partial_path.parent.mkdir(parents=True)
+    partial_path.write_bytes(range_server.content[:1000])
+    Path(f"{partial_path}.meta").write_text(json.dumps({"validator": '"v1"'}), encoding="utf-8")
+    expected = hashlib.sha256(range_server.content).hexdigest()
+
+    output_path = run.download(
+        range_server.url, str(tmp_path), sha256=expected, cache_dir=str(cache_dir)
+    )
+
+    assert range_server.ranges == ["bytes=1000-"]
+    assert Path(output_path).read_bytes() == range_server.content
+
+
+def test_download_fetches_large_file_in_parallel_chunks(
+    tmp_path: Path, range_server: RangeServer, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(run, "DOWNLOAD_PARALLEL_MIN_SIZE", 1024)
+    output_path = run.download(range_server.url, str(tmp_path), cache_dir=str(tmp_path), jobs=4)
+
+    assert Path(output_path).read_bytes() == range_server.content
+    assert sorted(value for value in range_server.ranges if value != "bytes=0-0") == [
+        "bytes=0-65535",
+        "bytes=131072-196607",
+        "bytes=196608-262143",
+        "bytes=65536-131071",
+    ]
+    assert os.listdir(tmp_path / "partial") == []
+
+
+def test_download_rejects_sha256_mismatch_in_parallel_chunks(
+    tmp_path: Path, range_server: RangeServer, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    # 並列ダウンロードでハッシュが一致しない場合も、途中のファイルを残さずにエラーにする。
+    monkeypatch.setattr(run, "DOWNLOAD_PARALLEL_MIN_SIZE", 1024)
+    with pytest.raises(run.DownloadError, match="SHA256 mismatch"):
+        run.download(
+            range_server.url, str(tmp_path), sha256="0" * 64, cache_dir=str(tmp_path), jobs=4
+        )
+
+    assert not (tmp_path / "tool.exe").exists()
+    assert os.listdir(tmp_path / "objects") == []
+    assert os.listdir(tmp_path / "partial") == []
+
+
+@pytest.fixture
+def keepalive_server() -> Iterator[tuple[str, list[str], list[int]]]:
+    # 接続数とリクエストのパスを記録する HTTP/1.1 サーバー。
+    paths: list[str] = []
+    connections: list[int] = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self) -> None:
+            super().setup()
+            connections.append(1)
+
+        def do_GET(self) -> None:
+            paths.append(self.path)
+            body = self.path.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: object) -> None:
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}", paths, connections
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_http_client_reuses_connection_and_caches_responses(
+    tmp_path: Path, keepalive_server: tuple[str, list[str], list[int]]
+) -> None:
+    url, paths, connections = keepalive_server
+    with run.HttpClient(cache_dir=str(tmp_path), ttl=60) as client:
+        assert client.get(f"{url}/a") == "/a"
+        assert client.get(f"{url}/b?x=1") == "/b?x=1"
+        assert client.get(f"{url}/a") == "/a"
+    with run.HttpClient(cache_dir=str(tmp_path), offline=True) as client:
+        assert client.get(f"{url}/b?x=1") == "/b?x=1"
+        with pytest.raises(run.HttpClientError, match="not cached"):
+            client.get(f"{url}/c")
+
+    assert paths == ["/a", "/b?x=1"]
+    assert len(connections) == 1
+
+
+@pytest.mark.parametrize(
+    "entry",
+    [
+        {"url": "x", "body": "stale"},
+        {"url": "x", "fetched_at": 1e18},
+        {"url": "x", "fetched_at": "now", "body": "stale"},
+        {"url": "x", "fetched_at": 1e18, "body": None},
+        ["stale"],
+    ],
+)
+def test_http_client_refetches_broken_cache_entry(
+    tmp_path: Path, keepalive_server: tuple[str, list[str], list[int]], entry: object
+) -> None:
+    # 壊れたキャッシュのエントリは使わずに取得し直し、正しい内容で上書きする。
+    url, paths, _ = keepalive_server
+    cache_path = tmp_path / f"{hashlib.sha256(f'{url}/a'.encode()).hexdigest()}.json"
+    cache_path.write_text(json.dumps(entry), encoding="utf-8")
+    with (
+        run.HttpClient(cache_dir=str(tmp_path), offline=True) as client,
+        pytest.raises(run.HttpClientError, match="not cached"),
+    ):
+        client.get(f"{url}/a")
+    with run.HttpClient(cache_dir=str(tmp_path), ttl=60) as client:
+        assert client.get(f"{url}/a") == "/a"
+    with run.HttpClient(cache_dir=str(tmp_path), offline=True) as client:
+        assert client.get(f"{url}/a") == "/a"
+
+    assert paths == ["/a"]
+
+
+def test_version_list_replays_recorded_responses(
+    tmp_path: Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    # 記録したレスポンスだけを使い、ネットワークに接続せずに一覧を出力する。
+    milestones = [
+        {"milestone": 153, "webrtc_branch": "7300"},
+        {"milestone": 152, "webrtc_branch": "7250"},
+    ]
+    responses = {"https://chromiumdash.appspot.com/fetch_milestones": json.dumps(milestones)}
+    for index, m in enumerate(milestones):
+        branch = m["webrtc_branch"]
+        message = f"Fix\n\nCr-Commit-Position: refs/branch-heads/{branch}@{{#{index + 3}}}\n"
+        log = {"log": [{"commit": f"{index:040x}", "message": message}]}
+        url = f"https://webrtc.googlesource.com/src.git/+log/refs/branch-heads/{branch}"
+        url += "?format=JSON&n=1"
+        responses[url] = ")]}'\n" + json.dumps(log)
+    for url, body in responses.items():
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        (tmp_path / f"{key}.json").write_text(
+            json.dumps({"url": url, "fetched_at": 0, "body": body}), encoding="utf-8"
+        )
+
+    run.version_list(
+        argparse.Namespace(http_cache_dir=str(tmp_path), http_cache_ttl=0, offline=True)
+    )
+
+    assert capsys.readouterr().out.splitlines() == [
+        f"m153 7300 3 {0:040x}",
+        f"m152 7250 4 {1:040x}",
+    ]
+
+
+def test_read_gclient_cache_dir(tmp_path: Path) -> None:
+    # get_webrtc が .gclient に追記した cache_dir を、以降の fetch で読み戻せる。
+    assert run._read_gclient_cache_dir(str(tmp_path)) is None
+    cache_dir = str(tmp_path / "git cache")
+    (tmp_path / ".gclient").write_text(
+        f'solutions = [{{"name": "src"}}]\ncache_dir = {cache_dir!r}\n', encoding="utf-8"
+    )
+
+    assert run._read_gclient_cache_dir(str(tmp_path)) == cache_dir
+
+
+def test_webrtc_snapshot_key_depends_on_patches_and_target_os(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setitem(run.PATCHES, "android", ["a.patch"])
+    monkeypatch.setitem(run.PATCHES, "android_sdk", ["a.patch"])
+    monkeypatch.setitem(run.PATCHES, "ubuntu-24.04_x86_64", ["a.patch"])
+    (tmp_path / "a.patch").write_text("first", encoding="utf-8")
+    key = run.webrtc_snapshot_key(str(tmp_path), "abc", "android")
+
+    assert run.webrtc_snapshot_key(str(tmp_path), "abc", "android_sdk") == key
+    assert run.webrtc_snapshot_key(str(tmp_path), "abc", "ubuntu-24.04_x86_64") != key
+    assert run.webrtc_snapshot_key(str(tmp_path), "def", "android") != key
+    (tmp_path / "a.patch").write_text("second", encoding="utf-8")
+    assert run.webrtc_snapshot_key(str(tmp_path), "abc", "android") != key
+
+
+def test_get_webrtc_restores_snapshot(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # スナップショットがあれば fetch や gclient sync を行わずにソースを復元する。
+    monkeypatch.setitem(run.PATCHES, "ubuntu-24.04_x86_64", [])
+    snapshot_dir = str(tmp_path / "snapshots")
+    key = run.webrtc_snapshot_key(str(tmp_path), "abc", "ubuntu-24.04_x86_64")
+    original = tmp_path / "original"
+    (original / "src" / "api").mkdir(parents=True)
+    (original / "src" / "api" / "peer_connection.h").write_text("patched", encoding="utf-8")
+    (original / ".gclient").write_text("solutions = []\n", encoding="utf-8")
+    run.save_webrtc_snapshot(snapshot_dir, key, str(original))
+
+    webrtc_source_dir = tmp_path / "webrtc"
+    run.get_webrtc(
+        str(tmp_path),
+        str(tmp_path),
+        "abc",
+        "ubuntu-24.04_x86_64",
+        str(webrtc_source_dir),
+        snapshot_dir=snapshot_dir,
+    )
+
+    assert (webrtc_source_dir / "src" / "api" / "peer_connection.h").read_text() == "patched"
+    assert (webrtc_source_dir / ".gclient").exists()
+
+
+def test_fetch_webrtc_skips_sync_and_reapplies_changed_patches(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    caplog: pytest.LogCaptureFixture,
+    git_repo: MakeGitRepo,
+) -> None:
+    # gclient が使えない環境でも、同期済みの判定とパッチの差分だけで fetch が終わることを確認する。
+    target = "ubuntu-24.04_x86_64"
+    monkeypatch.setitem(run.PATCHES, target, ["a.patch", "b.patch"])
+    monkeypatch.setattr(run, "_deps_dirs", lambda src_dir: ["."])
+    applied_from = []
+    monkeypatch.setattr(
+        run, "apply_patches", lambda *args, start=0: applied_from.append((args[0], start))
+    )
+    patch_dir = tmp_path / "patches"
+    patch_dir.mkdir()
+    webrtc_source_dir = tmp_path / "webrtc"
+    src_dir = webrtc_source_dir / "src"
+    version = git_repo(src_dir, {"DEPS": "deps = {}\n"})
+    (webrtc_source_dir / ".gclient").write_text("solutions = []\n", encoding="utf-8")
+    for patch in ("a.patch", "b.patch"):
+        (patch_dir / patch).write_text(patch, encoding="utf-8")
+        digest = hashlib.sha256(patch.encode("utf-8")).hexdigest()
+        run.cmd(
+            ["git", "-C", str(src_dir), "commit", "-q", "--allow-empty"]
+            + ["-m", f"[shiguredo-patch] Apply {patch}", "-m", f"Patch-SHA256: {digest}"]
+        )
+    first_patch = run.cmdcap(["git", "-C", str(src_dir), "rev-parse", "HEAD~1"])
+    run._write_fetch_fingerprint(str(webrtc_source_dir), str(patch_dir), version, target)
+
+    def fetch() -> None:
+        run.fetch_webrtc(str(tmp_path), str(patch_dir), version, target, str(webrtc_source_dir))
+
+    def is_synced() -> bool:
+        return run._webrtc_source_is_synced(str(webrtc_source_dir), str(patch_dir), version, target)
+
+    assert is_synced()
+    fetch()
+    assert applied_from == []
+
+    (src_dir / "DEPS").write_text("modified\n", encoding="utf-8")
+    assert not is_synced()
+    run.cmd(["git", "-C", str(src_dir), "checkout", "-q", "DEPS"])
+
+    (patch_dir / "b.patch").write_text("changed", encoding="utf-8")
+    assert is_synced()
+    with caplog.at_level(logging.INFO):
+        fetch()
+    assert applied_from == [(target, 1)]
+    assert "Re-applying 1 patches because b.patch changed" in caplog.text
+    assert run.cmdcap(["git", "-C", str(src_dir), "rev-parse", "HEAD"]) == first_patch
+
+
+def test_split_patch_files_maps_paths_to_repositories() -> None:
+    data = (
+        b"From: someone\n\n"
+        b"diff --git c/third_party/foo/source/foo/a.h i/third_party/foo/source/foo/a.h\n"
+        b"--- c/third_party/foo/source/foo/a.h\n+++ i/third_party/foo/source/foo/a.h\n"
+        b"@@ -1 +1 @@\n-a\n+b\n"
+        b"--- a/BUILD.gn\t2024-01-01\n+++ b/BUILD.gn\t2024-01-01\n@@ -1 +1 @@\n-x\n+y\n"
+        b"--- a/third_party/foo/gone.txt\n+++ /dev/null\n@@ -1 +0,0 @@\n-z\n"
+    )
+    files = run._split_patch_files(data)
+    assert [path for path, _ in files] == [
+        "third_party/foo/source/foo/a.h",
+        "BUILD.gn",
+        "third_party/foo/gone.txt",
+    ]
+    assert b"".join(section for _, section in files) == data[len(b"From: someone\n\n") :]
+    dirs = [".", "third_party/foo", "third_party/foo/source/foo"]
+    assert [run._owning_repository(path, dirs) for path, _ in files] == [
+        "third_party/foo/source/foo",
+        ".",
+        "third_party/foo",
+    ]
+
+
+def test_apply_patches_commits_once_per_touched_repository(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, git_repo: MakeGitRepo
+) -> None:
+    target = "ubuntu-24.04_x86_64"
+    monkeypatch.setitem(run.PATCHES, target, ["a.patch", "b.patch", "c.patch"])
+    monkeypatch.setattr(run, "_deps_dirs", lambda src_dir: [".", "third_party/foo", "other"])
+    src_dir = tmp_path / "src"
+    repos = [src_dir, src_dir / "third_party" / "foo", src_dir / "other"]
+    git_repo(src_dir, {"file.txt": "1\n", ".gitignore": "/third_party/foo/\n/other/\n"})
+    for repo in repos[1:]:
+        git_repo(repo, {"file.txt": "1\n"})
+
+    def diff(path: str, old: str, new: str) -> str:
+        return (
+            f"diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n"
+            f"@@ -1 +1 @@\n-{old}\n+{new}\n"
+        )
+
+    patch_dir = tmp_path / "patches"
+    patch_dir.mkdir()
+    (patch_dir / "a.patch").write_text(diff("file.txt", "1", "2"), encoding="utf-8")
+    (patch_dir / "b.patch").write_text(
+        diff("third_party/foo/file.txt", "1", "2") + diff("file.txt", "2", "3"), encoding="utf-8"
+    )
+    (patch_dir / "c.patch").write_text(diff("third_party/foo/file.txt", "2", "3"), encoding="utf-8")
+
+    run.apply_patches(target, str(patch_dir), str(src_dir), None, False)
+    assert _git_log(src_dir) == ["[shiguredo-patch] Apply 3 patches", "base"]
+    assert _git_log(repos[1]) == ["[shiguredo-patch] Apply 3 patches", "base"]
+    assert _git_log(repos[2]) == ["base"]
+    assert (src_dir / "file.txt").read_text(encoding="utf-8") == "3\n"
+    assert (repos[1] / "file.txt").read_text(encoding="utf-8") == "3\n"
+    with run.cd(str(src_dir)):
+        assert [name for name, _ in run._applied_patches()] == ["a.patch", "b.patch", "c.patch"]
+
+    # まとめたコミットは途中から戻せないので、全部戻してから当て直す
+    (patch_dir / "c.patch").write_text(diff("third_party/foo/file.txt", "2", "4"), encoding="utf-8")
+    assert run.reapply_changed_patches(target, str(patch_dir), str(src_dir))
+    assert _git_log(src_dir) == ["[shiguredo-patch] Apply 3 patches", "base"]
+    assert (repos[1] / "file.txt").read_text(encoding="utf-8") == "4\n"
+    assert not run.reapply_changed_patches(target, str(patch_dir), str(src_dir))
+
+    # パッチごとのモードでは、触ったリポジトリだけにパッチごとのコミットが積まれる
+    for repo in repos[:2]:
+        run.cmd(["git", "-C", str(repo), "reset", "-q", "--hard", "HEAD~1"])
+    run.apply_patches(target, str(patch_dir), str(src_dir), "b.patch", True, per_patch=True)
+    assert _git_log(src_dir)[:2] == [
+        "[shiguredo-patch] Apply b.patch",
+        "[shiguredo-patch] Apply a.patch",
+    ]
+    assert _git_log(repos[1]) == ["[shiguredo-patch] Apply b.patch", "base"]
+
+    # 最後のパッチだけが変わった場合は、そのパッチのコミットだけを戻して当て直す
+    assert run.reapply_changed_patches(target, str(patch_dir), str(src_dir))
+    assert _git_log(src_dir)[:3] == [
+        "[shiguredo-patch] Apply c.patch",
+        "[shiguredo-patch] Apply b.patch",
+        "[shiguredo-patch] Apply a.patch",
+    ]
+    assert _git_log(repos[1])[:2] == [
+        "[shiguredo-patch] Apply c.patch",
+        "[shiguredo-patch] Apply b.patch",
+    ]
+
+
+def test_apply_patches_batched_reverts_only_its_own_changes(
+    tmp_path: Path, caplog: pytest.LogCaptureFixture, git_repo: MakeGitRepo
+) -> None:
+    # 途中のリポジトリで当たらなかった場合は、当てた差分だけを戻し、手元のファイルは残す。
+    src_dir = tmp_path / "src"
+    git_repo(src_dir, {"file.txt": "1\n", ".gitignore": "/other/\n"})
+    git_repo(src_dir / "other", {"file.txt": "1\n"})
+    (src_dir / "local.txt").write_text("work in progress\n", encoding="utf-8")
+    patch_dir = tmp_path / "patches"
+    patch_dir.mkdir()
+    (patch_dir / "a.patch").write_text(
+        "--- a/file.txt\n+++ b/file.txt\n@@ -1 +1 @@\n-1\n+2\n"
+        "--- /dev/null\n+++ b/added.txt\n@@ -0,0 +1 @@\n+new\n"
+        "--- a/other/file.txt\n+++ b/other/file.txt\n@@ -1 +1 @@\n-9\n+2\n",
+        encoding="utf-8",
+    )
+    patches = run._read_patches(str(patch_dir), ["a.patch"], [".", "other"])
+
+    with caplog.at_level(logging.WARNING):
+        assert not run._apply_patches_batched(str(src_dir), patches)
+
+    assert "Failed to apply patches at once in other" in caplog.text
+    assert (src_dir / "file.txt").read_text(encoding="utf-8") == "1\n"
+    assert not (src_dir / "added.txt").exists()
+    assert (src_dir / "local.txt").exists()
+    assert _git_log(src_dir) == ["base"]
+
+
+def test_check_patches_reports_offsets_and_failures(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture[str],
+    git_repo: MakeGitRepo,
+) -> None:
+    target = "ubuntu-24.04_x86_64"
+    monkeypatch.setitem(run.PATCHES, target, ["a.patch", "b.patch", "c.patch", "d.patch"])
+    monkeypatch.setattr(
+        run, "_deps_dirs", lambda src_dir: [".", "third_party/foo", "third_party/bar"]
+    )
+    webrtc_source_dir = tmp_path / "webrtc"
+    src_dir = webrtc_source_dir / "src"
+    foo_dir = src_dir / "third_party" / "foo"
+    bar_dir = src_dir / "third_party" / "bar"
+    file = "0\n0\n" + "".join(f"{i}\n" for i in range(1, 21))
+    foo_base = git_repo(foo_dir, {"file.txt": file})
+    git_repo(bar_dir, {"file.txt": file})
+    # foo は DEPS で固定した最初のコミット、bar は取得されていないリビジョンを指す
+    deps = (
+        "vars = {'git': 'https://example.com'}\n"
+        "deps = {\n"
+        f"  'src/third_party/foo': Var('git') + '/foo.git' + '@' + '{foo_base}',\n"
+        "  'src/third_party/bar': {\n"
+        f"    'url': '{{git}}/bar.git@{'0' * 40}',\n"
+        "    'condition': 'checkout_linux',\n"
+        "  },\n"
+        "  'src/tools/cipd': {'dep_type': 'cipd', 'packages': []},\n"
+        "}\n"
+    )
+    version = git_repo(src_dir, {"file.txt": file, ".gitignore": "/third_party/\n", "DEPS": deps})
+    # 今のチェックアウトではなく、DEPS で固定されたコミットに対して確認する
+    (foo_dir / "file.txt").write_text("rolled\n", encoding="utf-8")
+    run.cmd(["git", "-C", str(foo_dir), "commit", "-qam", "roll"])
+    (foo_dir / "file.txt").write_text("patched\n", encoding="utf-8")
+    run.cmd(["git", "-C", str(foo_dir), "commit", "-qam", "[shiguredo-patch] Apply a.patch"])
+
+    def diff(path: str, line: int, before: str, old: str, new: str, after: str) -> str:
+        return (
+            f"diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n"
+            f"@@ -{line - 1},3 +{line - 1},3 @@\n {before}\n-{old}\n+{new}\n {after}\n"
+        )
+
+    patch_dir = tmp_path / "patches"
+    patch_dir.mkdir()
+    (patch_dir / "a.patch").write_text(
+        diff("file.txt", 5, "4", "5", "five", "6")
+        + diff("third_party/foo/file.txt", 10, "9", "10", "ten", "11"),
+        encoding="utf-8",
+    )
+    # 後のパッチは前のパッチを当てた状態に対して確認される
+    (patch_dir / "b.patch").write_text(
+        diff("file.txt", 6, "five", "6", "six", "7"), encoding="utf-8"
+    )
+    (patch_dir / "c.patch").write_text(
+        diff("third_party/foo/file.txt", 9, "8", "9", "nine", "10"), encoding="utf-8"
+    )
+    (patch_dir / "d.patch").write_text(
+        diff("third_party/bar/file.txt", 5, "4", "5", "five", "6"), encoding="utf-8"
+    )
+
+    ok = run.check_patches(str(tmp_path), str(patch_dir), target, str(webrtc_source_dir), version)
+    out = capsys.readouterr().out
+    assert not ok
+    assert "    OK  a.patch\n" in out
+    assert "    OK  b.patch\n" in out
+    assert "file.txt: Hunk #1 succeeded at 6 (offset 2 lines)." in out
+    assert "third_party/foo/file.txt: Hunk #1 succeeded at 11 (offset 2 lines)." in out
+    assert "FAILED  c.patch\n" in out
+    assert "third_party/foo/file.txt: error: patch failed: file.txt:8" in out
+    assert f"third_party/bar: skipped, {'0' * 40} is not fetched" in out
+    # 作業ツリーやインデックスには触らない
+    assert (foo_dir / "file.txt").read_text(encoding="utf-8") == "patched\n"
+    assert run.cmdcap(["git", "-C", str(src_dir), "status", "--porcelain"]) == ""
+
+    # VERSION が無く、パッチも当たっていない src は確認の元にできない
+    with pytest.raises(run.PatchCheckError, match="not fetched"):
+        run.check_patches(str(tmp_path), str(patch_dir), target, str(webrtc_source_dir), "f" * 40)
+
+
+def test_init_sysroots_reports_elapsed_time_of_failed_target(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture
+) -> None:
+    # 失敗したターゲットにも、プール全体ではなくそのターゲット自身の所要時間を出す。
+    def init_sysroot(target: str, output_dir: str, **options: object) -> bool:
+        if target == "slow":
+            time.sleep(0.5)
+            return True
+        raise run.SysrootBuildError("broken")
+
+    monkeypatch.setattr(run, "BASE_DIR", str(tmp_path))
+    monkeypatch.setattr(run, "init_sysroot", init_sysroot)
+    caplog.set_level("INFO")
+    with pytest.raises(run.SysrootBuildError, match="broken-target"):
+        run.init_sysroots(["slow", "broken-target"], 1)
+    summary = {
+        record.getMessage().split()[0]: record.getMessage().split()
+        for record in caplog.records
+        if record.getMessage().startswith("  ")
+    }
+    assert summary["slow"][1] == "built"
+    assert summary["broken-target"][1] == "failed"
+    assert float(summary["broken-target"][2].removesuffix("s")) < 0.4
+
+
+def test_init_sysroots_reports_every_target_when_a_worker_dies(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture
+) -> None:
+    # ワーカープロセスが落ちても、各ターゲットの集計とログの場所を出してから失敗する。
+    def init_sysroot(target: str, output_dir: str, **options: object) -> bool:
+        os._exit(1)
+
+    monkeypatch.setattr(run, "BASE_DIR", str(tmp_path))
+    monkeypatch.setattr(run, "init_sysroot", init_sysroot)
+    caplog.set_level("INFO")
+    with pytest.raises(run.SysrootBuildError, match="crashed, other"):
+        run.init_sysroots(["crashed", "other"], 1)
+    summary = {
+        record.getMessage().split()[0]: record.getMessage().split()
+        for record in caplog.records
+        if record.getMessage().startswith("  ")
+    }
+    assert summary["crashed"][1] == "failed"
+    assert summary["other"][1] == "failed"
+    for target in ("crashed", "other"):
+        log_path = tmp_path / "_source" / target / "sysroot.log"
+        assert f"{target}: failed" in caplog.text
+        assert f"log={log_path}" in caplog.text
@@ -1,20 +1,58 @@
 from __future__ import annotations
 
+import functools
+import hashlib
+import http.server
+import io
 import json
 import os
+import shutil
+import tarfile
+import threading
+import time
+from collections.abc import Iterator
+from dataclasses import replace
 from pathlib import Path
 from typing import cast
 
 import pytest
+from bench_sysroot_e2e import local_repository, missing_commands
 
+import sysroot_builder
 from sysroot_builder import (
+    DEFAULT_PRUNE_INCLUDE,
+    PruneConfig,
     SysrootBuildError,
     SysrootConfigError,
+    _BuildMetrics,
+    _deb_cache_path,
+    _DebPackage,
+    _dependency_groups,
+    _dirty_packages,
+    _extract_deb,
     _fix_absolute_symlinks,
+    _HttpConnectionPool,
+    _index_sysroot_files,
     _link_pkgconfig_files,
+    _merge_extracted_tree,
+    _prune_deb_cache,
+    _prune_matcher,
+    _remove_package_paths,
+    _repository_lists_key,
+    _resolve_packages,
+    _restore_from_deb_cache,
+    _store_in_deb_cache,
+    _stream_stage_debs,
     build_sysroot,
+    empty_trash,
+    export_sysroot_artifact,
     load_sysroot_config,
+    load_sysroot_lock,
+    lock_sysroot,
+    move_to_trash,
     sysroot_config_fingerprint,
+    sysroot_lock_path,
+    verify_sysroot,
 )
 
 
@@ -123,6 +161,108 @@ def test_sysroot_config_fingerprint_is_independent_of_config_path(tmp_path: Path
     assert sysroot_config_fingerprint(first) == sysroot_config_fingerprint(second)
 
 
+def test_load_sysroot_config_reads_exclude_packages(tmp_path: Path) -> None:
+    # 除外したパッケージが違えば別の sysroot になり、packages と重なる指定は受け付けない。
+    (tmp_path / "keyrings").mkdir()
+    (tmp_path / "keyrings" / "ubuntu-archive-keyring.gpg").touch()
+    write_config(tmp_path / "config.json")
+    raw_config = json.loads((tmp_path / "config.json").read_text(encoding="utf-8"))
+    raw_config["exclude_packages"] = ["adwaita-icon-theme"]
+    (tmp_path / "excluded.json").write_text(json.dumps(raw_config), encoding="utf-8")
+    raw_config["exclude_packages"] = ["libc6-dev"]
+    (tmp_path / "overlap.json").write_text(json.dumps(raw_config), encoding="utf-8")
+
+    config = load_sysroot_config(tmp_path / "config.json")
+    excluded = load_sysroot_config(tmp_path / "excluded.json")
+
+    assert excluded.exclude_packages == ("adwaita-icon-theme",)
+    assert sysroot_config_fingerprint(config) != sysroot_config_fingerprint(excluded)
+    with pytest.raises(SysrootConfigError, match="exclude_packages"):
+        load_sysroot_config(tmp_path / "overlap.json")
+
+
+def test_dependency_groups_drops_version_constraints() -> None:
+    assert _dependency_groups("libc6 (>= 2.34), libfoo1 | libbar1 [arm64], python3:any") == [
+        ["libc6"],
+        ["libfoo1", "libbar1"],
+        ["python3"],
+    ]
+
+
+def test_repository_lists_key_is_shared_between_configs(tmp_path: Path) -> None:
+    # 同じリポジトリとアーキテクチャなら、名前やパッケージが違っても APT インデックスを共有する。
+    (tmp_path / "keyrings").mkdir()
+    (tmp_path / "keyrings" / "ubuntu-archive-keyring.gpg").write_bytes(b"key")
+    write_config(tmp_path / "config.json")
+    config = load_sysroot_config(tmp_path / "config.json")
+    repository = config.repositories[0]
+    other = replace(config, name="other", packages=("zlib1g-dev",))
+
+    key = _repository_lists_key(config, repository)
+    assert key == _repository_lists_key(other, repository)
+    assert key != _repository_lists_key(replace(config, arch="amd64"), repository)
+
+    # 署名鍵が差し替えられたら、古い鍵で検証したインデックスは使わない。
+    (tmp_path / "keyrings" / "ubuntu-archive-keyring.gpg").write_bytes(b"rotated")
+    assert key != _repository_lists_key(config, repository)
+
+
+def test_sysroot_config_fingerprint_distinguishes_prune(tmp_path: Path) -> None:
+    # 絞り込んだ sysroot を全体の sysroot として再利用しないようにする。
+    (tmp_path / "keyrings").mkdir()
+    (tmp_path / "keyrings" / "ubuntu-archive-keyring.gpg").touch()
+    config_path = tmp_path / "config.json"
+    write_config(config_path)
+    raw_config = json.loads(config_path.read_text(encoding="utf-8"))
+    raw_config["prune"] = {"exclude": ["usr/include/X11/*"]}
+    pruned_path = tmp_path / "pruned.json"
+    pruned_path.write_text(json.dumps(raw_config), encoding="utf-8")
+
+    config = load_sysroot_config(config_path)
+    pruned = load_sysroot_config(pruned_path)
+
+    assert config.prune is None
+    assert pruned.prune == PruneConfig(DEFAULT_PRUNE_INCLUDE, ("usr/include/X11/*",))
+    fingerprints = {
+        sysroot_config_fingerprint(config),
+        sysroot_config_fingerprint(pruned),
+        sysroot_config_fingerprint(replace(pruned, prune=PruneConfig())),
+    }
+    assert len(fingerprints) == 3
+
+
+def test_load_sysroot_lock_pins_packages_and_rejects_stale_config(tmp_path: Path) -> None:
+    # lockfile は作成時の設定にだけ適用し、固定した deb は fingerprint に反映する。
+    (tmp_path / "keyrings").mkdir()
+    (tmp_path / "keyrings" / "ubuntu-archive-keyring.gpg").touch()
+    write_config(tmp_path / "config.json")
+    write_config(tmp_path / "other.json", name="other")
+    config = load_sysroot_config(tmp_path / "config.json")
+    lock = {
+        "format_version": 1,
+        "fingerprint": sysroot_config_fingerprint(config),
+        "packages": [
+            {
+                "url": "https://ports.ubuntu.com/ubuntu-ports/pool/main/g/glibc/libc6_2.43_arm64.deb",
+                "filename": "libc6_2.43_arm64.deb",
+                "version": "2.43",
+                "size": 3,
+                "sha256": hashlib.sha256(b"deb").hexdigest(),
+            }
+        ],
+    }
+    lock_path = tmp_path / "config.lock.json"
+    lock_path.write_text(json.dumps(lock), encoding="utf-8")
+
+    locked = load_sysroot_lock(lock_path, config)
+
+    assert locked.lock is not None
+    assert [package.filename for package in locked.lock] == ["libc6_2.43_arm64.deb"]
+    assert sysroot_config_fingerprint(locked) != sysroot_config_fingerprint(config)
+    with pytest.raises(SysrootConfigError, match="does not match"):
+        load_sysroot_lock(lock_path, load_sysroot_config(tmp_path / "other.json"))
+
+
 def test_fix_absolute_symlinks_makes_existing_target_relative(tmp_path: Path) -> None:
     # sysroot の移動後もリンクがホスト側の /usr/lib を参照しないことを確認する。
     target = tmp_path / "usr" / "lib" / "aarch64-linux-gnu" / "libexample.so.1"
@@ -149,6 +289,22 @@ def test_fix_absolute_symlinks_keeps_unresolved_target(tmp_path: Path) -> None:
     assert os.readlink(link) == "/etc/alternatives/example"
 
 
+def test_fix_absolute_symlinks_resolves_indexed_path_through_usrmerge(tmp_path: Path) -> None:
+    # 展開時の記録は lib/... のままでも、実体は usr/lib にあるため実体基準で相対化する。
+    target = tmp_path / "usr" / "share" / "example" / "data"
+    target.parent.mkdir(parents=True)
+    target.touch()
+    (tmp_path / "usr" / "lib" / "aarch64-linux-gnu").mkdir(parents=True)
+    (tmp_path / "lib").symlink_to("usr/lib")
+    link = tmp_path / "usr" / "lib" / "aarch64-linux-gnu" / "data"
+    link.symlink_to("/usr/share/example/data")
+
+    _fix_absolute_symlinks(tmp_path, ["lib/aarch64-linux-gnu/data", "lib/missing"])
+
+    assert os.readlink(link) == "../../share/example/data"
+    assert link.resolve() == target
+
+
 def test_link_pkgconfig_files_creates_compatibility_links(tmp_path: Path) -> None:
     # WebRTC の pkg-config 探索が従来と同じ場所からターゲット用定義を発見できるようにする。
     source_dir = tmp_path / "usr" / "lib" / "aarch64-linux-gnu" / "pkgconfig"
@@ -162,6 +318,415 @@ def test_link_pkgconfig_files_creates_compatibility_links(tmp_path: Path) -> Non
     assert os.readlink(link) == "../../lib/aarch64-linux-gnu/pkgconfig/example.pc"
 
 
+def test_merge_extracted_tree_prefers_later_package(tmp_path: Path) -> None:
+    # 並列展開でも統合順で結果が決まり、同じパスの衝突が報告されることを確認する。
+    root = tmp_path / "rootfs"
+    root.mkdir()
+    owners: dict[str, str] = {}
+    for index, content in enumerate(("first", "second")):
+        staging_dir = tmp_path / f"staging{index}"
+        header = staging_dir / "usr" / "include" / "example.h"
+        header.parent.mkdir(parents=True)
+        header.write_text(content, encoding="utf-8")
+        (staging_dir / "usr" / "include" / f"only{index}.h").touch()
+        conflicts = _merge_extracted_tree(staging_dir, root, f"package{index}.deb", owners)
+
+    assert (root / "usr" / "include" / "example.h").read_text(encoding="utf-8") == "second"
+    assert (root / "usr" / "include" / "only0.h").is_file()
+    assert (root / "usr" / "include" / "only1.h").is_file()
+    assert conflicts == [("usr/include/example.h", "package0.deb", "package1.deb")]
+
+
+def test_merge_extracted_tree_does_not_follow_absolute_symlink(tmp_path: Path) -> None:
+    # sysroot 外を指すリンクを経由してホスト側へ書き込まないことを確認する。
+    root = tmp_path / "rootfs"
+    (root / "usr").mkdir(parents=True)
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    (root / "usr" / "lib").symlink_to(outside)
+    staging_dir = tmp_path / "staging"
+    (staging_dir / "usr" / "lib").mkdir(parents=True)
+    (staging_dir / "usr" / "lib" / "libexample.so").touch()
+
+    _merge_extracted_tree(staging_dir, root, "package.deb", {})
+
+    assert not (outside / "libexample.so").exists()
+    assert (root / "usr" / "lib" / "libexample.so").is_file()
+
+
+def test_dirty_packages_follows_shared_paths(tmp_path: Path) -> None:
+    # 変更されるパスを共有する deb と、さらにその deb とパスを共有する deb を再展開対象にする。
+    kept = {
+        "a.deb": ["usr/", "usr/share/doc/shared"],
+        "b.deb": ["usr/", "usr/share/doc/shared", "usr/include/b.h"],
+        "c.deb": ["usr/", "usr/include/b.h"],
+        "d.deb": ["usr/", "usr/include/d.h"],
+    }
+
+    dirty = _dirty_packages(kept, {"usr/share/doc/shared"})
+
+    assert dirty == {"a.deb", "b.deb", "c.deb"}
+
+
+def test_remove_package_paths_keeps_shared_directories(tmp_path: Path) -> None:
+    # 削除する deb のファイルは消すが、残る deb が含むディレクトリは空でも残す。
+    (tmp_path / "usr" / "include" / "removed").mkdir(parents=True)
+    (tmp_path / "usr" / "include" / "removed" / "a.h").touch()
+    (tmp_path / "usr" / "share").mkdir()
+
+    _remove_package_paths(
+        tmp_path,
+        ["usr/", "usr/include/", "usr/include/removed/", "usr/include/removed/a.h", "usr/share/"],
+        {"usr/", "usr/share/"},
+    )
+
+    assert not (tmp_path / "usr" / "include").exists()
+    assert (tmp_path / "usr" / "share").is_dir()
+
+
+def write_deb(
+    path: Path, members: list[tuple[tarfile.TarInfo, bytes]], *, compression: str = "xz"
+) -> None:
+    # dpkg-deb に依存せず、ar と tar を組み立てて最小限の deb を作る。
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode=f"w:{compression}") as archive:
+        for info, content in members:
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+    ar_members = [
+        ("debian-binary", b"2.0\n"),
+        ("control.tar.xz", b""),
+        (f"data.tar.{compression}", data.getvalue()),
+    ]
+    with path.open("wb") as file:
+        file.write(b"!<arch>\n")
+        for name, content in ar_members:
+            header = f"{name}/".ljust(16) + "0".ljust(12) + "0".ljust(6) + "0".ljust(6)
+            header += "100644".ljust(8) + str(len(content)).ljust(10) + "`\n"
+            file.write(header.encode("ascii"))
+            file.write(content)
+            if len(content) % 2:
+                file.write(b"\n")
+
+
+def tar_member(name: str, kind: bytes = tarfile.REGTYPE, link: str = "") -> tarfile.TarInfo:
+    info = tarfile.TarInfo(name)
+    info.type = kind
+    info.linkname = link
+    info.mode = 0o755 if kind == tarfile.DIRTYPE else 0o644
+    return info
+
+
+@pytest.mark.parametrize("compression", ["gz", "xz", "bz2"])
+def test_extract_deb_records_index(tmp_path: Path, compression: str) -> None:
+    deb_file = tmp_path / "libfoo_1.0_arm64.deb"
+    write_deb(
+        deb_file,
+        [
+            (tar_member("./", tarfile.DIRTYPE), b""),
+            (tar_member("./usr/lib/", tarfile.DIRTYPE), b""),
+            (tar_member("./usr/lib/libfoo.so.1"), b"elf"),
+            (tar_member("./usr/lib/libfoo.so", tarfile.SYMTYPE, "libfoo.so.1"), b""),
+            (tar_member("./usr/lib/libbar.so.1", tarfile.LNKTYPE, "./usr/lib/libfoo.so.1"), b""),
+        ],
+        compression=compression,
+    )
+    root = tmp_path / "root"
+
+    entries = _extract_deb(deb_file, root)
+
+    assert [(entry.path, entry.kind, entry.size, entry.link) for entry in entries] == [
+        ("usr/lib", "dir", 0, None),
+        ("usr/lib/libbar.so.1", "file", 3, None),
+        ("usr/lib/libfoo.so", "symlink", 0, "libfoo.so.1"),
+        ("usr/lib/libfoo.so.1", "file", 3, None),
+    ]
+    assert (root / "usr/lib/libfoo.so").read_bytes() == b"elf"
+    assert (root / "usr/lib/libbar.so.1").stat().st_ino == (
+        root / "usr/lib/libfoo.so.1"
+    ).stat().st_ino
+
+
+@pytest.mark.parametrize(
+    "members",
+    [
+        [(tar_member("./../escape"), b"x")],
+        [
+            (tar_member("./usr/lib", tarfile.SYMTYPE, "/tmp"), b""),
+            (tar_member("./usr/lib/escape"), b"x"),
+        ],
+        [
+            (tar_member("./usr/lib", tarfile.SYMTYPE, "/etc"), b""),
+            (tar_member("./escape", tarfile.LNKTYPE, "./usr/lib/passwd"), b""),
+        ],
+    ],
+)
+def test_extract_deb_rejects_paths_outside_root(
+    tmp_path: Path, members: list[tuple[tarfile.TarInfo, bytes]]
+) -> None:
+    # 展開先の外へ書き込むパスは、".." でも symlink 経由でも受け付けない。
+    deb_file = tmp_path / "evil_1.0_arm64.deb"
+    write_deb(deb_file, members)
+
+    with pytest.raises(SysrootBuildError, match="deb archive"):
+        _extract_deb(deb_file, tmp_path / "root")
+
+    assert not (tmp_path / "escape").exists()
+
+
+@pytest.mark.parametrize(
+    "members",
+    [
+        [(tar_member("./escape", tarfile.LNKTYPE, "./missing"), b"")],
+        [
+            (tar_member("./passwd", tarfile.SYMTYPE, "/etc/passwd"), b""),
+            (tar_member("./escape", tarfile.LNKTYPE, "./passwd"), b""),
+        ],
+    ],
+)
+def test_extract_deb_rejects_hardlinks_to_unextracted_files(
+    tmp_path: Path, members: list[tuple[tarfile.TarInfo, bytes]]
+) -> None:
+    # ハードリンクは、同じ deb で展開済みの通常のファイルだけを指せる。
+    deb_file = tmp_path / "evil_1.0_arm64.deb"
+    write_deb(deb_file, members)
+
+    with pytest.raises(SysrootBuildError, match="Hardlink in evil_1.0_arm64.deb"):
+        _extract_deb(deb_file, tmp_path / "root")
+
+    assert not (tmp_path / "root" / "escape").exists()
+
+
+def test_extract_deb_applies_prune(tmp_path: Path) -> None:
+    deb_file = tmp_path / "libfoo-dev_1.0_arm64.deb"
+    write_deb(
+        deb_file,
+        [
+            (tar_member("./usr/include/", tarfile.DIRTYPE), b""),
+            (tar_member("./usr/include/foo.h"), b"h"),
+            (tar_member("./usr/lib/aarch64-linux-gnu/", tarfile.DIRTYPE), b""),
+            (tar_member("./usr/lib/aarch64-linux-gnu/libfoo.a"), b"a"),
+            (tar_member("./usr/lib/aarch64-linux-gnu/libfoo.so", tarfile.SYMTYPE, "x.so.1"), b""),
+            (tar_member("./usr/share/doc/libfoo-dev/", tarfile.DIRTYPE), b""),
+            (tar_member("./usr/share/doc/libfoo-dev/copyright"), b"c"),
+            (tar_member("./usr/share/man/man3/foo.3.gz"), b"m"),
+        ],
+    )
+    root = tmp_path / "root"
+
+    entries = _extract_deb(deb_file, root, _prune_matcher(PruneConfig()))
+
+    # 残すファイルの親だけが作られ、ドキュメントはディレクトリごと展開されない。
+    assert [entry.path for entry in entries] == [
+        "usr/include",
+        "usr/include/foo.h",
+        "usr/lib/aarch64-linux-gnu",
+        "usr/lib/aarch64-linux-gnu/libfoo.a",
+        "usr/lib/aarch64-linux-gnu/libfoo.so",
+    ]
+    assert not (root / "usr" / "share").exists()
+
+
+def make_deb_package(path: Path, content: bytes) -> _DebPackage:
+    path.write_bytes(content)
+    return _DebPackage(
+        url=f"https://ports.ubuntu.com/ubuntu-ports/pool/main/{path.name}",
+        filename=path.name,
+        size=len(content),
+        hash=f"SHA256:{hashlib.sha256(content).hexdigest()}",
+    )
+
+
+def test_deb_cache_restores_stored_package(tmp_path: Path) -> None:
+    # 一度ダウンロードした deb は別の作業ディレクトリからも再利用できる。
+    cache_dir = tmp_path / "cache"
+    package = make_deb_package(tmp_path / "libexample_1.0_arm64.deb", b"deb")
+
+    _store_in_deb_cache(cache_dir, package, tmp_path / package.filename)
+    destination = tmp_path / "archives" / package.filename
+    destination.parent.mkdir()
+
+    assert _restore_from_deb_cache(cache_dir, package, destination)
+    assert destination.read_bytes() == b"deb"
+
+
+def test_deb_cache_misses_on_different_hash(tmp_path: Path) -> None:
+    # 同名でも中身の異なる deb をキャッシュから取り違えない。
+    cache_dir = tmp_path / "cache"
+    package = make_deb_package(tmp_path / "libexample_1.0_arm64.deb", b"deb")
+    _store_in_deb_cache(cache_dir, package, tmp_path / package.filename)
+    (tmp_path / "rebuilt").mkdir()
+    rebuilt = make_deb_package(tmp_path / "rebuilt" / package.filename, b"rebuilt")
+
+    assert not _restore_from_deb_cache(cache_dir, rebuilt, tmp_path / "restored.deb")
+
+
+def test_deb_cache_rejects_corrupted_package(tmp_path: Path) -> None:
+    # ハッシュが一致しない deb で共有キャッシュを汚さない。
+    cache_dir = tmp_path / "cache"
+    package = make_deb_package(tmp_path / "libexample_1.0_arm64.deb", b"deb")
+    (tmp_path / package.filename).write_bytes(b"truncated")
+
+    with pytest.raises(SysrootBuildError):
+        _store_in_deb_cache(cache_dir, package, tmp_path / package.filename)
+
+
+def test_deb_cache_evicts_corrupted_object_on_restore(tmp_path: Path) -> None:
+    # 格納後に壊れた deb は展開に使わず、キャッシュから削除する。
+    cache_dir = tmp_path / "cache"
+    package = make_deb_package(tmp_path / "libexample_1.0_arm64.deb", b"deb")
+    _store_in_deb_cache(cache_dir, package, tmp_path / package.filename)
+    cache_path = _deb_cache_path(cache_dir, package)
+    assert cache_path is not None
+    cache_path.unlink()
+    cache_path.write_bytes(b"de")
+    destination = tmp_path / "archives" / package.filename
+    destination.parent.mkdir()
+
+    assert not _restore_from_deb_cache(cache_dir, package, destination)
+    assert not destination.exists()
+    assert not cache_path.exists()
+
+
+@pytest.fixture
+def http_server(tmp_path: Path) -> Iterator[str]:
+    # tmp_path/public をドキュメントルートにした HTTP サーバーを起動し、ベース URL を返す。
+    (tmp_path / "public").mkdir()
+    handler = functools.partial(
+        http.server.SimpleHTTPRequestHandler, directory=str(tmp_path / "public")
+    )
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_stream_stage_debs_extracts_while_downloading(tmp_path: Path, http_server: str) -> None:
+    # ダウンロードした deb はディスクに置かずに展開し、キャッシュを使う場合だけ保存する。
+    packages = []
+    for index in range(4):
+        deb_file = tmp_path / "public" / f"libfoo{index}_1.0_arm64.deb"
+        write_deb(deb_file, [(tar_member(f"./usr/lib/libfoo{index}.so"), b"elf")])
+        package = make_deb_package(deb_file, deb_file.read_bytes())
+        packages.append(replace(package, url=f"{http_server}/{deb_file.name}"))
+    cache_dir = tmp_path / "cache"
+
+    with _HttpConnectionPool() as pool:
+        staged = list(
+            _stream_stage_debs(pool, packages, tmp_path / "staging", 2, None, cache_dir, 1 << 30)
+        )
+        assert [filename for filename, _, _ in staged] == [pkg.filename for pkg in packages]
+        assert (staged[3][1] / "usr/lib/libfoo3.so").read_bytes() == b"elf"
+        assert len(list((cache_dir / "debs" / "sha256").iterdir())) == 4
+
+        # キャッシュにある deb は、サーバーから消えていても展開できる。
+        (tmp_path / "public" / packages[0].filename).unlink()
+        staged = list(
+            _stream_stage_debs(pool, packages[:1], tmp_path / "cached", 1, None, cache_dir, 1 << 30)
+        )
+        assert (staged[0][1] / "usr/lib/libfoo0.so").read_bytes() == b"elf"
+
+        # 壊れたキャッシュは使わず、ダウンロードし直してキャッシュも書き直す。
+        cache_path = _deb_cache_path(cache_dir, packages[3])
+        assert cache_path is not None
+        cache_path.unlink()
+        cache_path.write_bytes((tmp_path / "public" / packages[2].filename).read_bytes())
+        staged = list(
+            _stream_stage_debs(
+                pool, packages[3:], tmp_path / "refetched", 1, None, cache_dir, 1 << 30
+            )
+        )
+        assert "usr/lib/libfoo3.so" in {entry.path for entry in staged[0][2]}
+        assert not (staged[0][1] / "usr/lib/libfoo2.so").exists()
+        assert cache_path.read_bytes() == (tmp_path / "public" / packages[3].filename).read_bytes()
+
+        # 中身がハッシュと一致しない deb は、展開できても受け付けない。
+        (tmp_path / "public" / packages[1].filename).write_bytes(
+            (tmp_path / "public" / packages[2].filename).read_bytes()
+        )
+        with pytest.raises(SysrootBuildError, match="does not match"):
+            list(_stream_stage_debs(pool, packages[1:2], tmp_path / "other", 1, None, None, 0))
+
+
+def test_build_metrics_excludes_nested_phases() -> None:
+    # 入れ子の段階の時間は外側の段階に二重に数えない。
+    metrics = _BuildMetrics()
+    with metrics.phase("extract"), metrics.phase("download"):
+        time.sleep(0.05)
+    package = _DebPackage(url="", filename="libfoo_1.0_arm64.deb", size=100, hash="")
+    metrics.add_packages([package], cached=False)
+    metrics.add_packages([replace(package, filename="libbar_1.0_arm64.deb")], cached=True)
+
+    value = metrics.to_json(1.0, {"usr/lib/libfoo.so": [3, 0, "x"]}, {"lib": "usr/lib"})
+
+    phases = cast(dict[str, float], value["phases"])
+    assert phases["download"] >= 0.05
+    assert phases["extract"] < 0.05
+    download = cast(dict[str, int], value["download"])
+    assert (download["packages"], download["cached_packages"], download["bytes"]) == (1, 1, 100)
+    assert 0 < download["bytes_per_second"] <= 2000
+    assert value["sysroot"] == {"files": 1, "symlinks": 1, "bytes": 3}
+
+
+def test_prune_deb_cache_removes_least_recently_used(tmp_path: Path) -> None:
+    # 上限を超えた場合は最終利用日時の古い deb から削除する。
+    cache_dir = tmp_path / "cache"
+    packages = []
+    for index in range(3):
+        package = make_deb_package(tmp_path / f"package{index}_1.0_arm64.deb", b"x" * 10)
+        _store_in_deb_cache(cache_dir, package, tmp_path / package.filename)
+        packages.append(package)
+    cached_files = sorted((cache_dir / "debs").glob("*/*.deb"))
+    for index, package in enumerate(packages):
+        (cached_file,) = [path for path in cached_files if path.name.endswith(package.filename)]
+        os.utime(cached_file, (1000 + index, 1000 + index))
+
+    _prune_deb_cache(cache_dir, 20)
+
+    remaining = sorted(path.name.split("_", 1)[1] for path in cache_dir.glob("debs/*/*.deb"))
+    assert remaining == [packages[1].filename, packages[2].filename]
+
+
+def test_resolve_packages_keys_cache_on_sha256_from_packages_index(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    # --print-uris は MD5Sum しか出力しないので、
+    # キャッシュのキーには apt-cache show の SHA256 を使う。
+    url = "http://example.com/pool/main/libe/libexample/libexample1_1%3a1.0_arm64.deb"
+    outputs = {
+        "apt-get": (
+            f"'{url}' libexample1_1%3a1.0_arm64.deb 3 MD5Sum:0123\n"
+            "'http://example.com/pool/main/b/base/base_2.0_arm64.deb' base_2.0_arm64.deb 5\n"
+        ),
+        "apt-cache": (
+            "Package: libexample1\nVersion: 1:1.0\n"
+            "Filename: pool/main/libe/libexample/libexample1_1%3a1.0_arm64.deb\n"
+            "SHA256: aaaa\nDescription: example\n continued\n\n"
+            "Package: base\nFilename: pool/main/b/base/base_2.0_arm64.deb\nSHA256: bbbb\n"
+        ),
+    }
+    commands = []
+
+    def run_command_output(args: list[str], **_: object) -> str:
+        commands.append(args)
+        return outputs[args[0]]
+
+    monkeypatch.setattr(sysroot_builder, "_require_command", lambda name: name)
+    monkeypatch.setattr(sysroot_builder, "_run_command_output", run_command_output)
+
+    packages = _resolve_packages("apt-get", [], {}, ("libexample1",))
+
+    assert [(package.filename, package.hash) for package in packages] == [
+        ("base_2.0_arm64.deb", "SHA256:bbbb"),
+        ("libexample1_1%3a1.0_arm64.deb", "SHA256:aaaa"),
+    ]
+    assert commands[1][-2:] == ["libexample1=1:1.0", "base=2.0"]
+
+
 def test_build_sysroot_reuses_matching_manifest(tmp_path: Path) -> None:
     # 一致する manifest があれば APT を再実行せず、安全に既存 sysroot を再利用する。
     config_path = tmp_path / "config" / "config.json"
@@ -171,10 +736,15 @@ def test_build_sysroot_reuses_matching_manifest(tmp_path: Path) -> None:
     write_config(config_path)
     config = load_sysroot_config(config_path)
     output_dir = tmp_path / "rootfs"
-    output_dir.mkdir()
+    (output_dir / "usr" / "lib").mkdir(parents=True)
+    (output_dir / "usr" / "lib" / "libfoo.so.1").write_bytes(b"elf")
+    (output_dir / "usr" / "lib" / "libfoo.so").symlink_to("libfoo.so.1")
+    files, symlinks = _index_sysroot_files(output_dir, {}, {}, 1)
     manifest = {
-        "format_version": 1,
+        "format_version": sysroot_builder.MANIFEST_VERSION,
         "fingerprint": sysroot_config_fingerprint(config),
+        "files": files,
+        "symlinks": symlinks,
     }
     (output_dir / ".webrtc-build-sysroot.json").write_text(json.dumps(manifest), encoding="utf-8")
 
@@ -183,7 +753,30 @@ def test_build_sysroot_reuses_matching_manifest(tmp_path: Path) -> None:
     assert built is False
 
 
-def test_build_sysroot_rejects_old_manifest_without_force(tmp_path: Path) -> None:
+def test_build_sysroot_rejects_manifest_without_file_index(tmp_path: Path) -> None:
+    # ファイル一覧のない manifest では変更を検出できないため、再利用しない。
+    config_path = tmp_path / "config" / "config.json"
+    keyring_path = config_path.parent / "keyrings" / "ubuntu-archive-keyring.gpg"
+    keyring_path.parent.mkdir(parents=True)
+    keyring_path.touch()
+    write_config(config_path)
+    config = load_sysroot_config(config_path)
+    output_dir = tmp_path / "rootfs"
+    output_dir.mkdir()
+    manifest = {
+        "format_version": sysroot_builder.MANIFEST_VERSION,
+        "fingerprint": sysroot_config_fingerprint(config),
+    }
+    (output_dir / ".webrtc-build-sysroot.json").write_text(json.dumps(manifest), encoding="utf-8")
+
+    with pytest.raises(SysrootBuildError, match="no file index"):
+        build_sysroot(config, output_dir)
+
+
+@pytest.mark.parametrize("format_version", [0, 1])
+def test_build_sysroot_rejects_old_manifest_without_force(
+    tmp_path: Path, format_version: int
+) -> None:
     # 生成形式が変わった sysroot を再利用せず、明示的な再生成を要求する。
     config_path = tmp_path / "config" / "config.json"
     keyring_path = config_path.parent / "keyrings" / "ubuntu-archive-keyring.gpg"
@@ -194,7 +787,7 @@ def test_build_sysroot_rejects_old_manifest_without_force(tmp_path: Path) -> Non
     output_dir = tmp_path / "rootfs"
     output_dir.mkdir()
     manifest = {
-        "format_version": 0,
+        "format_version": format_version,
         "fingerprint": sysroot_config_fingerprint(config),
     }
     (output_dir / ".webrtc-build-sysroot.json").write_text(json.dumps(manifest), encoding="utf-8")
@@ -231,3 +824,131 @@ def test_build_sysroot_rejects_stale_symlink_without_force(tmp_path: Path) -> No
 
     with pytest.raises(SysrootBuildError):
         build_sysroot(config, output_dir)
+
+
+def test_verify_sysroot_detects_modified_files(tmp_path: Path) -> None:
+    # 更新日時だけが変わったファイルはハッシュで確認し、中身が同じなら問題にしない。
+    config_path = tmp_path / "config" / "config.json"
+    keyring_path = config_path.parent / "keyrings" / "ubuntu-archive-keyring.gpg"
+    keyring_path.parent.mkdir(parents=True)
+    keyring_path.touch()
+    write_config(config_path)
+    config = load_sysroot_config(config_path)
+    output_dir = tmp_path / "rootfs"
+    (output_dir / "usr" / "lib").mkdir(parents=True)
+    for name in ("libfoo.so.1", "libbar.so.1", "libbaz.so.1"):
+        (output_dir / "usr" / "lib" / name).write_bytes(b"elf")
+    (output_dir / "usr" / "lib" / "libfoo.so").symlink_to("libfoo.so.1")
+    files, symlinks = _index_sysroot_files(output_dir, {}, {}, 2)
+    manifest = {
+        "format_version": sysroot_builder.MANIFEST_VERSION,
+        "fingerprint": sysroot_config_fingerprint(config),
+        "files": files,
+        "symlinks": symlinks,
+    }
+    (output_dir / ".webrtc-build-sysroot.json").write_text(json.dumps(manifest), encoding="utf-8")
+
+    os.utime(output_dir / "usr" / "lib" / "libfoo.so.1", (0, 0))
+    assert verify_sysroot(output_dir) == []
+    assert build_sysroot(config, output_dir) is False
+
+    (output_dir / "usr" / "lib" / "libbar.so.1").write_bytes(b"ELF")
+    (output_dir / "usr" / "lib" / "libbaz.so.1").unlink()
+    (output_dir / "usr" / "lib" / "libfoo.so").unlink()
+    (output_dir / "usr" / "lib" / "libfoo.so").symlink_to("libbar.so.1")
+
+    assert verify_sysroot(output_dir) == [
+        "usr/lib/libbar.so.1: content changed",
+        "usr/lib/libbaz.so.1: missing",
+        "usr/lib/libfoo.so: symlink target changed",
+    ]
+    with pytest.raises(SysrootBuildError, match="modified"):
+        build_sysroot(config, output_dir)
+
+
+@pytest.mark.skipif(shutil.which("zstd") is None, reason="zstd is not installed")
+def test_build_sysroot_restores_exported_artifact(tmp_path: Path) -> None:
+    # 書き出したアーティファクトは同じ内容なら同じバイト列になり、apt を使わずに復元できる。
+    config_path = tmp_path / "config" / "config.json"
+    keyring_path = config_path.parent / "keyrings" / "ubuntu-archive-keyring.gpg"
+    keyring_path.parent.mkdir(parents=True)
+    keyring_path.touch()
+    write_config(config_path)
+    config = load_sysroot_config(config_path)
+    sysroot_dir = tmp_path / "built"
+    (sysroot_dir / "usr" / "lib").mkdir(parents=True)
+    (sysroot_dir / "usr" / "lib" / "libfoo.so.1").write_bytes(b"elf")
+    (sysroot_dir / "usr" / "lib" / "libfoo.so").symlink_to("libfoo.so.1")
+    (sysroot_dir / "lib").symlink_to("usr/lib")
+    manifest = {
+        "format_version": sysroot_builder.MANIFEST_VERSION,
+        "fingerprint": sysroot_config_fingerprint(config),
+    }
+    (sysroot_dir / ".webrtc-build-sysroot.json").write_text(
+        json.dumps({**manifest, "metrics": {"total_seconds": 1.0}}), encoding="utf-8"
+    )
+
+    artifact = export_sysroot_artifact(config, sysroot_dir, tmp_path / "first")
+    (sysroot_dir / ".webrtc-build-sysroot.json").write_text(
+        json.dumps({**manifest, "metrics": {"total_seconds": 2.0}}), encoding="utf-8"
+    )
+    second = export_sysroot_artifact(config, sysroot_dir, tmp_path / "second")
+    output_dir = tmp_path / "rootfs"
+    built = build_sysroot(config, output_dir, artifact_source=str(artifact.parent))
+
+    assert artifact.read_bytes() == second.read_bytes()
+    assert built is True
+    assert (output_dir / "lib" / "libfoo.so").read_bytes() == b"elf"
+    assert os.readlink(output_dir / "lib") == "usr/lib"
+    restored_manifest = json.loads(
+        (output_dir / ".webrtc-build-sysroot.json").read_text(encoding="utf-8")
+    )
+    assert "metrics" not in restored_manifest
+
+
+def test_move_to_trash_defers_removal(tmp_path: Path) -> None:
+    # 同じ名前のツリーを続けて移しても衝突せず、削除はバックグラウンドでも完了する。
+    trash_dir = tmp_path / ".trash"
+    trashed = []
+    for content in (b"first", b"second"):
+        tree = tmp_path / "rootfs"
+        (tree / "usr" / "lib").mkdir(parents=True)
+        (tree / "usr" / "lib" / "libfoo.so").write_bytes(content)
+        trashed.append(move_to_trash(tree))
+
+    assert not (tmp_path / "rootfs").exists()
+    assert [path.parent for path in trashed if path is not None] == [trash_dir, trash_dir]
+    assert move_to_trash(tmp_path / "missing") is None
+
+    empty_trash(trash_dir, background=True)
+    deadline = time.monotonic() + 30
+    while any(trash_dir.iterdir()) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert list(trash_dir.iterdir()) == []
+
+
+@pytest.mark.skipif(bool(missing_commands()), reason="apt-get, gpg or openssl is not installed")
+def test_build_sysroot_end_to_end_with_local_repository(tmp_path: Path) -> None:
+    # apt による依存解決と lockfile による取得の両方を、ネットワークなしで最後まで通す。
+    with local_repository(tmp_path / "repository", 4, 3, 1024) as config_path:
+        config = load_sysroot_config(config_path)
+        output_dir = tmp_path / "rootfs"
+        locked_dir = tmp_path / "locked"
+        assert build_sysroot(config, output_dir, cache_dir=tmp_path / "cache")
+        lock_sysroot(config, sysroot_lock_path(config_path))
+        locked = load_sysroot_lock(sysroot_lock_path(config_path), config)
+        assert build_sysroot(locked, locked_dir)
+
+    lib_dir = output_dir / "usr" / "lib" / "aarch64-linux-gnu"
+    assert os.readlink(lib_dir / "libbench0003.so") == "libbench0003.so.1"
+    assert os.readlink(output_dir / "usr" / "share" / "pkgconfig" / "libbench0000.pc") == (
+        "../../lib/aarch64-linux-gnu/pkgconfig/libbench0000.pc"
+    )
+    assert verify_sysroot(output_dir) == []
+    manifests = [
+        json.loads((root / ".webrtc-build-sysroot.json").read_text(encoding="utf-8"))
+        for root in (output_dir, locked_dir)
+    ]
+    assert len(manifests[0]["deb_files"]) == 5
+    assert manifests[0]["files"] == manifests[1]["files"]
+    assert set(manifests[0]["metrics"]["phases"]) >= {"update", "resolve", "download", "extract"}